@@ -1,12 +1,8 @@
 import asyncio
 import hashlib
 from json import JSONEncoder
-from lib2to3.fixes.fix_input import context
 import sys
 
-import transformers
-from pkg_resources import resource_listdir
-from seleniumwire import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.common.exceptions import (StaleElementReferenceException,
                                         TimeoutException,
@@ -21,7 +17,6 @@ from urllib.parse import urlparse, urljoin
 import json
 import pprint
 import datetime
-import tldextract
 import math
 import os
 import traceback
@@ -30,24 +25,37 @@ import re
 import time
 import itertools
 import string
-
-from torch.utils.hipify.hipify_python import bcolors
+from bisect import insort
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
+import copy
+import functools
+import threading
+import pickle
+import weakref
 
 from Functions import *
-from Navigation import DependencyGraph, Scheduler, Node
+from Navigation import DependencyGraph, Scheduler, Node, Cluster
+from checkpoint import CrawlCheckpoint
+from graph_store import GraphStore, store_key
+from snapshot_store import get_snapshot_store
 from extractors.Events import extract_events
 from extractors.Forms import extract_forms, parse_form
 from extractors.Urls import extract_urls
 from extractors.Iframes import extract_iframes
 from extractors.Ui_forms import extract_ui_forms
+from extractors.Page import analyze_page
+from settle import wait_for_settle
+from browser_state import save_browser_state
+from traffic import configure_capture
 from selenium.webdriver.common.by import By
 
 import logging
 
-from llm_manager import LLMManager
-from torch.utils.hipify.hipify_python import bcolors
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from llm_manager import LLMManager, get_tokenizer
+from similarity import SimilarityIndex
+from llm_cache import get_llm_cache
 
 timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 app_name = os.getenv("APP_NAME", "")
@@ -95,6 +103,8 @@ class Request:
         self.method = method
         self.before_resource_operation = None
         self.after_resource_operation = None
+        # Snapshot store digest of the browser state at this node
+        self.browser_state = None
 
     def set_before_resource_operation(self, resource_operation):
         self.before_resource_operation = resource_operation
@@ -136,7 +146,9 @@ class Request:
         return False
 
     def __hash__(self):
-        return hash(self.method)
+        if self.method == "get":
+            return hash((self.method, get_url_equivalence_key(self.url)))
+        return hash((self.method, self.url))
 
     def dump(self):
         return {
@@ -147,8 +159,26 @@ class Request:
         }
 
 
+# Graph methods that change it, crawl workers share one graph
+def synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class Graph:
+    # Nodes and edges are kept outside of the checkpoints
+    persistent = False
+
     def __init__(self):
+        # Also held by the crawler for changes spanning several calls
+        self.lock = threading.RLock()
+        Graph.clear(self)
+
+    # Forgets all nodes and edges, before a new crawl
+    @synchronized
+    def clear(self):
         self.nodes = []
         self.edges = []
         self.data = {}  # Metadata that can be used for anything
@@ -159,6 +189,11 @@ class Graph:
         self.failed_resource_operations = {}
         self.request_resource_operations = {}
         self.blocking_edges = []
+        # Index from node/edge key to positions in self.nodes/self.edges.
+        # Equal values always share a key, so lookups only compare a bucket.
+        self.node_index = defaultdict(list)
+        self.edge_index = defaultdict(list)
+        self.target_index = defaultdict(list)
 
     # Separate node class for storing meta data.
     class Node:
@@ -209,21 +244,77 @@ class Graph:
                 "depth": self.depth
             }
 
+    @staticmethod
+    def node_key(value):
+        if value.method == "get":
+            return value.method, get_url_equivalence_key(value.url)
+        return value.method, value.url
+
+    @staticmethod
+    def method_data_key(method, method_data):
+        if isinstance(method_data, Form):
+            # Form.__hash__ includes the action, but Form.__eq__ does not.
+            return method_data.method, hash(frozenset(method_data.inputs))
+        if isinstance(method_data, Event):
+            # execute_event may append /td[1] to the address of a row.
+            addr = method_data.addr
+            if isinstance(addr, str) and addr.endswith("/td[1]"):
+                addr = addr[:-len("/td[1]")]
+            if isinstance(method_data.id, dict):
+                return method_data.function_id, method_data.tag, addr
+            return method_data.function_id, method_data.id, method_data.tag, addr
+        return hash(method_data)
+
+    def edge_key(self, value):
+        return value.method, self.method_data_key(value.method, value.method_data)
+
+    # Recomputes the indexes, e.g. after the nodes and edges were replaced
+    @synchronized
+    def rebuild_index(self):
+        self.node_index = defaultdict(list)
+        self.edge_index = defaultdict(list)
+        self.target_index = defaultdict(list)
+        for (index, node) in enumerate(self.nodes):
+            self.node_index[self.node_key(node.value)].append(index)
+        for (index, edge) in enumerate(self.edges):
+            self.edge_index[self.edge_key(edge.value)].append(index)
+            self.target_index[self.node_key(edge.n2.value)].append(index)
+
+    def find_node(self, node):
+        for index in self.node_index[self.node_key(node.value)]:
+            if self.nodes[index] == node:
+                return index
+        return -1
+
+    def find_edge(self, edge):
+        for index in self.edge_index[self.edge_key(edge.value)]:
+            if self.edges[index] == edge:
+                return index
+        return -1
+
+    # Index of this very edge, find_edge also matches equal ones
+    def edge_position(self, edge):
+        for index in self.edge_index[self.edge_key(edge.value)]:
+            if self.edges[index] is edge:
+                return index
+        return -1
+
+    @synchronized
     def add(self, value):
         node = self.Node(value)
-        for index, existing_node in enumerate(self.nodes):
-            if existing_node == node:
-                return False, index
+        index = self.find_node(node)
+        if index >= 0:
+            return False, index
         self.nodes.append(node)
+        self.node_index[self.node_key(value)].append(len(self.nodes) - 1)
         return True, len(self.nodes) - 1
 
     def create_edge(self, v1, v2, value, parent=None):
         n1 = self.Node(v1)
         n2 = self.Node(v2)
         edge = self.Edge(n1, n2, value, parent)
-        for existing_edge in self.edges:
-            if existing_edge == edge:
-                return edge, True
+        if self.find_edge(edge) >= 0:
+            return edge, True
         return edge, False
 
     def has_successful_edge(self, edge):
@@ -239,6 +330,9 @@ class Graph:
                             if CRUD_type in self.successful_resource_operations[resource][method][operation]:
                                 if self.successful_resource_operations[resource][method][operation][CRUD_type]:
                                     return True
+        return self.is_successful(edge)
+
+    def is_successful(self, edge):
         for successful_edge in self.successful_edges:
             if successful_edge == edge:
                 return True
@@ -271,26 +365,25 @@ class Graph:
                 return True
         return False
 
+    @synchronized
     def connect(self, v1, v2, value, parent=None):
         n1 = self.Node(v1)
         n2 = self.Node(v2)
         edge = self.Edge(n1, n2, value, parent)
 
-        p1 = False
-        p2 = False
-        for index, existing_node in enumerate(self.nodes):
-            if existing_node == n1:
-                p1 = True
-            if existing_node == n2:
-                p2 = True
-        for index, existing_edge in enumerate(self.edges):
-            if existing_edge == edge:
-                return None
+        p1 = self.find_node(n1) >= 0
+        p2 = self.find_node(n2) >= 0
+        if self.find_edge(edge) >= 0:
+            return None
         if p1 and p2:
             self.edges.append(edge)
-            return edge, len(self.edges) - 1
+            edge_index = len(self.edges) - 1
+            self.edge_index[self.edge_key(value)].append(edge_index)
+            self.target_index[self.node_key(v2)].append(edge_index)
+            return edge, edge_index
         return None
 
+    @synchronized
     def add_success(self, edge):
         self.successful_edges.append(edge)
         if edge.value.after_resource_operation and edge.value.after_resource_operation != {}:
@@ -324,6 +417,7 @@ class Graph:
                     self.failed_resource_operations[resource][method][operation][CRUD_type] = 0
                 self.failed_resource_operations[resource][method][operation][CRUD_type] += 1
 
+    @synchronized
     def add_failed(self, edge):
         self.failed_edges.append(edge)
         if edge.value.after_resource_operation and edge.value.after_resource_operation != {}:
@@ -357,30 +451,102 @@ class Graph:
                     self.failed_resource_operations[resource][method][operation][CRUD_type] = 0
                 self.failed_resource_operations[resource][method][operation][CRUD_type] += 1
 
+    @synchronized
     def add_blocking(self, edge):
         self.blocking_edges.append(edge)
 
+    @synchronized
     def visit_node(self, value):
         node = self.Node(value)
-        if node in self.nodes:
-            target = self.nodes[self.nodes.index(node)]
-            target.visited = True
+        index = self.find_node(node)
+        if index >= 0:
+            self.nodes[index].visited = True
             return True
         return False
 
+    @synchronized
     def visit_edge(self, edge):
-        self.visited_edges.append(edge)
+        if not edge.visited:
+            self.visited_edges.append(edge)
         edge.visited = True
 
+    # Also drops the edge from visited_edges
+    @synchronized
     def unvisit_edge(self, edge):
-        if edge in self.edges:
+        if self.find_edge(edge) >= 0:
+            if edge.visited:
+                for (position, visited_edge) in enumerate(self.visited_edges):
+                    if visited_edge is edge:
+                        del self.visited_edges[position]
+                        break
             edge.visited = False
             return True
         return False
 
-    def get_parents(self, value):
+    # (index, edge) of the edges not visited yet
+    def unvisited_edges(self):
+        return [(index, edge) for (index, edge) in enumerate(self.edges) if not edge.visited]
+
+    # Number of unvisited edges per method
+    def unvisited_counts(self):
+        counts = defaultdict(int)
+        for edge in self.edges:
+            if not edge.visited:
+                counts[edge.value.method] += 1
+        return counts
+
+    # Edges whose target node is equal to value, in insertion order.
+    def get_edges_to(self, value):
         node = self.Node(value)
-        return [edge.n1.value for edge in self.edges if node == edge.n2]
+        return [self.edges[index] for index in self.target_index[self.node_key(value)]
+                if node == self.edges[index].n2]
+
+    def get_parents(self, value):
+        return [edge.n1.value for edge in self.get_edges_to(value)]
+
+    def nodes_with_key(self, key):
+        return list(self.node_index.get(key, []))
+
+    def edges_to_key(self, key):
+        return list(self.target_index.get(key, []))
+
+    # Nodes of the bucket key that are equal to an earlier node now, e.g.
+    # after a parameter turned out not to matter, are not crawled again.
+    # Returns the number of edges to them that were still unvisited.
+    @synchronized
+    def remerge_nodes(self, key):
+        kept = []
+        duplicate_urls = set()
+        for index in self.nodes_with_key(key):
+            if any(self.nodes[i] == self.nodes[index] for i in kept):
+                duplicate_urls.add(self.nodes[index].value.url)
+            else:
+                kept.append(index)
+        merged = 0
+        for edge_index in self.edges_to_key(key):
+            edge = self.edges[edge_index]
+            if not edge.visited and edge.n2.value.url in duplicate_urls:
+                self.visit_edge(edge)
+                merged += 1
+        return merged
+
+    # Request urls are normalized in place after being added, keep the
+    # indexes in sync with the new key.
+    @synchronized
+    def set_url(self, value, url):
+        old_key = self.node_key(value)
+        value.url = url
+        new_key = self.node_key(value)
+        if old_key == new_key:
+            return
+        moved = [index for index in self.node_index[old_key] if self.nodes[index].value is value]
+        for index in moved:
+            self.node_index[old_key].remove(index)
+            insort(self.node_index[new_key], index)
+        moved = [index for index in self.target_index[old_key] if self.edges[index].n2.value is value]
+        for index in moved:
+            self.target_index[old_key].remove(index)
+            insort(self.target_index[new_key], index)
 
     def __repr__(self):
         res = "---GRAPH---\n"
@@ -397,14 +563,376 @@ class Graph:
             "nodes": self.nodes,
             "edges": [str(edge) for edge in self.edges],
             "data": self.data,
-            "successful_edges": self.successful_edges,
+            "successful_edges": list(self.successful_edges),
             "successful_resource_operations": self.successful_resource_operations,
-            "failed_edges": self.failed_edges,
+            "failed_edges": list(self.failed_edges),
             "failed_resource_operations": self.failed_resource_operations,
             "request_resource_operations": self.request_resource_operations,
-            "blocking_edges": self.blocking_edges
+            "blocking_edges": list(self.blocking_edges)
         }
 
+# One of the edge lists of a SqliteGraph, e.g. visited_edges. Appending
+# records the edge in flag_events, iterating loads the edges in that order.
+class EdgeFlagList:
+    def __init__(self, graph, flag):
+        self.graph = graph
+        self.flag = flag
+
+    def append(self, edge):
+        index = self.graph.position(edge)
+        if index >= 0:
+            self.graph.store.add_flag(index, self.flag)
+
+    def __iter__(self):
+        return (self.graph.edges[index] for index in self.graph.store.flagged(self.flag))
+
+    def __len__(self):
+        return self.graph.store.count_flagged(self.flag)
+
+# Bookkeeping of the nodes and edges of a SqliteGraph. When one is no longer
+# used, its value and visited flag are queued for writing back unless they
+# are the same as in the store. Copies are not tied to the graph.
+class StoredItem:
+    def __getstate__(self):
+        return {name: value for (name, value) in self.__dict__.items()
+                if name not in ("write_queue", "store_index", "stored_state")}
+
+    def __del__(self):
+        # Runs wherever the last reference goes, so it must not take locks
+        write_queue = self.__dict__.get("write_queue")
+        if write_queue is None:
+            return
+        try:
+            (value, state) = pickled_state(self)
+        except Exception:
+            return
+        if state != self.stored_state:
+            write_queue.append((self.table, self.store_index, self.visited, value))
+
+class StoredNode(StoredItem, Graph.Node):
+    table = "nodes"
+
+class StoredEdge(StoredItem, Graph.Edge):
+    table = "edges"
+
+# Pickled value and what tells whether it changed
+def pickled_state(item):
+    value = pickle.dumps(item.value, protocol=pickle.HIGHEST_PROTOCOL)
+    return value, (item.visited, hash(value))
+
+# Nodes or edges of a SqliteGraph, loaded from the store when accessed. An
+# object stays the same as long as it is used anywhere, the list itself only
+# keeps the GRAPH_CACHE_SIZE most recently used ones alive.
+class StoredList:
+    def __init__(self, graph, load, length):
+        self.graph = graph
+        self.load = load
+        self.length = length
+        self.live = weakref.WeakValueDictionary()
+        self.recent = OrderedDict()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("graph index out of range")
+        with self.graph.loading:
+            item = self.live.get(index)
+            if item is None:
+                item = self.load(index)
+            self.keep(index, item)
+        return item
+
+    def __iter__(self):
+        index = 0
+        while index < self.length:
+            yield self[index]
+            index += 1
+
+    def append(self, item):
+        with self.graph.loading:
+            self.keep(self.length, item)
+            self.length += 1
+
+    def keep(self, index, item):
+        self.live[index] = item
+        self.recent[index] = item
+        self.recent.move_to_end(index)
+        if len(self.recent) > self.graph.cache_size:
+            self.recent.popitem(last=False)
+
+# Graph stored in SQLite (GRAPH_BACKEND=sqlite), for crawls whose graph does
+# not fit in memory.
+#
+# nodes and edges are StoredLists, lookups such as the unvisited edges or the
+# edges to a node are indexed queries. The graph survives a restart, the
+# checkpoints only hold the crawler state. A value handed to add or connect
+# is only tied to the graph while its node or edge is alive, look them up
+# again instead of keeping the value around.
+class SqliteGraph(Graph):
+    persistent = True
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.loading = threading.RLock()
+        self.store = GraphStore(path)
+        self.cache_size = int(os.getenv("GRAPH_CACHE_SIZE", 10000))
+        self.reset()
+
+    # Python side of the graph, the store keeps its rows
+    def reset(self):
+        self.data = {}
+        self.successful_resource_operations = {}
+        self.failed_resource_operations = {}
+        self.request_resource_operations = {}
+        # Objects of an earlier reset write back to a queue nobody reads
+        self.write_queue = deque()
+        self.nodes = StoredList(self, self.load_node, self.store.count("nodes"))
+        self.edges = StoredList(self, self.load_edge, self.store.count("edges"))
+
+    @synchronized
+    def clear(self):
+        with self.loading:
+            self.store.clear()
+            self.reset()
+
+    def edge_list(flag):
+        def get_list(self):
+            return EdgeFlagList(self, flag)
+
+        def set_list(self, edges):
+            self.store.reset_flag(flag)
+            for edge in edges:
+                EdgeFlagList(self, flag).append(edge)
+        return property(get_list, set_list)
+
+    visited_edges = edge_list("visited")
+    successful_edges = edge_list("successful")
+    failed_edges = edge_list("failed")
+    blocking_edges = edge_list("blocking")
+    del edge_list
+
+    def track(self, item, index, value):
+        item.store_index = index
+        item.stored_state = (item.visited, hash(value))
+        item.write_queue = self.write_queue
+
+    # Writes the nodes and edges that were dropped since the last call
+    def write_back(self):
+        with self.loading:
+            while self.write_queue:
+                (table, index, visited, value) = self.write_queue.popleft()
+                self.store.save_row(table, index, visited, value)
+
+    # Writes every changed node and edge, e.g. before a checkpoint
+    @synchronized
+    def flush(self):
+        with self.loading:
+            for items in [self.nodes, self.edges]:
+                for item in list(items.live.values()):
+                    (value, state) = pickled_state(item)
+                    if state != item.stored_state:
+                        self.store.save_row(item.table, item.store_index, item.visited, value)
+                        item.stored_state = state
+            self.write_back()
+
+    def load_node(self, index):
+        self.write_back()
+        (visited, value) = self.store.node_row(index)
+        node = StoredNode(pickle.loads(value))
+        node.visited = bool(visited)
+        self.track(node, index, value)
+        return node
+
+    def load_edge(self, index):
+        self.write_back()
+        (visited, n1, n2, parent, parent_value, value) = self.store.edge_row(index)
+        if parent is not None:
+            parent = self.edges[parent]
+        elif parent_value is not None:
+            parent = pickle.loads(parent_value)
+        edge = StoredEdge(self.nodes[n1], self.nodes[n2], pickle.loads(value), parent)
+        edge.visited = bool(visited)
+        self.track(edge, index, value)
+        return edge
+
+    # Index the edge was stored at, -1 for edges not in this graph
+    def position(self, edge):
+        index = getattr(edge, "store_index", -1)
+        if self.edges.live.get(index) is edge:
+            return index
+        return -1
+
+    # Checkpoint reference of a node or edge of this graph, None for others
+    def reference(self, obj):
+        index = getattr(obj, "store_index", -1)
+        if self.nodes.live.get(index) is obj:
+            return ("node", index)
+        if self.edges.live.get(index) is obj:
+            return ("edge", index)
+        return None
+
+    # Recomputes the keys, e.g. after node_key changed
+    @synchronized
+    def rebuild_index(self):
+        for (index, node) in enumerate(self.nodes):
+            self.store.set_node_key(index, store_key(self.node_key(node.value)))
+        for (index, edge) in enumerate(self.edges):
+            self.store.set_edge_keys(index, store_key(self.edge_key(edge.value)), store_key(self.node_key(edge.n2.value)))
+
+    def find_node(self, node):
+        for index in self.store.nodes_with_key(store_key(self.node_key(node.value))):
+            if self.nodes[index] == node:
+                return index
+        return -1
+
+    def find_edge(self, edge):
+        for index in self.store.edges_with_key(store_key(self.edge_key(edge.value))):
+            if self.edges[index] == edge:
+                return index
+        return -1
+
+    def edge_position(self, edge):
+        return self.position(edge)
+
+    @synchronized
+    def add(self, value):
+        node = StoredNode(value)
+        index = self.find_node(node)
+        if index >= 0:
+            return False, index
+        index = len(self.nodes)
+        stored_value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.store.add_node(index, value.method, store_key(self.node_key(value)), stored_value)
+        self.track(node, index, stored_value)
+        self.nodes.append(node)
+        return True, index
+
+    # Edges point at the stored nodes equal to v1 and v2
+    @synchronized
+    def connect(self, v1, v2, value, parent=None):
+        n1 = self.Node(v1)
+        n2 = self.Node(v2)
+        edge = self.Edge(n1, n2, value, parent)
+
+        p1 = self.find_node(n1)
+        p2 = self.find_node(n2)
+        if self.find_edge(edge) >= 0:
+            return None
+        if p1 >= 0 and p2 >= 0:
+            edge = StoredEdge(self.nodes[p1], self.nodes[p2], value, parent)
+            edge_index = len(self.edges)
+            parent_index = self.position(parent) if parent is not None else -1
+            parent_value = None
+            if parent is not None and parent_index < 0:
+                parent_value = pickle.dumps(parent, protocol=pickle.HIGHEST_PROTOCOL)
+            stored_value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            self.store.add_edge(edge_index, value.method, store_key(self.edge_key(value)), store_key(self.node_key(v2)),
+                                p1, p2, parent_index if parent_index >= 0 else None, parent_value, stored_value)
+            self.track(edge, edge_index, stored_value)
+            self.edges.append(edge)
+            return edge, edge_index
+        return None
+
+    @synchronized
+    def add_success(self, edge):
+        super().add_success(edge)
+        self.store_operation(edge)
+
+    @synchronized
+    def add_failed(self, edge):
+        super().add_failed(edge)
+        self.store_operation(edge)
+
+    def store_operation(self, edge):
+        index = self.position(edge)
+        resource_operation = edge.value.after_resource_operation or edge.value.before_resource_operation
+        if index >= 0 and resource_operation:
+            self.store.set_operation(index, resource_operation.get('resource'), resource_operation.get('operation'),
+                                     resource_operation.get('CRUD_type'))
+
+    @synchronized
+    def visit_node(self, value):
+        node = self.Node(value)
+        index = self.find_node(node)
+        if index >= 0:
+            self.nodes[index].visited = True
+            self.store.visit_node(index)
+            return True
+        return False
+
+    @synchronized
+    def visit_edge(self, edge):
+        if not edge.visited:
+            self.visited_edges.append(edge)
+        edge.visited = True
+        index = self.position(edge)
+        if index >= 0:
+            self.store.set_visited(index, True)
+
+    @synchronized
+    def unvisit_edge(self, edge):
+        if self.find_edge(edge) >= 0:
+            index = self.position(edge)
+            if index >= 0:
+                if edge.visited:
+                    self.store.remove_flag(index, "visited")
+                self.store.set_visited(index, False)
+            edge.visited = False
+            return True
+        return False
+
+    def is_successful(self, edge):
+        for index in self.store.flagged_with_key("successful", store_key(self.edge_key(edge.value))):
+            if self.edges[index] == edge:
+                return True
+        # CrawlEdge.__eq__ also matches a successful edge with another key
+        # whose operation is the one edge turned out to do
+        if edge.value.success and edge.value.after_resource_operation:
+            return super().is_successful(edge)
+        return False
+
+    def unvisited_edges(self):
+        return [(index, self.edges[index]) for index in self.store.unvisited_edges() if not self.edges[index].visited]
+
+    def unvisited_counts(self):
+        return self.store.unvisited_counts()
+
+    def get_edges_to(self, value):
+        node = self.Node(value)
+        return [self.edges[index] for index in self.store.edges_to(store_key(self.node_key(value)))
+                if node == self.edges[index].n2]
+
+    def nodes_with_key(self, key):
+        return self.store.nodes_with_key(store_key(key))
+
+    def edges_to_key(self, key):
+        return self.store.edges_to(store_key(key))
+
+    @synchronized
+    def set_url(self, value, url):
+        old_key = store_key(self.node_key(value))
+        value.url = url
+        new_key = store_key(self.node_key(value))
+        if old_key == new_key:
+            return
+        for index in self.store.nodes_with_key(old_key):
+            if self.nodes[index].value is value:
+                self.store.set_node_key(index, new_key)
+        for index in self.store.edges_to(old_key):
+            if self.edges[index].n2.value is value:
+                self.store.set_target_key(index, new_key)
+
+def create_graph():
+    if os.getenv("GRAPH_BACKEND", "memory") == "sqlite":
+        return SqliteGraph(os.getenv("GRAPH_DB", os.path.join(os.getcwd(), "cache", "graph.sqlite")))
+    return Graph()
+
 
 class Form:
     def __init__(self):
@@ -806,14 +1334,28 @@ class Ui_form:
         }
 
 class Crawler:
-    def __init__(self, driver, url, request_queue, analysis_queue, condition_signal, still_crawling_signal):
+    def __init__(self, driver, url, request_queue, analysis_queue, condition_signal, still_crawling_signal, driver_factory=None):
         self.root_req = None
         self.debug_mode = None
         self.driver = driver
 
+        # Opens extra browsers for the crawl workers and the attack phase
+        self.driver_factory = driver_factory
+        self.crawl_browsers = max(1, int(os.getenv("CRAWL_BROWSERS", 1)))
+        self.attack_browsers = max(1, int(os.getenv("ATTACK_BROWSERS", 1)))
+        # Edges a crawl worker is following right now
+        self.crawling_edges = set()
+        self.crawl_stop = threading.Event()
+        self.crawl_workers = None
+        # Bumped on every login, workers log in again when they are behind
+        self.login_generation = 0
+        # Hands out edges to remote workers, see distributed.py
+        self.coordinator = None
+
         # Start url
         self.url = url
-        self.graph = Graph()
+        configure_capture(driver, url)
+        self.graph = create_graph()
 
         self.dependency_graph = DependencyGraph(self)
 
@@ -823,6 +1365,9 @@ class Crawler:
 
         # Used to track injections. Each injection will have a unique key.
         self.attack_lookup_table = {}
+        # Attack browsers share the table and the result files
+        self.attack_table_lock = threading.Lock()
+        self.result_lock = threading.Lock()
 
         # input / output graph
         self.io_graph = {}
@@ -848,6 +1393,8 @@ class Crawler:
 
         self.cookies = []
 
+        self.login_url = None
+
         self.still_work = True
 
         self.request_queue = request_queue
@@ -858,7 +1405,7 @@ class Crawler:
 
         self.still_crawling_signal = still_crawling_signal
 
-        self.event_prompt_cache = []
+        self.event_prompt_index = SimilarityIndex()
 
         self.event_prompt_hash_cache = []
 
@@ -872,53 +1419,72 @@ class Crawler:
             "remove"
         ]
 
-        self.tokenizer = transformers.AutoTokenizer.from_pretrained(
-            os.getcwd(), trust_remote_code=True
-        )
-
         self.semantic_cache = semantic_cache
 
         self.resource_parent_child_relationship = {}
 
         self.resource_child_parent_relationship = {}
+        # Create and read edges shown per known resource when inferring
+        # dependencies
+        self.dependency_contexts = int(os.getenv("DEPENDENCY_CONTEXTS", 1))
 
         self.received_requests = set()
         self.received_requests.add(0)
 
+        self.after_analysis_executor = ThreadPoolExecutor(max_workers=int(os.getenv("AFTER_ANALYSIS_WORKERS", 4)))
+        self.pending_after_analysis = []
+
+        # Edge index to the positions of its replay path, see replay_path
+        self.replay_paths = {}
+
+        # Crawl time spent before a resume
+        self.crawl_elapsed = 0.0
+        self.checkpoint = CrawlCheckpoint(os.getenv("CHECKPOINT_DIR", os.path.join(os.getcwd(), "cache", "checkpoint")))
+
         logging.info("Init crawl on " + url)
 
-    async def start(self, debug_mode=False):
-        self.root_req = Request("ROOTREQ", "get")
-        req = Request(self.url, "get")
-        self.graph.add(self.root_req)
-        self.graph.add(req)
-        self.graph.connect(self.root_req, req, CrawlEdge("get", None, None, None))
+    async def start(self, debug_mode=False, resume=False):
         self.debug_mode = debug_mode
 
-        # Path deconstruction
-        # TODO arg for this
-        if not debug_mode:
-            purl = urlparse(self.url)
-            if purl.path:
-                path_builder = ""
-                for d in purl.path.split("/")[:-1]:
-                    if d:
-                        path_builder += d + "/"
-                        tmp_purl = purl._replace(path=path_builder)
-                        req = Request(tmp_purl.geturl(), "get")
-                        self.graph.add(req)
-                        self.graph.connect(self.root_req, req, CrawlEdge("get", None, None, None))
-
-        self.graph.data['urls'] = {}
-        self.graph.data['form_urls'] = {}
+        resumed = resume and self.resume_from_checkpoint()
+        if not resumed:
+            self.checkpoint.clear()
+            get_snapshot_store().clear()
+            self.graph.clear()
+            self.root_req = Request("ROOTREQ", "get")
+            req = Request(self.url, "get")
+            self.graph.add(self.root_req)
+            self.graph.add(req)
+            self.graph.connect(self.root_req, req, CrawlEdge("get", None, None, None))
+
+            # Path deconstruction
+            # TODO arg for this
+            if not debug_mode:
+                purl = urlparse(self.url)
+                if purl.path:
+                    path_builder = ""
+                    for d in purl.path.split("/")[:-1]:
+                        if d:
+                            path_builder += d + "/"
+                            tmp_purl = purl._replace(path=path_builder)
+                            req = Request(tmp_purl.geturl(), "get")
+                            self.graph.add(req)
+                            self.graph.connect(self.root_req, req, CrawlEdge("get", None, None, None))
+
+            self.graph.data['urls'] = {}
+            self.graph.data['form_urls'] = {}
         open("run.flag", "w+").write("1")
         open("queue.txt", "w+").write("")
         open("command.txt", "w+").write("")
 
         random.seed(6)  # chosen by fair dice roll
 
-        self.start_time = time.time()
+        self.start_time = time.time() - self.crawl_elapsed
         self.condition_signal.set()
+        self.driver.login_generation = self.login_generation
+        if self.coordinator:
+            self.coordinator.start(resumed)
+        self.start_crawl_workers()
         while self.still_work:
             elapsed_time = time.time() - self.start_time
             if elapsed_time > self.max_crawl_time:
@@ -927,7 +1493,8 @@ class Crawler:
                 break
 
             print(bcolors.OKGREEN+"-----------------------------------"+bcolors.ENDC)
-            new_edges = len([edge for edge in self.graph.edges if edge.visited == False])
+            unvisited_counts = self.graph.unvisited_counts()
+            new_edges = sum(unvisited_counts.values())
             print(bcolors.OKGREEN+"Edges left: "+ str(new_edges)+bcolors.ENDC)
             try:
                 if "0" in open("run.flag", "r").read():
@@ -938,17 +1505,9 @@ class Crawler:
                     input("Crawler paused, press enter to continue")
                     open("run.flag", "w+").write("3")
 
-                n_gets = 0
-                n_forms = 0
-                n_events = 0
-                for edge in self.graph.edges:
-                    if not edge.visited:
-                        if edge.value.method == "get":
-                            n_gets += 1
-                        elif edge.value.method == "form":
-                            n_forms += 1
-                        elif edge.value.method == "event":
-                            n_events += 1
+                n_gets = unvisited_counts.get("get", 0)
+                n_forms = unvisited_counts.get("form", 0)
+                n_events = unvisited_counts.get("event", 0)
                 print()
                 print(bcolors.OKGREEN+"----------------------"+bcolors.ENDC)
                 print(bcolors.OKGREEN+"GETS    | FORMS  | EVENTS "+bcolors.ENDC)
@@ -964,19 +1523,29 @@ class Crawler:
                     logging.error(str(e).splitlines()[0])
                     logging.error("Top level error while crawling")
 
+                with self.graph.lock:
+                    self.checkpoint.maybe_save(self)
+
             except KeyboardInterrupt:
                 print(bcolors.OKGREEN+"CTRL-C, abort mission"+bcolors.ENDC)
                 logging.info("CTRL-C, abort mission")
                 break
 
+        if self.coordinator:
+            self.coordinator.stop()
+        self.stop_crawl_workers()
         self.still_crawling_signal.clear()
+        self.receive_after_analysis(self.graph, wait=True)
+        self.after_analysis_executor.shutdown()
+        self.checkpoint.save(self)
 
         print(bcolors.OKGREEN+"Done crawling, ready to attack!"+bcolors.ENDC)
         logging.info("Done crawling, ready to attack!")
 
         try:
             for edge in self.graph.edges:
-                edge.visited = False
+                if edge.visited:
+                    self.graph.unvisit_edge(edge)
 
             self.attack()
 
@@ -986,6 +1555,7 @@ class Crawler:
 
             print(bcolors.OKGREEN+"Done deleting, ready to blocking!"+bcolors.ENDC)
             self.attack_blocking()
+            self.checkpoint.save(self)
         except Exception as e:
             print(bcolors.OKGREEN+str(e).splitlines()[0]+bcolors.ENDC)
             print(bcolors.OKGREEN + "Top level error while attacking" + bcolors.ENDC)
@@ -994,41 +1564,182 @@ class Crawler:
 
         print(bcolors.OKGREEN+"pause"+bcolors.ENDC)
 
-    def infer_resource_dependency_relationship(self, potential_parent_name, potential_parent_index_list, potential_child_name, potential_child_index_list):
-        if potential_parent_name in self.resource_parent_child_relationship and potential_child_name in self.resource_parent_child_relationship[potential_parent_name]:
-            return self.resource_parent_child_relationship[potential_parent_name][potential_child_name]
-        if potential_child_name in self.resource_child_parent_relationship and potential_parent_name in self.resource_child_parent_relationship[potential_child_name]:
-            if self.resource_child_parent_relationship[potential_child_name][potential_parent_name]:
-                return False
-        dependency_prompt = f"Resource A: {potential_parent_name}"
-        for index in potential_parent_index_list:
-            edge = self.graph.edges[index]
-            dependency_prompt += f"\n{edge.value.before_prompt}"
-
-        dependency_prompt += f"\nResource B: {potential_child_name}"
-        for index in potential_child_index_list:
-            edge = self.graph.edges[index]
-            dependency_prompt += f"\n{edge.value.before_prompt}"
-        start = time.time()
-        formatted_start = datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
-        print(bcolors.OKGREEN+"start inferring resource parent-child relationship "+str(formatted_start)+bcolors.ENDC)
-        analysis = self.llm_manager.identify_resource_dependency_relationship(dependency_prompt)
-        compensation_time = time.time() - start
-        average_llm_time = int(os.getenv("AVERAGE_LLM_TIME", 5))
-        if compensation_time > average_llm_time:
-            self.max_crawl_time += compensation_time - average_llm_time
-            self.max_crawl_time = min(self.max_crawl_time, 2 * float(os.getenv("MAX_CRAWL_TIME", 60 * 60 * 3)))
-            print(bcolors.OKGREEN + "max_crawl_time " + str(self.max_crawl_time) + " compensation_time " + str(
-                compensation_time) + bcolors.ENDC)
-        dependency_relationship = analysis.get("parent-child relationship", False)
-        print(bcolors.OKGREEN+"end inferring resource parent-child relationship "+str(time.time()-start)+bcolors.ENDC)
-        print(bcolors.OKGREEN+"Resource parent-child relationship for "+str(potential_parent_name)+" and "+str(potential_child_name)+": "+str(dependency_relationship)+bcolors.ENDC)
-        if potential_parent_name not in self.resource_parent_child_relationship:
-            self.resource_parent_child_relationship[potential_parent_name] = {}
-        if potential_child_name not in self.resource_parent_child_relationship[potential_parent_name]:
-            self.resource_parent_child_relationship[potential_parent_name][potential_child_name] = dependency_relationship
-
-        return dependency_relationship
+    # Loaded on first use and shared with the rest of the process
+    @property
+    def tokenizer(self):
+        return get_tokenizer()
+
+    # Everything besides the graph nodes and edges needed to continue a crawl
+    def checkpoint_state(self):
+        graph = self.graph
+        clusters = []
+        for (key, cluster) in self.dependency_graph.clusters.items():
+            clusters.append((key, cluster.nodes,
+                             [(c.resource, c.operation) for c in cluster.predecessors],
+                             [(c.resource, c.operation) for c in cluster.successors]))
+        graph_state = {
+            "data": graph.data,
+            "successful_resource_operations": graph.successful_resource_operations,
+            "failed_resource_operations": graph.failed_resource_operations,
+            "request_resource_operations": graph.request_resource_operations
+        }
+        # A persistent graph keeps its edge lists itself
+        if not graph.persistent:
+            graph_state.update({
+                "visited_edges": list(graph.visited_edges),
+                "successful_edges": list(graph.successful_edges),
+                "failed_edges": list(graph.failed_edges),
+                "blocking_edges": list(graph.blocking_edges)
+            })
+        return {
+            "graph": graph_state,
+            "clusters": clusters,
+            "parent_cache": dict(self.dependency_graph.parent_cache),
+            "attack_lookup_table": self.attack_table_snapshot(),
+            "io_graph": self.io_graph,
+            "events_in_row": self.events_in_row,
+            "early_gets": self.early_gets,
+            "crawl_elapsed": time.time() - self.start_time,
+            "resource_operation": self.resource_operation,
+            "link_urls": self.link_urls,
+            "cookies": self.cookies,
+            "login_url": self.login_url,
+            "event_prompts": self.event_prompt_index.prompts,
+            "event_prompt_hash_cache": self.event_prompt_hash_cache,
+            "semantic_cache": self.semantic_cache,
+            "resource_parent_child_relationship": self.resource_parent_child_relationship,
+            "resource_child_parent_relationship": self.resource_child_parent_relationship,
+            "received_requests": self.received_requests,
+            # Edges whose after request analysis has not been applied yet
+            "pending_after_analysis": [graph.edge_position(edge) for (future, edge) in self.pending_after_analysis]
+        }
+
+    def restore_checkpoint_state(self, state):
+        for (name, value) in state["graph"].items():
+            setattr(self.graph, name, value)
+
+        clusters = {}
+        for (key, nodes, predecessors, successors) in state["clusters"]:
+            clusters[key] = Cluster(*key)
+            clusters[key].nodes = nodes
+        for (key, nodes, predecessors, successors) in state["clusters"]:
+            clusters[key].predecessors = [clusters[k] for k in predecessors]
+            clusters[key].successors = [clusters[k] for k in successors]
+        self.dependency_graph.clusters = clusters
+        self.dependency_graph.parent_cache.update(state["parent_cache"])
+        self.dependency_graph.rebuild()
+
+        self.attack_lookup_table = state["attack_lookup_table"]
+        self.io_graph = state["io_graph"]
+        self.events_in_row = state["events_in_row"]
+        self.early_gets = state["early_gets"]
+        self.crawl_elapsed = state["crawl_elapsed"]
+        self.resource_operation = state["resource_operation"]
+        self.link_urls = state["link_urls"]
+        self.cookies = state["cookies"]
+        self.login_url = state["login_url"]
+        for prompt in state["event_prompts"]:
+            self.event_prompt_index.add(prompt)
+        self.event_prompt_hash_cache = state["event_prompt_hash_cache"]
+        # Functions keeps a reference to the same dict
+        self.semantic_cache.update(state["semantic_cache"])
+        self.resource_parent_child_relationship = state["resource_parent_child_relationship"]
+        self.resource_child_parent_relationship = state["resource_child_parent_relationship"]
+        self.received_requests = state["received_requests"]
+        # Asked again like the before request analyses
+        for edge_index in state.get("pending_after_analysis", []):
+            if edge_index >= 0:
+                self.submit_after_analysis(self.graph, self.graph.edges[edge_index])
+
+    def resume_from_checkpoint(self):
+        state = self.checkpoint.load(self.graph)
+        if state is None:
+            print(bcolors.OKGREEN+"No checkpoint to resume from, starting a new crawl"+bcolors.ENDC)
+            logging.warning("No checkpoint to resume from, starting a new crawl")
+            return False
+        self.restore_checkpoint_state(state)
+        self.root_req = self.graph.nodes[0].value
+
+        # Analyses that were still in the LLM process are asked again,
+        # analyzed edges are not
+        requeued = 0
+        for (edge_index, edge) in enumerate(self.graph.edges):
+            if edge_index in self.received_requests or not edge.value.before_prompt:
+                continue
+            request_wrapper = {"req_index": self.graph.find_node(edge.n2), "prompt": edge.value.before_prompt, "edge_index": edge_index}
+            if edge.value.method == "event":
+                request_wrapper["is_event"] = True
+            self.request_queue.put(request_wrapper)
+            requeued += 1
+        # Dependency answers that were still in the LLM process
+        for resource in sorted({r for (r, operation) in self.dependency_graph.clusters}):
+            self.dependency_graph.infer_dependencies(resource, [])
+
+        print(bcolors.OKGREEN+"Resumed crawl with "+str(len(self.graph.edges))+" edges, "+str(requeued)+" waiting for analysis"+bcolors.ENDC)
+        logging.info("Resumed crawl with " + str(len(self.graph.edges)) + " edges, " + str(requeued) + " waiting for analysis")
+        return True
+
+    # Known answer whether child depends on parent, None if there is none
+    def known_resource_dependency(self, parent, child):
+        if child in self.resource_parent_child_relationship.get(parent, {}):
+            return self.resource_parent_child_relationship[parent][child]
+        if self.resource_child_parent_relationship.get(child, {}).get(parent):
+            return False
+        llm_cache = get_llm_cache()
+        if llm_cache:
+            return llm_cache.get("resource_dependency", str(parent) + "\n" + str(child))
+        return None
+
+    def set_resource_dependency(self, parent, child, related):
+        self.resource_parent_child_relationship.setdefault(parent, {})[child] = related
+        if related:
+            self.dependency_graph.link_delete(parent, child)
+
+    # Asks the LLM process in one request how a new resource relates to all
+    # known resources, the answer arrives with the analyses. Pairs answered
+    # before are applied right away. Returns the resources the pending
+    # answer is about, [] when nothing was asked.
+    def request_resource_dependencies(self, resource, index_list):
+        unknown = []
+        for other in sorted({r for (r, operation) in self.dependency_graph.clusters} - {resource}):
+            related = self.known_resource_dependency(resource, other)
+            reverse = self.known_resource_dependency(other, resource)
+            if related is None or reverse is None:
+                unknown.append(other)
+                continue
+            self.set_resource_dependency(resource, other, related)
+            self.set_resource_dependency(other, resource, reverse)
+        if not unknown or self.request_queue is None:
+            return []
+
+        dependency_prompt = f"Resource A: {resource}"
+        for index in index_list:
+            dependency_prompt += f"\n{self.graph.edges[index].value.before_prompt}"
+        for other in unknown:
+            dependency_prompt += f"\nKnown resource: {other}"
+            for operation in ['create', 'read']:
+                nodes = self.dependency_graph.clusters[(other, operation)].nodes
+                for node in random.sample(nodes, min(self.dependency_contexts, len(nodes))):
+                    dependency_prompt += f"\n{self.graph.edges[node.index].value.before_prompt}"
+        self.request_queue.put({"type": "resource_dependency", "resource": resource, "known": unknown, "prompt": dependency_prompt})
+        logging.info("Inferring dependencies of " + str(resource) + " on " + str(len(unknown)) + " resources")
+        return [resource] + unknown
+
+    def apply_resource_dependencies(self, dependency_wrapper):
+        resource = dependency_wrapper["resource"]
+        self.dependency_graph.inferred([resource] + dependency_wrapper["known"])
+        if dependency_wrapper["error"]:
+            logging.warning("Failed to infer dependencies of " + str(resource))
+            return
+        llm_cache = get_llm_cache()
+        for other in dependency_wrapper["known"]:
+            for (parent, child, related) in [(resource, other, other in dependency_wrapper["children"]),
+                                             (other, resource, other in dependency_wrapper["parents"])]:
+                self.set_resource_dependency(parent, child, related)
+                if llm_cache:
+                    llm_cache.put("resource_dependency", str(parent) + "\n" + str(child), related)
+        print(bcolors.OKGREEN+"Resource "+str(resource)+" has children "+str(dependency_wrapper["children"])+" and parents "+str(dependency_wrapper["parents"])+bcolors.ENDC)
+        logging.info("Resource " + str(resource) + " has children " + str(dependency_wrapper["children"]) + " and parents " + str(dependency_wrapper["parents"]))
 
     def extract_vectors(self, is_delete, is_blocking):
         print(bcolors.OKGREEN+"Extracting urls"+bcolors.ENDC)
@@ -1083,7 +1794,7 @@ class Crawler:
                 vectors.append(("get", edge.value.method_data))
             if method == "form":
                 vectors.append(("form", edge))
-                edge.visited = True
+                self.graph.visit_edge(edge)
             if method == "event":
                 event = method_data
 
@@ -1093,7 +1804,7 @@ class Crawler:
                         ("on" + event.event in exploitable_events)):
                     if not event in added:
                         vectors.append(("event", edge))
-                        edge.visited = True
+                        self.graph.visit_edge(edge)
                         added.add(event)
 
         return vectors
@@ -1138,7 +1849,7 @@ class Crawler:
                 logging.error("Can't attack event " + str(event) + " " + str(e).splitlines()[0])
 
             # Inspect
-            inspect_result = self.inspect_attack(vector_edge)
+            inspect_result = self.inspect_attack(driver, vector_edge)
             if inspect_result:
                 successful_xss = successful_xss.union(inspect_result)
                 if lookup_id in inspect_result:
@@ -1154,7 +1865,7 @@ class Crawler:
         if "#" in vector and not "#####" in vector:
             driver.get("http://localhost")
         driver.get(vector)
-        inspect_result = self.inspect_attack(vector)
+        inspect_result = self.inspect_attack(driver, vector)
         if inspect_result:
             successful_xss = successful_xss.union(inspect_result)
 
@@ -1196,7 +1907,7 @@ class Crawler:
                     driver.get(attack_vector)
 
                     # Inspect
-                    inspect_result = self.inspect_attack(vector)
+                    inspect_result = self.inspect_attack(driver, vector)
                     if inspect_result:
                         successful_xss = successful_xss.union(inspect_result)
                         if lookup_id in inspect_result:
@@ -1233,7 +1944,7 @@ class Crawler:
                         driver.get(attack_vector)
 
                         # Inspect
-                        inspect_result = self.inspect_attack(vector)
+                        inspect_result = self.inspect_attack(driver, vector)
                         if inspect_result:
                             successful_xss = successful_xss.union(inspect_result)
                             if lookup_id in inspect_result:
@@ -1325,65 +2036,76 @@ class Crawler:
 
     # Adds it to the attack table
     def use_payload(self, lookup_id, vector_with_payload):
-        self.attack_lookup_table[str(lookup_id)] = {"injected": vector_with_payload,
-                                                    "reflected": set()}
+        with self.attack_table_lock:
+            self.attack_lookup_table[str(lookup_id)] = {"injected": vector_with_payload,
+                                                        "reflected": set()}
+
+    # Copy of the attack table that is safe to print while attacks are running
+    def attack_table_snapshot(self):
+        with self.attack_table_lock:
+            return {k: {"injected": v["injected"], "reflected": set(v["reflected"])}
+                    for (k, v) in self.attack_lookup_table.items()}
 
     # Checks for successful injections
-    def inspect_attack(self, vector_edge):
+    def inspect_attack(self, driver, vector_edge):
         successful_xss = set()
 
         # attribute injections
-        attribute_injects = self.driver.find_elements(By.XPATH, "//*[@jaekpot-attribute]")
+        attribute_injects = driver.find_elements(By.XPATH, "//*[@jaekpot-attribute]")
         for attribute in attribute_injects:
             try:
                 lookup_id = attribute.get_attribute("jaekpot-attribute")
                 successful_xss.add(lookup_id)
-                self.reflected_payload(lookup_id, vector_edge)
+                self.reflected_payload(driver, lookup_id, vector_edge)
             except Exception as e:
                 print(bcolors.OKGREEN+"PROBLEM INSPECTING ATTRIBUTE"+bcolors.ENDC)
                 logging.error("Can't inspect attribute " + str(attribute) + " " + str(e).splitlines()[0])
 
-        xsses_json = self.driver.execute_script("return JSON.stringify(xss_array)")
+        xsses_json = driver.execute_script("return JSON.stringify(xss_array)")
         lookup_ids = json.loads(xsses_json)
 
         for lookup_id in lookup_ids:
             successful_xss.add(lookup_id)
-            self.reflected_payload(lookup_id, vector_edge)
+            self.reflected_payload(driver, lookup_id, vector_edge)
 
         # Save successful attacks to file
         if successful_xss:
             app_result_path = os.path.join(RESULT_DIR, self.app_name)
-            f = open(os.path.join(app_result_path, "successful_injections-" + self.session_id + ".txt"), "a+")
-            for xss in successful_xss:
-                attack_entry = self.get_table_entry(xss)
-                if attack_entry:
-                    print(bcolors.OKGREEN+"----------------------------"+bcolors.ENDC)
-                    print(bcolors.OKGREEN+"Found vulnerability: "+str(attack_entry)+bcolors.ENDC)
-                    print(bcolors.OKGREEN+"----------------------------"+bcolors.ENDC)
-                    simple_entry = {'reflected': str(attack_entry['reflected']),
-                                    'injected': str(attack_entry['injected'])}
-
-                    try:
-                        f.write(json.dumps(simple_entry) + "\n")
-                    except Exception as e:
-                        logging.error("Error while dumping successful injections: " + str(e))
-                        print(bcolors.OKGREEN+"Error while dumping successful injections: "+str(e)+bcolors.ENDC)
+            with self.result_lock:
+                f = open(os.path.join(app_result_path, "successful_injections-" + self.session_id + ".txt"), "a+")
+                for xss in successful_xss:
+                    attack_entry = self.get_table_entry(xss)
+                    if attack_entry:
+                        print(bcolors.OKGREEN+"----------------------------"+bcolors.ENDC)
+                        print(bcolors.OKGREEN+"Found vulnerability: "+str(attack_entry)+bcolors.ENDC)
+                        print(bcolors.OKGREEN+"----------------------------"+bcolors.ENDC)
+                        simple_entry = {'reflected': str(attack_entry['reflected']),
+                                        'injected': str(attack_entry['injected'])}
+
+                        try:
+                            f.write(json.dumps(simple_entry) + "\n")
+                        except Exception as e:
+                            logging.error("Error while dumping successful injections: " + str(e))
+                            print(bcolors.OKGREEN+"Error while dumping successful injections: "+str(e)+bcolors.ENDC)
+                f.close()
 
         return successful_xss
 
-    def reflected_payload(self, lookup_id, location):
-        if str(lookup_id) in self.attack_lookup_table:
-            #self.attack_lookup_table[str(lookup_id)]["reflected"].append((self.driver.current_url, location))
-            self.attack_lookup_table[str(lookup_id)]["reflected"].add((self.driver.current_url, location))
-        else:
-            logging.warning("Could not find lookup_id %s, perhaps from an older attack session?" % lookup_id)
+    def reflected_payload(self, driver, lookup_id, location):
+        current_url = driver.current_url
+        with self.attack_table_lock:
+            if str(lookup_id) in self.attack_lookup_table:
+                self.attack_lookup_table[str(lookup_id)]["reflected"].add((current_url, location))
+                return
+        logging.warning("Could not find lookup_id %s, perhaps from an older attack session?" % lookup_id)
 
     # Surprisingly tricky to get the string/int types right for numeric ids...
+    # Returns a copy, other browsers may still add reflections
     def get_table_entry(self, lookup_id):
-        if lookup_id in self.attack_lookup_table:
-            return self.attack_lookup_table[lookup_id]
-        if str(lookup_id) in self.attack_lookup_table:
-            return self.attack_lookup_table[str(lookup_id)]
+        with self.attack_table_lock:
+            entry = self.attack_lookup_table.get(lookup_id, self.attack_lookup_table.get(str(lookup_id)))
+            if entry:
+                return {"injected": entry["injected"], "reflected": set(entry["reflected"])}
 
         logging.warning("Could not find lookup_id %s " % lookup_id)
         return None
@@ -1400,7 +2122,7 @@ class Crawler:
                     if "#" in edge_in_path.n2.value.url and not "#####" in edge_in_path.n2.value.url:
                         driver.get("http://localhost")
                     driver.get(edge_in_path.n2.value.url)
-                    self.inspect_attack(edge_in_path)
+                    self.inspect_attack(driver, edge_in_path)
                 else:
                     logging.warning("Not allowed to get: " + str(edge_in_path.n2.value.url))
                     return False
@@ -1408,7 +2130,7 @@ class Crawler:
                 form = method_data
                 try:
                     fill_result = form_fill(driver, form)
-                    self.inspect_attack(edge_in_path)
+                    self.inspect_attack(driver, edge_in_path)
                     if not fill_result:
                         logging.warning("Failed to fill form:" + str(form))
                         return False
@@ -1421,14 +2143,14 @@ class Crawler:
                 event = method_data
                 execute_event(driver, event)
                 remove_alerts(driver)
-                self.inspect_attack(edge_in_path)
+                self.inspect_attack(driver, edge_in_path)
             elif method == "iframe":
                 logging.info("iframe, do find_state")
                 if not find_state(driver, graph, edge_in_path, False):
                     logging.warning("Could not enter iframe" + str(edge_in_path))
                     return False
 
-                self.inspect_attack(edge_in_path)
+                self.inspect_attack(driver, edge_in_path)
             elif method == "javascript":
                 js_code = edge_in_path.n2.value.url
                 if "#####" in js_code:
@@ -1510,7 +2232,7 @@ class Crawler:
                 else:
                     try:
                         driver.execute_script(js_code)
-                        self.inspect_attack(edge_in_path)
+                        self.inspect_attack(driver, edge_in_path)
                     except Exception as e:
                         print(bcolors.OKGREEN+str(e).splitlines()[0]+bcolors.ENDC)
                         
@@ -1527,9 +2249,9 @@ class Crawler:
         self.io_graph[tracker] = {"injected": vector_with_payload,
                                   "reflected": set()}
 
-    def inspect_tracker(self, vector_edge):
+    def inspect_tracker(self, driver, vector_edge):
         try:
-            body_text = get_element_text(self.driver, self.driver.find_element(By.TAG_NAME, "body"))
+            body_text = get_element_text(driver, driver.find_element(By.TAG_NAME, "body"))
 
             for tracker in self.io_graph:
                 if tracker in body_text:
@@ -1540,7 +2262,7 @@ class Crawler:
                     prev_edge = self.io_graph[tracker]['injected'][0]
                     attackable = prev_edge.value.method_data.attackable()
                     if attackable:
-                        self.path_attack_form(self.driver, prev_edge, vector_edge)
+                        self.path_attack_form(driver, prev_edge, vector_edge)
         except Exception as e:
             print(bcolors.OKGREEN+"Failed to find tracker in body_text"+bcolors.ENDC)
             logging.error("Failed to find tracker in body_text")
@@ -1569,7 +2291,7 @@ class Crawler:
             self.execute_path(driver, path)
 
             # Inspect
-            self.inspect_tracker(vector_edge)
+            self.inspect_tracker(driver, vector_edge)
         except Exception as e:
             print(bcolors.OKGREEN+"PROBLEM TRACKING FORM: "+str(vector_edge)+bcolors.ENDC)
             logging.error("Can't track form " + str(vector_edge) + " " + str(e).splitlines()[0])
@@ -1582,7 +2304,7 @@ class Crawler:
         successful_xss = set()
 
         graph = self.graph
-        path = rec_find_path(graph, vector_edge)
+        path = self.detach_forms(rec_find_path(graph, vector_edge))
         self.execute_path(driver, path)
 
         logging.info("PATH LENGTH: " + str(len(path)))
@@ -1605,7 +2327,7 @@ class Crawler:
                 logging.info("check_edge defined from tracker " + str(check_edge))
                 follow_edge(driver, graph, check_edge)
             # Inspect
-            inspect_result = self.inspect_attack(vector_edge)
+            inspect_result = self.inspect_attack(driver, vector_edge)
             if inspect_result:
                 successful_xss = successful_xss.union(inspect_result)
                 for lookup_id in lookup_ids:
@@ -1626,7 +2348,7 @@ class Crawler:
                 logging.info("check_edge defined from tracker " + str(check_edge))
                 follow_edge(driver, graph, check_edge)
             # Inspect
-            inspect_result = self.inspect_attack(vector_edge)
+            inspect_result = self.inspect_attack(driver, vector_edge)
             if inspect_result:
                 successful_xss = successful_xss.union(inspect_result)
                 for lookup_id in lookup_ids:
@@ -1636,6 +2358,18 @@ class Crawler:
 
         return successful_xss
 
+    # Copies the form edges of a path so the payloads armed by fix_form don't
+    # end up in the graph, other attack browsers may use the same forms
+    def detach_forms(self, path):
+        detached = []
+        for edge in path:
+            if edge.value.method == "form":
+                edge = copy.copy(edge)
+                edge.value = copy.copy(edge.value)
+                edge.value.method_data = copy.deepcopy(edge.value.method_data)
+            detached.append(edge)
+        return detached
+
     def attack_ui_form(self, driver, vector_edge):
 
         successful_xss = set()
@@ -1663,7 +2397,7 @@ class Crawler:
                 logging.error("Can't attack event " + str(ui_form) + " " + str(e).splitlines()[0])
 
             # Inspect
-            inspect_result = self.inspect_attack(vector_edge)
+            inspect_result = self.inspect_attack(driver, vector_edge)
             if inspect_result:
                 successful_xss = successful_xss.union(inspect_result)
                 if lookup_id in inspect_result:
@@ -1672,6 +2406,124 @@ class Crawler:
 
         return successful_xss
 
+    # Extra browsers for the attack phase, each logged in on its own
+    # Extra browsers next to self.driver, logged in like it
+    def open_browsers(self, count, kind):
+        drivers = []
+        if not self.driver_factory:
+            return drivers
+        for i in range(count - 1):
+            try:
+                driver = self.driver_factory()
+                configure_capture(driver, self.url)
+            except Exception as e:
+                print(bcolors.OKGREEN+"PROBLEM OPENING "+kind.upper()+" BROWSER"+bcolors.ENDC)
+                logging.error("Can't open " + kind + " browser " + str(e).splitlines()[0])
+                break
+            driver.login_generation = self.login_generation
+            self.login_browser(driver)
+            drivers.append(driver)
+        logging.info("Using " + str(len(drivers) + 1) + " " + kind + " browsers")
+        return drivers
+
+    def login_browser(self, driver):
+        try:
+            driver.get(self.login_url or self.url)
+            wait_for_settle(driver, "login browser")
+            if find_login_form(driver, self.graph):
+                self.retry_login(driver, self.graph)
+            else:
+                # No login page seen while crawling, reuse the crawler's session
+                for cookie in self.driver.get_cookies():
+                    try:
+                        driver.add_cookie(cookie)
+                    except Exception as e:
+                        logging.warning("Can't copy cookie " + str(e).splitlines()[0])
+        except Exception as e:
+            logging.error("Can't login browser " + str(e).splitlines()[0])
+
+    def close_browsers(self, drivers):
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logging.warning("Can't close browser " + str(e).splitlines()[0])
+
+    # Extra browsers crawling next to the main loop of start()
+    def start_crawl_workers(self):
+        self.crawl_stop.clear()
+        drivers = self.open_browsers(self.crawl_browsers, "crawl")
+        if not drivers:
+            return
+        executor = ThreadPoolExecutor(max_workers=len(drivers))
+        for driver in drivers:
+            executor.submit(self.crawl_worker, driver)
+        self.crawl_workers = (executor, drivers)
+
+    def stop_crawl_workers(self):
+        self.crawl_stop.set()
+        if not self.crawl_workers:
+            return
+        (executor, drivers) = self.crawl_workers
+        executor.shutdown(wait=True)
+        self.close_browsers(drivers)
+        self.crawl_workers = None
+
+    def crawl_worker(self, driver):
+        still_work = True
+        while still_work and not self.crawl_stop.is_set():
+            try:
+                still_work = asyncio.run(self.rec_crawl(driver))
+            except Exception as e:
+                print(bcolors.OKGREEN+str(e).splitlines()[0]+bcolors.ENDC)
+                print(bcolors.OKGREEN + "Top level error in crawl worker" + bcolors.ENDC)
+                logging.error(str(e).splitlines()[0])
+                logging.error("Top level error in crawl worker")
+
+    # Only one worker follows an edge at a time
+    def claim_edge(self, edge):
+        with self.graph.lock:
+            if edge.visited or id(edge) in self.crawling_edges:
+                return False
+            self.crawling_edges.add(id(edge))
+            return True
+
+    def release_edge(self, edge):
+        with self.graph.lock:
+            self.crawling_edges.discard(id(edge))
+
+    # Runs attack_function(driver, vector) for every vector, each browser
+    # attacks one vector at a time. Returns (vector, result) in completion order.
+    def attack_in_parallel(self, drivers, kind, vectors, attack_function, start_time):
+        free_drivers = Queue()
+        for driver in drivers:
+            free_drivers.put(driver)
+
+        def attack_vector(vector):
+            if time.time() - start_time > self.max_reply_time:
+                logging.info("Max reply time reached, skipping " + str(vector))
+                return False, None
+            driver = free_drivers.get()
+            try:
+                return True, attack_function(driver, vector)
+            finally:
+                free_drivers.put(driver)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=len(drivers)) as executor:
+            futures = {executor.submit(attack_vector, vector): vector for vector in vectors}
+            for done, future in enumerate(as_completed(futures), 1):
+                vector = futures[future]
+                print(bcolors.OKGREEN+"Progress ("+kind+"): "+str(done)+"/"+str(len(vectors))+bcolors.ENDC)
+                try:
+                    (attacked, result) = future.result()
+                    if attacked:
+                        results.append((vector, result))
+                except Exception as e:
+                    print(bcolors.OKGREEN+"PROBLEM ATTACKING "+kind.upper()+bcolors.ENDC)
+                    logging.error("Can't attack " + kind + " " + str(e).splitlines()[0])
+        return results
+
     def attack(self):
         driver = self.driver
         successful_xss = set()
@@ -1680,81 +2532,47 @@ class Crawler:
 
         start_time = time.time()
 
+        attack_drivers = [driver] + self.open_browsers(self.attack_browsers, "attack")
         try:
-            forms_to_attack = [(vector_type, vector) for (vector_type, vector) in vectors if vector_type == "form"]
-            form_c = 0
-            for (vector_type, vector) in forms_to_attack:
-                try:
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time > self.max_reply_time:
-                        logging.info("Max reply time reached, stopping")
-                        break
-                    print(bcolors.OKGREEN + "Progress (forms): " + str(form_c) + "/" + str(
-                        len(forms_to_attack)) + bcolors.ENDC)
-                    if vector_type == "form":
-                        form_xss = self.path_attack_form(driver, vector)
-                        if form_xss:
-                            # Save to file
-                            app_result_path = os.path.join(RESULT_DIR, self.app_name)
+            try:
+                forms_to_attack = [vector for (vector_type, vector) in vectors if vector_type == "form"]
+                for (vector, form_xss) in self.attack_in_parallel(attack_drivers, "form", forms_to_attack, self.path_attack_form, start_time):
+                    if form_xss:
+                        # Save to file
+                        app_result_path = os.path.join(RESULT_DIR, self.app_name)
+                        attack_table = self.attack_table_snapshot()
+                        with self.result_lock:
                             f = open(os.path.join(app_result_path, "form_xss.txt"), "a+")
                             for xss in form_xss:
-                                if xss in self.attack_lookup_table:
-                                    f.write(str(self.attack_lookup_table) + "\n")
+                                if xss in attack_table:
+                                    f.write(str(attack_table) + "\n")
+                            f.close()
 
-                            successful_xss = successful_xss.union(form_xss)
-                        else:
-                            logging.error("Failed to attack form " + str(vector))
-                    form_c += 1
-                except Exception as e:
-                    print(bcolors.OKGREEN + "PROBLEM ATTACKING FORM" + bcolors.ENDC)
-                    logging.error("Can't attack form " + str(e).splitlines()[0])
-        except Exception as e:
-            print(bcolors.OKGREEN + "PROBLEM ATTACKING FORMS" + bcolors.ENDC)
-            logging.error("Can't attack forms " + str(e).splitlines()[0])
+                        successful_xss = successful_xss.union(form_xss)
+                    else:
+                        logging.error("Failed to attack form " + str(vector))
+            except Exception as e:
+                print(bcolors.OKGREEN + "PROBLEM ATTACKING FORMS" + bcolors.ENDC)
+                logging.error("Can't attack forms " + str(e).splitlines()[0])
 
-        try:
-            # Try to attack vectors
-            events_to_attack = [(vector_type, vector) for (vector_type, vector) in vectors if vector_type == "event"]
-            event_c = 0
-            for (vector_type, vector) in events_to_attack:
-                try:
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time > self.max_reply_time:
-                        logging.info("Max reply time reached, stopping")
-                        break
-                    print(bcolors.OKGREEN+"Progress (events): "+str(event_c)+"/"+str(len(events_to_attack))+bcolors.ENDC)
-                    if vector_type == "event":
-                        event_xss = self.attack_event(driver, vector)
-                        successful_xss = successful_xss.union(event_xss)
-                    event_c += 1
-                except Exception as e:
-                    print(bcolors.OKGREEN+"PROBLEM ATTACKING EVENT"+bcolors.ENDC)
-                    logging.error("Can't attack event " + str(e).splitlines()[0])
-        except Exception as e:
-            print(bcolors.OKGREEN+"PROBLEM ATTACKING EVENTS"+bcolors.ENDC)
-            logging.error("Can't attack events " + str(e).splitlines()[0])
+            try:
+                # Try to attack vectors
+                events_to_attack = [vector for (vector_type, vector) in vectors if vector_type == "event"]
+                for (vector, event_xss) in self.attack_in_parallel(attack_drivers, "event", events_to_attack, self.attack_event, start_time):
+                    successful_xss = successful_xss.union(event_xss)
+            except Exception as e:
+                print(bcolors.OKGREEN+"PROBLEM ATTACKING EVENTS"+bcolors.ENDC)
+                logging.error("Can't attack events " + str(e).splitlines()[0])
 
-        try:
-            gets_to_attack = [(vector_type, vector) for (vector_type, vector) in vectors if vector_type == "get"]
-            get_c = 0
-            for (vector_type, vector) in gets_to_attack:
-                try:
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time > self.max_reply_time:
-                        logging.info("Max reply time reached, stopping")
-                        break
-                    print(bcolors.OKGREEN+"Progress (get): "+str(get_c)+"/"+str(len(gets_to_attack))+bcolors.ENDC)
-                    logging.info("Progress (get): " + str(get_c) + "/" + str(len(gets_to_attack)))
-                    if vector_type == "get":
-                        get_xss = self.attack_get(driver, vector)
-                        successful_xss = successful_xss.union(get_xss)
-                    get_c += 1
-                except Exception as e:
-                    print(bcolors.OKGREEN+"PROBLEM ATTACKING GET"+bcolors.ENDC)
-                    logging.error("Can't attack get " + str(e).splitlines()[0])
-        except Exception as e:
-            print(bcolors.OKGREEN+"PROBLEM ATTACKING GETS"+bcolors.ENDC)
-            logging.error("Can't attack gets " + str(e).splitlines()[0])
+            try:
+                gets_to_attack = [vector for (vector_type, vector) in vectors if vector_type == "get"]
+                for (vector, get_xss) in self.attack_in_parallel(attack_drivers, "get", gets_to_attack, self.attack_get, start_time):
+                    successful_xss = successful_xss.union(get_xss)
+            except Exception as e:
+                print(bcolors.OKGREEN+"PROBLEM ATTACKING GETS"+bcolors.ENDC)
+                logging.error("Can't attack gets " + str(e).splitlines()[0])
+        finally:
+            self.close_browsers(attack_drivers[1:])
 
         try:
             # Quickly check for stored.
@@ -2039,7 +2857,7 @@ class Crawler:
                     driver.get(url)
 
                     # Inspect
-                    successful_xss = successful_xss.union(self.inspect_attack(url))
+                    successful_xss = successful_xss.union(self.inspect_attack(driver, url))
             except Exception as e:
                 logging.error("Can't attack get " + str(e).splitlines()[0])
 
@@ -2055,6 +2873,9 @@ class Crawler:
         while not self.analysis_queue.empty() and batch_size > 0:
             analysis_wrapper = self.analysis_queue.get()
             batch_size -= 1
+            if analysis_wrapper.get("type") == "resource_dependency":
+                self.apply_resource_dependencies(analysis_wrapper)
+                continue
             req_index = analysis_wrapper['req_index']
             req = graph.nodes[req_index]
             analysis = analysis_wrapper['analysis']
@@ -2089,7 +2910,9 @@ class Crawler:
     def exec_list_to_use(self, list_to_use, driver, graph):
         logging.warning("Trying to exec list_to_use")
         for edge in list_to_use:
-            if not edge.visited:
+            if not self.claim_edge(edge):
+                continue
+            try:
                 if not check_edge(driver, graph, edge):
                     logging.warning("Check_edge failed for " + str(edge))
                     graph.visit_edge(edge)
@@ -2099,37 +2922,29 @@ class Crawler:
                     if successful:
                         print(bcolors.OKGREEN+"Successful exec edge "+str(edge.value)+bcolors.ENDC)
                         logging.info("Successful exec edge "+str(edge.value))
+                        # Taken, before other workers can claim it again
+                        graph.visit_edge(edge)
                         return edge
+            finally:
+                self.release_edge(edge)
         return None
 
-    def is_similar(self, prompt, threshold=0.95):
-        if not self.event_prompt_cache:
-            return None
-
-        prompts = self.event_prompt_cache
-        vectorizer = TfidfVectorizer().fit_transform([prompt] + prompts)
-        similarity_matrix = cosine_similarity(vectorizer[0:1], vectorizer[1:])
-
-        max_sim_idx = similarity_matrix.argmax()
-        max_sim_value = similarity_matrix[0, max_sim_idx]
-
-        if max_sim_value >= threshold:
-            return True
-        return False
-
     # Handle priority
     async def next_unvisited_edge(self, driver, graph):
-        user_url = open("queue.txt", "r").read()
+        # URLs from the user only go to the main browser
+        user_url = open("queue.txt", "r").read() if driver is self.driver else ""
         if user_url:
             print("User supplied url: ", user_url)
             logging.info("Adding user from URLs " + user_url)
 
             req = Request(user_url, "get")
             current_cookies = driver.get_cookies()
-            new_edge, exist = graph.create_edge(self.root_req, req, CrawlEdge(req.method, user_url, None, current_cookies),
-                                         graph.data['prev_edge'])
-            graph.add(req)
-            graph.connect(self.root_req, req, CrawlEdge(req.method, user_url, None, current_cookies), graph.data['prev_edge'])
+            prev_edge = getattr(driver, "prev_edge", None)
+            with graph.lock:
+                new_edge, exist = graph.create_edge(self.root_req, req, CrawlEdge(req.method, user_url, None, current_cookies),
+                                             prev_edge)
+                graph.add(req)
+                graph.connect(self.root_req, req, CrawlEdge(req.method, user_url, None, current_cookies), prev_edge)
 
             print(new_edge)
 
@@ -2142,10 +2957,8 @@ class Crawler:
             else:
                 logging.error("Could not load URL from user " + str(new_edge))
 
-        while True:
-            self.receive_analysis(graph)
-
-            edge_index = self.scheduler.pick_and_run()
+        while not self.crawl_stop.is_set():
+            list_to_use = self.candidate_edges(driver, graph)
 
             elapsed_time = time.time() - self.start_time
 
@@ -2154,67 +2967,138 @@ class Crawler:
                 logging.info("Max crawl time reached")
                 break
 
-            list_to_use = []
-            if edge_index >= 0:
-                list_to_use.append(graph.edges[edge_index])
-            else:
-                for edge_index, edge in enumerate(graph.edges):
-                    if edge_index not in self.received_requests and not self.analysis_queue.empty():
-                        continue
-                    if not edge.visited and not edge.value.after_resource_operation and not edge.value.after_context:
-                        if not graph.is_blocking(edge):
-                            list_to_use.append(edge)
-
             edge = self.exec_list_to_use(list_to_use, driver, graph)
             if edge:
                 return edge
+            if self.crawl_workers or self.coordinator:
+                # Wait for the other workers to find something
+                time.sleep(0.5)
 
         return None
 
+    # URLs compared while a parameter was classified used the provisional
+    # answer, nodes it kept apart are merged again
+    def receive_semantic_verdicts(self, graph):
+        while not semantic_verdicts.empty():
+            (url_template, param_name, important, keys) = semantic_verdicts.get()
+            if important == semantic_param_default:
+                continue
+            if important:
+                logging.info("Parameter " + param_name + " of " + url_template + " matters, URLs merged before stay merged")
+                continue
+            merged = sum(graph.remerge_nodes(("get", key)) for key in keys)
+            print(bcolors.OKGREEN+"Parameter "+param_name+" of "+url_template+" does not matter, skipping "+str(merged)+" edges"+bcolors.ENDC)
+            logging.info("Parameter " + param_name + " of " + url_template + " does not matter, skipping " + str(merged) + " edges")
+
+    # The edge picked by the scheduler, or all unvisited edges left. driver
+    # is the browser that will follow them, None for a remote worker.
+    def candidate_edges(self, driver, graph):
+        with graph.lock:
+            self.receive_analysis(graph)
+            self.receive_after_analysis(graph)
+            self.receive_semantic_verdicts(graph)
+
+            # Prefer edges continuing from where the browser already is
+            edge_index = self.scheduler.pick_and_run(lambda index: self.edge_overlap(driver, graph, index))
+
+        list_to_use = []
+        if edge_index >= 0:
+            list_to_use.append(graph.edges[edge_index])
+        else:
+            candidates = []
+            for edge_index, edge in graph.unvisited_edges():
+                if edge_index not in self.received_requests and not self.analysis_queue.empty():
+                    continue
+                if not edge.visited and not edge.value.after_resource_operation and not edge.value.after_context:
+                    if not graph.is_blocking(edge):
+                        candidates.append((edge_index, edge))
+            # Consecutive edges share the longest prefix, the replay skips it
+            if getattr(driver, "replay_position", None):
+                candidates.sort(key=lambda candidate: self.edge_overlap(driver, graph, candidate[0]), reverse=True)
+            # Visited edges are not asked for again
+            self.replay_paths = {index: self.replay_paths[index] for (index, edge) in candidates if index in self.replay_paths}
+            list_to_use = [edge for (edge_index, edge) in candidates]
+        return list_to_use
+
+    # Positions of the edges of rec_find_path of the edge at edge_index. The
+    # parents of an edge never change, and positions don't keep edges alive.
+    def replay_path(self, graph, edge_index):
+        path = self.replay_paths.get(edge_index)
+        if path is None:
+            path = [graph.edge_position(edge) for edge in rec_find_path(graph, graph.edges[edge_index])]
+            self.replay_paths[edge_index] = path
+        return path
+
+    # Steps of the path to the edge at edge_index the browser went through
+    def edge_overlap(self, driver, graph, edge_index):
+        position = getattr(driver, "replay_position", None)
+        if not position:
+            return 0
+        return replay_overlap(self.replay_path(graph, edge_index), [graph.edge_position(edge) for edge in position[0]])
+
     async def load_page(self, driver, graph):
-        request = None
         edge = await self.next_unvisited_edge(driver, graph)
         if not edge:
             return None
+        return self.record_page(driver, graph, edge, driver.current_url)
 
-        # Update last visited edge
-        graph.data['prev_edge'] = edge
+    # Bookkeeping once edge was followed and the browser ended up on
+    # current_url, driver is None for a remote worker
+    def record_page(self, driver, graph, edge, current_url):
+        # Update last visited edge of this browser
+        if driver is not None:
+            driver.prev_edge = edge
 
         request = edge.n2.value
         req = request
         new_edge = edge
 
-        current_url = driver.current_url
         if current_url:
             current_url = current_url.rstrip('/')
         if request.url:
-            request.url = request.url.rstrip('/')
+            graph.set_url(request, request.url.rstrip('/'))
         if current_url != request.url:
             req = Request(current_url, request.method)
             logging.info("Changed url: " + current_url)
-            new_edge, exist = graph.create_edge(edge.n1.value, req, CrawlEdge(edge.value.method, edge.value.method_data, edge.value.before_resource_operation, edge.value.cookies), edge.parent)
-            if not exist and allow_edge(graph, new_edge):
-                graph.add(req)
-                graph.connect(edge.n1.value, req, CrawlEdge(edge.value.method, edge.value.method_data, edge.value.before_resource_operation, edge.value.cookies, edge.value.after_resource_operation), edge.parent)
-                logging.info("New Crawl (edge): " + str(new_edge))
-                print(bcolors.OKGREEN+"New Crawl (edge): " + str(new_edge)+bcolors.ENDC)
-                graph.visit_node(request)
-                graph.visit_edge(edge)
-            else:
-                logging.info("Not allowed to add edge: %s" % new_edge)
-                new_edge = edge
-                req = request
-                graph.visit_node(request)
-                graph.visit_edge(edge)
+            with graph.lock:
+                new_edge, exist = graph.create_edge(edge.n1.value, req, CrawlEdge(edge.value.method, edge.value.method_data, edge.value.before_resource_operation, edge.value.cookies), edge.parent)
+                if not exist and allow_edge(graph, new_edge):
+                    graph.add(req)
+                    graph.connect(edge.n1.value, req, CrawlEdge(edge.value.method, edge.value.method_data, edge.value.before_resource_operation, edge.value.cookies, edge.value.after_resource_operation), edge.parent)
+                    logging.info("New Crawl (edge): " + str(new_edge))
+                    print(bcolors.OKGREEN+"New Crawl (edge): " + str(new_edge)+bcolors.ENDC)
+                    graph.visit_node(request)
+                    graph.visit_edge(edge)
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
+                    new_edge = edge
+                    req = request
+                    graph.visit_node(request)
+                    graph.visit_edge(edge)
         else:
             logging.info("Current url: " + current_url)
             logging.info("Crawl (edge): " + str(edge))
             print(bcolors.OKGREEN+"Crawl (edge): " + str(edge)+bcolors.ENDC)
 
+        self.submit_after_analysis(graph, edge)
+
+        return new_edge, req
+
+    # Analysed in the background, the result is applied by receive_after_analysis
+    def submit_after_analysis(self, graph, edge):
+        (after_prompt, page_state) = self.after_request_prompt(edge)
+        purpose = os.getenv("PURPOSE", "")
+        future = self.after_analysis_executor.submit(self.identify_resource_operation_after_request, purpose, after_prompt, page_state)
+        with graph.lock:
+            self.pending_after_analysis.append((future, edge))
+
+    # Prompt and page state of the after request analysis of a followed edge
+    def after_request_prompt(self, edge):
         after_prompt = f""""I have used the below prompt to ask you to identify the resource operation before the request action executed. \n {edge.value.before_prompt}\n Your answer is {edge.value.before_resource_operation}\n"""
         after_prompt += f"""Now, I will provide you more details of the request action that is executed.
         Below are the details of the request action that is executed."""
-        if edge.value.get_before_context() != edge.value.get_after_context():
+        # Equal digests mean equal markdown, no need to load it for the check
+        if edge.value.before_context != edge.value.after_context:
             after_prompt += f"""Before the request action is executed, the page state is presented in Markdown format as follows: [{edge.value.get_before_context()}].
             After the request action is executed, the page state is presented in Markdown format as follows: [{edge.value.get_after_context()}].
             """
@@ -2247,18 +3131,32 @@ class Crawler:
             logging.warning("Prompt too long: " + str(length) + " " + str(len(after_prompt)))
             after_prompt = after_prompt[:MAX_CONTEXT_LENGTH]
 
-        purpose = os.getenv("PURPOSE", "")
+        return after_prompt, page_state
+
+    def identify_resource_operation_after_request(self, purpose, after_prompt, page_state):
         start = time.time()
         formatted_start = datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
         print(bcolors.OKGREEN+"start identify_resource_operation_after_request "+str(formatted_start)+bcolors.ENDC)
         resource_operation = self.llm_manager.identify_resource_operation_after_request(purpose, after_prompt, page_state)
-        compensation_time = time.time() - start
-        average_llm_time = int(os.getenv("AVERAGE_LLM_TIME", 5))
-        if compensation_time > average_llm_time:
-            self.max_crawl_time += compensation_time-average_llm_time
-            self.max_crawl_time = min(self.max_crawl_time, 2 * float(os.getenv("MAX_CRAWL_TIME", 60 * 60 * 3)))
-            print(bcolors.OKGREEN+"max_crawl_time "+str(self.max_crawl_time)+" compensation_time "+str(compensation_time)+bcolors.ENDC)
         print(bcolors.OKGREEN+"end identify_resource_operation_after_request "+str(time.time()-start)+bcolors.ENDC)
+        return resource_operation
+
+    # Apply finished after request analyses, or all of them when wait is set
+    def receive_after_analysis(self, graph, wait=False):
+        pending = []
+        for future, edge in self.pending_after_analysis:
+            if not wait and not future.done():
+                pending.append((future, edge))
+                continue
+            try:
+                resource_operation = future.result()
+            except Exception as e:
+                logging.error("After request analysis failed " + str(e).splitlines()[0])
+                resource_operation = {}
+            self.apply_after_analysis(graph, edge, resource_operation)
+        self.pending_after_analysis = pending
+
+    def apply_after_analysis(self, graph, edge, resource_operation):
         edge.value.after_resource_operation = resource_operation
         exec_success = False
         if 'success' in resource_operation:
@@ -2284,15 +3182,18 @@ class Crawler:
         if resource_operation != {}:
             self.scheduler.feedback(Node(edge.value.method, resource_operation.get('resource', "unknown"), resource_operation.get('CRUD_type', "unknown"), resource_operation.get('operation', "unknown"), -1), exec_success)
 
-        return new_edge, req
-
     # Actually not recursive (TODO change name)
-    async def rec_crawl(self):
-        driver = self.driver
+    async def rec_crawl(self, driver=None):
+        driver = driver or self.driver
         graph = self.graph
         llm_manager = self.llm_manager
         tokenizer = self.tokenizer
 
+        # Another browser logged in since this one did
+        if driver.login_generation < self.login_generation:
+            driver.login_generation = self.login_generation
+            self.login_browser(driver)
+
         todo = await self.load_page(driver, graph)
         if not todo:
             print(bcolors.OKGREEN+"Done crawling"+bcolors.ENDC)
@@ -2305,37 +3206,87 @@ class Crawler:
             return False
 
         (edge, request) = todo
+        self.visit_page(graph, edge, request)
+        findings = self.extract_findings(driver, graph, edge, request)
+        if self.merge_findings(graph, edge, request, findings):
+            driver.login_generation = self.login_generation
+
+        # Try to clean up alerts
+        try:
+            alert = driver.switch_to.alert
+            alert.dismiss()
+        except NoAlertPresentException:
+            pass
+
+        if driver is self.driver and "3" in open("run.flag", "r").read():
+            logging.info("Run set to 3, pause each step")
+            input("Crawler in stepping mode, press enter to continue. EDIT run.flag to run")
+
+        # Check command
+        found_command = False
+        if "get_graph" in open("command.txt", "r").read():
+            app_result_path = os.path.join(RESULT_DIR, self.app_name)
+            f = open(os.path.join(app_result_path, "graph.txt"), "w+")
+            f.write(str(self.graph))
+            f.close()
+            found_command = True
+        # Clear command
+        if found_command:
+            open("command.txt", "w+").write("")
+
+        return True
+
+    # What a remote worker sent back for edge, see distributed.CrawlWorker
+    def apply_remote_result(self, edge, result):
+        graph = self.graph
+        for (name, value) in result["values"].items():
+            if value:
+                getattr(edge.value, "set_" + name)(value)
+        if not result["followed"]:
+            if result["failed"]:
+                graph.add_failed(edge)
+            if result["visited"]:
+                graph.visit_edge(edge)
+            return
+
+        print(bcolors.OKGREEN+"Successful remote exec edge "+str(edge.value)+bcolors.ENDC)
+        graph.visit_edge(edge)
+        (edge, request) = self.record_page(None, graph, edge, result["current_url"])
+        self.visit_page(graph, edge, request)
+        if result["findings"]:
+            self.merge_findings(graph, edge, request, result["findings"])
+
+    def visit_page(self, graph, edge, request):
         graph.visit_node(request)
         graph.visit_edge(edge)
 
         # (almost) Never GET twice (optimization)
         if edge.value.method == "get":
-            for e in graph.edges:
+            for e in graph.get_edges_to(edge.n2.value):
                 if (edge.n2 == e.n2) and (edge != e) and (e.value.method == "get"):
                     #print("Fake visit", e)
                     graph.visit_edge(e)
 
-        # Wait if needed
+    # Everything the page reached by edge offers, read from the browser. Only
+    # touches the graph to find the replay path, so remote workers run it on
+    # a copy of the path.
+    def extract_findings(self, driver, graph, edge, request):
+        llm_manager = self.llm_manager
+        tokenizer = self.tokenizer
+
+        # Wait for asynch requests, DOM updates and short timers
+        wait_for_settle(driver, "need_to_wait")
         try:
-            wait_json = driver.execute_script("return JSON.stringify(need_to_wait)")
-            wait = json.loads(wait_json)
-            if wait:
-                time.sleep(1)
-        except UnexpectedAlertPresentException:
-            logging.warning("Alert detected")
             alert = driver.switch_to.alert
+            logging.warning("Alert detected")
             alert.dismiss()
 
             # Check if double check is needed...
-            try:
-                wait_json = driver.execute_script("return JSON.stringify(need_to_wait)")
-                wait = json.loads(wait_json)
-                if wait:
-                    time.sleep(1)
-            except Exception as e:
-                logging.warning("Inner wait error for need_to_wait " + str(e).splitlines()[0])
+            wait_for_settle(driver, "need_to_wait")
+        except NoAlertPresentException:
+            pass
         except Exception as e:
-            logging.warning("No need_to_wait " + str(e).splitlines()[0])
+            logging.warning("Inner wait error for need_to_wait " + str(e).splitlines()[0])
 
         # Timeouts
         try:
@@ -2351,8 +3302,11 @@ class Crawler:
             logging.warning("No timeouts from stringify " + str(e).splitlines()[0])
 
         # Extract urls, forms, elements, iframe etc
-        reqs, url_contexts = extract_urls(driver)
-        forms, form_contexts = extract_forms(driver)
+        analysis = analyze_page(driver)
+        set_replay_position(driver, rec_find_path(graph, edge), analysis.version)
+        save_browser_state(driver, request, analysis.fingerprint)
+        reqs, url_contexts = analysis.extract(extract_urls)
+        forms, form_contexts = analysis.extract(extract_forms)
         for form in forms:
             form_context = form_contexts[form]
             new_forms = set_form_values(driver, [form], llm_manager, tokenizer, False, form_context)
@@ -2363,24 +3317,58 @@ class Crawler:
                 form_contexts[new_forms_list[0]] = form_context
 
         # forms = set_form_values(forms, llm_manager)
-        ui_forms, ui_form_contexts = extract_ui_forms(driver)
-        events, event_contexts = extract_events(driver)
-        iframes, iframe_contexts = extract_iframes(driver)
+        ui_forms, ui_form_contexts = analysis.extract(extract_ui_forms)
+        events, event_contexts = analysis.extract(extract_events)
+        iframes, iframe_contexts = analysis.extract(extract_iframes)
 
         # Check if we need to wait for asynch
+        wait_for_settle(driver, "after extraction")
         try:
-            wait_json = driver.execute_script("return JSON.stringify(need_to_wait)")
-        except UnexpectedAlertPresentException:
-            logging.warning("Alert detected")
             alert = driver.switch_to.alert
+            logging.warning("Alert detected")
             alert.dismiss()
-        wait_json = driver.execute_script("return JSON.stringify(need_to_wait)")
-        wait = json.loads(wait_json)
-        if wait:
-            time.sleep(1)
+        except NoAlertPresentException:
+            pass
 
-        # Add findings to the graph
         current_cookies = driver.get_cookies() #bear
+        current_url = driver.current_url
+
+        early_state = self.early_gets < self.max_early_gets
+        login_form = find_login_form(driver, graph, early_state)
+
+        login = None
+        if login_form:
+            logging.info("Found login form")
+            print(bcolors.OKGREEN+"We want to test edge: "+str(edge)+bcolors.ENDC)
+            new_form = set_form_values(driver, {login_form}, llm_manager, tokenizer, True).pop()
+            try:
+                print(bcolors.OKGREEN+"Logging in"+bcolors.ENDC)
+                logging.warning("Logging in")
+                form_fill(driver, new_form)
+                wait_for_settle(driver, "login")
+                login = {"cookies": driver.get_cookies(), "current_url": driver.current_url}
+            except Exception as e:
+                logging.warning("Failed to login to potential login form " + str(e).splitlines()[0])
+
+        return {"url_contexts": url_contexts,
+                "form_contexts": form_contexts,
+                "ui_form_contexts": ui_form_contexts,
+                "event_contexts": event_contexts,
+                "iframe_contexts": iframe_contexts,
+                "cookies": current_cookies,
+                "current_url": current_url,
+                "login": login}
+
+    # Adds what extract_findings found to the graph, True after a login
+    def merge_findings(self, graph, edge, request, findings):
+        url_contexts = findings["url_contexts"]
+        form_contexts = findings["form_contexts"]
+        ui_form_contexts = findings["ui_form_contexts"]
+        event_contexts = findings["event_contexts"]
+        iframe_contexts = findings["iframe_contexts"]
+
+        # Add findings to the graph
+        current_cookies = findings["cookies"]
 
         logging.info("Adding requests from URLs")
 
@@ -2392,27 +3380,29 @@ class Crawler:
         for req in url_contexts:
             logging.info("from URLs %s " % str(req))
 
-            new_edge, exist = graph.create_edge(request, req, CrawlEdge(req.method, req.url, None, current_cookies), edge)
-            if not exist and allow_edge(graph, new_edge):
-
-                url_context = url_contexts[req]
-                dom_context = dom_context_format(url_context['dom_context'], self.tokenizer)
-                element_type = json.dumps(url_context['element_type'])
-                url = req.url
-                url_prompt = url_prompt_template.format(dom_context=dom_context, element_type=element_type, url=url)
-
-                _, req_index = graph.add(req)
-                connected = graph.connect(request, req, CrawlEdge(req.method, req.url, None, current_cookies), edge)
-                if not connected:
-                    logging.warning("Not connected "+str(new_edge))
-                    continue
-                (new_edge, edge_index) = connected
-                new_edge.value.before_prompt = url_prompt
-                request_wrapper = {"req_index": req_index, "prompt": url_prompt, "edge_index": edge_index}
-                self.request_queue.put(request_wrapper)
+            # Another browser may add the same edge in between
+            with graph.lock:
+                new_edge, exist = graph.create_edge(request, req, CrawlEdge(req.method, req.url, None, current_cookies), edge)
+                if not exist and allow_edge(graph, new_edge):
+
+                    url_context = url_contexts[req]
+                    dom_context = dom_context_format(url_context['dom_context'], self.tokenizer)
+                    element_type = json.dumps(url_context['element_type'])
+                    url = req.url
+                    url_prompt = url_prompt_template.format(dom_context=dom_context, element_type=element_type, url=url)
+
+                    _, req_index = graph.add(req)
+                    connected = graph.connect(request, req, CrawlEdge(req.method, req.url, None, current_cookies), edge)
+                    if not connected:
+                        logging.warning("Not connected "+str(new_edge))
+                        continue
+                    (new_edge, edge_index) = connected
+                    new_edge.value.before_prompt = url_prompt
+                    request_wrapper = {"req_index": req_index, "prompt": url_prompt, "edge_index": edge_index}
+                    self.request_queue.put(request_wrapper)
 
-            else:
-                logging.info("Not allowed to add edge: %s" % new_edge)
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
 
         logging.info("Adding requests from forms")
 
@@ -2426,28 +3416,29 @@ class Crawler:
             req = Request(form.action, form.method)
             logging.info("from forms %s " % str(req))
 
-            new_edge, exist = graph.create_edge(request, req, CrawlEdge("form", form, None, current_cookies), edge)
-            if not exist and allow_edge(graph, new_edge):
-
-                form_context = form_contexts[form]
-                dom_context = dom_context_format(form_context['dom_context'], self.tokenizer)
-                action_url = json.dumps(form_context['action_url'])
-                form_fields = str(form)
-                form_prompt = form_prompt_template.format(dom_context=dom_context, action_url=action_url,
-                                                          form_fileds=form_fields)
-
-                _, req_index = graph.add(req)
-                connected = graph.connect(request, req, CrawlEdge("form", form, None, current_cookies), edge)
-                if not connected:
-                    logging.warning("Not connected "+str(new_edge))
-                    continue
-                (new_edge, edge_index) = connected
-                new_edge.value.before_prompt = form_prompt
-                request_wrapper = {"req_index": req_index, "prompt": form_prompt, "edge_index": edge_index}
-                self.request_queue.put(request_wrapper)
+            with graph.lock:
+                new_edge, exist = graph.create_edge(request, req, CrawlEdge("form", form, None, current_cookies), edge)
+                if not exist and allow_edge(graph, new_edge):
+
+                    form_context = form_contexts[form]
+                    dom_context = dom_context_format(form_context['dom_context'], self.tokenizer)
+                    action_url = json.dumps(form_context['action_url'])
+                    form_fields = str(form)
+                    form_prompt = form_prompt_template.format(dom_context=dom_context, action_url=action_url,
+                                                              form_fileds=form_fields)
+
+                    _, req_index = graph.add(req)
+                    connected = graph.connect(request, req, CrawlEdge("form", form, None, current_cookies), edge)
+                    if not connected:
+                        logging.warning("Not connected "+str(new_edge))
+                        continue
+                    (new_edge, edge_index) = connected
+                    new_edge.value.before_prompt = form_prompt
+                    request_wrapper = {"req_index": req_index, "prompt": form_prompt, "edge_index": edge_index}
+                    self.request_queue.put(request_wrapper)
 
-            else:
-                logging.info("Not allowed to add edge: %s" % new_edge)
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
 
         logging.info("Adding requests from events")
 
@@ -2456,39 +3447,48 @@ class Crawler:
         including the DOM structure related to the event, the JavaScript event handler, and the corresponding action URL for the event.
         The details are as follows: (1) DOM: {dom_context}; (2) JavaScript Event: {js_event}; (3) Action URL: {url}.
         """
-        for event in event_contexts:
-            req = Request(request.url, "event")
-            logging.info("from events %s " % str(req))
-
-            new_edge, exist = graph.create_edge(request, req, CrawlEdge("event", event, None, current_cookies), edge)
-            if not exist and allow_edge(graph, new_edge):
-
-                event_context = event_contexts[event]
-                dom_context = dom_context_format(event_context['dom_context'], self.tokenizer)
-                js_event = json.dumps(event_context['event'])
-                url = json.dumps(event_context['url'])
-                event_prompt = event_prompt_template.format(dom_context=dom_context, js_event=js_event, url=url)
-                event_prompt_hash = hashlib.sha256(event_prompt.encode()).hexdigest()
-                if event_prompt_hash in self.event_prompt_hash_cache:
-                    logging.warning("Same event prompt")
-                    continue
-                self.event_prompt_hash_cache.append(event_prompt_hash)
-                if self.is_similar(event_prompt, float(os.getenv("EVENT_PROMPT_SIMILARITY_THRESHOLD", 0.95))):
+        with graph.lock:
+            new_events = []
+            for event in event_contexts:
+                req = Request(request.url, "event")
+                logging.info("from events %s " % str(req))
+
+                new_edge, exist = graph.create_edge(request, req, CrawlEdge("event", event, None, current_cookies), edge)
+                if not exist and allow_edge(graph, new_edge):
+
+                    event_context = event_contexts[event]
+                    dom_context = dom_context_format(event_context['dom_context'], self.tokenizer)
+                    js_event = json.dumps(event_context['event'])
+                    url = json.dumps(event_context['url'])
+                    event_prompt = event_prompt_template.format(dom_context=dom_context, js_event=js_event, url=url)
+                    event_prompt_hash = hashlib.sha256(event_prompt.encode()).hexdigest()
+                    if event_prompt_hash in self.event_prompt_hash_cache:
+                        logging.warning("Same event prompt")
+                        continue
+                    self.event_prompt_hash_cache.append(event_prompt_hash)
+                    new_events.append((event, req, event_prompt))
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
+
+            # Events of a page are compared with each other too, e.g. the rows of a table
+            similar_prompts = self.event_prompt_index.nearest_many([event_prompt for (event, req, event_prompt) in new_events],
+                                                                   float(os.getenv("EVENT_PROMPT_SIMILARITY_THRESHOLD", 0.95)),
+                                                                   batch=True)
+            for ((event, req, event_prompt), similar_prompt) in zip(new_events, similar_prompts):
+                if similar_prompt is not None:
                     logging.warning("Similar event_prompt")
                     continue
-                self.event_prompt_cache.append(event_prompt)
+                self.event_prompt_index.add(event_prompt)
 
                 _, req_index = graph.add(req)
                 connected = graph.connect(request, req, CrawlEdge("event", event, None, current_cookies), edge)
                 if not connected:
-                    logging.warning("Not connected "+str(new_edge))
+                    logging.warning("Not connected "+str(req))
                     continue
                 (new_edge, edge_index) = connected
                 new_edge.value.before_prompt = event_prompt
                 request_wrapper = {"req_index": req_index, "prompt": event_prompt, "edge_index": edge_index, "is_event": True}
                 self.request_queue.put(request_wrapper)
-            else:
-                logging.info("Not allowed to add edge: %s" % new_edge)
 
         logging.info("Adding requests from iframes")
 
@@ -2501,26 +3501,27 @@ class Crawler:
             req = Request(iframe.src, "iframe")
             logging.info("from iframes %s " % str(req))
 
-            new_edge, exist = graph.create_edge(request, req, CrawlEdge("iframe", iframe, None, current_cookies), edge)
-            if not exist and allow_edge(graph, new_edge):
-
-                iframe_context = iframe_contexts[iframe]
-                iframe_content = json.dumps(iframe_context['iframe_content'])
-                dom_context = dom_context_format(iframe_context['dom_context'], self.tokenizer)
-                url = json.dumps(iframe_context['url'])
-                iframe_prompt = iframe_prompt_template.format(iframe_content=iframe_content, dom_context=dom_context,
-                                                              url=url)
-                _, req_index = graph.add(req)
-                connected = graph.connect(request, req, CrawlEdge("iframe", iframe, None, current_cookies), edge)
-                if not connected:
-                    logging.warning("Not connected "+str(new_edge))
-                    continue
-                (new_edge, edge_index) = connected
-                new_edge.value.before_prompt = iframe_prompt
-                request_wrapper = {"req_index": req_index, "prompt": iframe_prompt, "edge_index": edge_index}
-                self.request_queue.put(request_wrapper)
-            else:
-                logging.info("Not allowed to add edge: %s" % new_edge)
+            with graph.lock:
+                new_edge, exist = graph.create_edge(request, req, CrawlEdge("iframe", iframe, None, current_cookies), edge)
+                if not exist and allow_edge(graph, new_edge):
+
+                    iframe_context = iframe_contexts[iframe]
+                    iframe_content = json.dumps(iframe_context['iframe_content'])
+                    dom_context = dom_context_format(iframe_context['dom_context'], self.tokenizer)
+                    url = json.dumps(iframe_context['url'])
+                    iframe_prompt = iframe_prompt_template.format(iframe_content=iframe_content, dom_context=dom_context,
+                                                                  url=url)
+                    _, req_index = graph.add(req)
+                    connected = graph.connect(request, req, CrawlEdge("iframe", iframe, None, current_cookies), edge)
+                    if not connected:
+                        logging.warning("Not connected "+str(new_edge))
+                        continue
+                    (new_edge, edge_index) = connected
+                    new_edge.value.before_prompt = iframe_prompt
+                    request_wrapper = {"req_index": req_index, "prompt": iframe_prompt, "edge_index": edge_index}
+                    self.request_queue.put(request_wrapper)
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
 
         logging.info("Adding requests from ui_forms")
 
@@ -2532,90 +3533,58 @@ class Crawler:
         """
 
         for ui_form in ui_form_contexts:
-            req = Request(driver.current_url, "ui_form")
+            req = Request(findings["current_url"], "ui_form")
             logging.info("from ui_forms %s " % str(req))
 
-            new_edge, exist = graph.create_edge(request, req, CrawlEdge("ui_form", ui_form, None, current_cookies), edge)
-            if not exist and allow_edge(graph, new_edge):
-
-                ui_form_context = ui_form_contexts[ui_form]
-                dom_context = dom_context_format(ui_form_context['dom_context'], self.tokenizer)
-                js_event = json.dumps(ui_form_context['js_event'])
-                action_url = json.dumps(ui_form_context['action_url'])
-                interactive_elements = str(ui_form)
-                ui_form_prompt = ui_form_prompt_template.format(dom_context=dom_context, js_event=js_event,
-                                                                action_url=action_url,
-                                                                interactive_elements=interactive_elements)
-
-                _, req_index = graph.add(req)
-                connected = graph.connect(request, req, CrawlEdge("ui_form", ui_form, None, current_cookies), edge)
-                if not connected:
-                    logging.warning("Not connected "+str(new_edge))
-                    continue
-                (new_edge, edge_index) = connected
-                new_edge.value.before_prompt = ui_form_prompt
-                request_wrapper = {"req_index": req_index, "prompt": ui_form_prompt, "edge_index": edge_index}
-                self.request_queue.put(request_wrapper)
-            else:
-                logging.info("Not allowed to add edge: %s" % new_edge)
-
-        early_state = self.early_gets < self.max_early_gets
-        login_form = find_login_form(driver, graph, early_state)
-
-        if login_form:
-            logging.info("Found login form")
-            print(bcolors.OKGREEN+"We want to test edge: "+str(edge)+bcolors.ENDC)
-            new_form = set_form_values(driver, {login_form}, llm_manager, tokenizer, True).pop()
-            try:
-                print(bcolors.OKGREEN+"Logging in"+bcolors.ENDC)
-                logging.warning("Logging in")
-                form_fill(driver, new_form)
-                time.sleep(1)
-
-                self.cookies.append(driver.get_cookies())
-
-                current_url = driver.current_url
-                if current_url != request.url:
-                    new_request = Request(current_url, request.method)
-                    logging.info("Changed url: " + current_url)
-                    new_edge, exist = graph.create_edge(request, new_request, CrawlEdge("get", current_url, None, None), edge)
-                    if not exist and allow_edge(graph, new_edge):
-                        graph.add(new_request)
-                        graph.connect(request, new_request, CrawlEdge("get", current_url, None, None), edge)
-                        logging.info("Crawl (edge): " + str(new_edge))
-                        print(bcolors.OKGREEN+"Crawl (edge): " + str(new_edge)+bcolors.ENDC)
-                        edge = new_edge
-                        request = new_request
-                        graph.visit_node(request)
-                        graph.visit_edge(edge)
-                    else:
-                        logging.info("Not allowed to add edge: %s" % new_edge)
-            except Exception as e:
-                logging.warning("Failed to login to potential login form " + str(e).splitlines()[0])
-
-        # Try to clean up alerts
-        try:
-            alert = driver.switch_to.alert
-            alert.dismiss()
-        except NoAlertPresentException:
-            pass
+            with graph.lock:
+                new_edge, exist = graph.create_edge(request, req, CrawlEdge("ui_form", ui_form, None, current_cookies), edge)
+                if not exist and allow_edge(graph, new_edge):
+
+                    ui_form_context = ui_form_contexts[ui_form]
+                    dom_context = dom_context_format(ui_form_context['dom_context'], self.tokenizer)
+                    js_event = json.dumps(ui_form_context['js_event'])
+                    action_url = json.dumps(ui_form_context['action_url'])
+                    interactive_elements = str(ui_form)
+                    ui_form_prompt = ui_form_prompt_template.format(dom_context=dom_context, js_event=js_event,
+                                                                    action_url=action_url,
+                                                                    interactive_elements=interactive_elements)
+
+                    _, req_index = graph.add(req)
+                    connected = graph.connect(request, req, CrawlEdge("ui_form", ui_form, None, current_cookies), edge)
+                    if not connected:
+                        logging.warning("Not connected "+str(new_edge))
+                        continue
+                    (new_edge, edge_index) = connected
+                    new_edge.value.before_prompt = ui_form_prompt
+                    request_wrapper = {"req_index": req_index, "prompt": ui_form_prompt, "edge_index": edge_index}
+                    self.request_queue.put(request_wrapper)
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
 
-        if "3" in open("run.flag", "r").read():
-            logging.info("Run set to 3, pause each step")
-            input("Crawler in stepping mode, press enter to continue. EDIT run.flag to run")
+        login = findings["login"]
+        if not login:
+            return False
 
-        # Check command
-        found_command = False
-        if "get_graph" in open("command.txt", "r").read():
-            app_result_path = os.path.join(RESULT_DIR, self.app_name)
-            f = open(os.path.join(app_result_path, "graph.txt"), "w+")
-            f.write(str(self.graph))
-            f.close()
-            found_command = True
-        # Clear command
-        if found_command:
-            open("command.txt", "w+").write("")
+        self.cookies.append(login["cookies"])
+        self.login_url = request.url
+        with graph.lock:
+            self.login_generation += 1
 
+        current_url = login["current_url"]
+        if current_url != request.url:
+            new_request = Request(current_url, request.method)
+            logging.info("Changed url: " + current_url)
+            with graph.lock:
+                new_edge, exist = graph.create_edge(request, new_request, CrawlEdge("get", current_url, None, None), edge)
+                if not exist and allow_edge(graph, new_edge):
+                    graph.add(new_request)
+                    graph.connect(request, new_request, CrawlEdge("get", current_url, None, None), edge)
+                    logging.info("Crawl (edge): " + str(new_edge))
+                    print(bcolors.OKGREEN+"Crawl (edge): " + str(new_edge)+bcolors.ENDC)
+                    graph.visit_node(new_request)
+                    graph.visit_edge(new_edge)
+                else:
+                    logging.info("Not allowed to add edge: %s" % new_edge)
         return True
 
     def retry_login(self, driver, graph):
@@ -2628,7 +3597,7 @@ class Crawler:
                 print(bcolors.OKGREEN + "Logging in" + bcolors.ENDC)
                 logging.warning("Logging in")
                 form_fill(driver, new_form)
-                time.sleep(1)
+                wait_for_settle(driver, "login")
             except Exception as e:
                 logging.warning("Failed to login to potential login form " + str(e).splitlines()[0])
 
@@ -2648,35 +3617,49 @@ class CrawlEdge:
         self.request_datas = []
         self.success = False
 
+    # Pages, markdown and traffic are kept in the snapshot store, the
+    # attributes hold their digest or the original value when it is empty
+    @staticmethod
+    def store_snapshot(value):
+        if not value:
+            return value
+        return get_snapshot_store().put(value)
+
+    @staticmethod
+    def load_snapshot(digest):
+        if not digest:
+            return digest
+        return get_snapshot_store().get(digest)
+
     def get_before_context(self):
-        return self.before_context
+        return self.load_snapshot(self.before_context)
 
     def get_after_context(self):
-        return self.after_context
+        return self.load_snapshot(self.after_context)
 
     def get_request_datas(self):
-        return self.request_datas
+        return self.load_snapshot(self.request_datas)
 
     def get_before_page(self):
-        return self.before_page
+        return self.load_snapshot(self.before_page)
 
     def get_after_page(self):
-        return self.after_page
+        return self.load_snapshot(self.after_page)
 
     def set_before_context(self, before_context):
-        self.before_context = before_context
+        self.before_context = self.store_snapshot(before_context)
 
     def set_before_page(self, before_page):
-        self.before_page = before_page
+        self.before_page = self.store_snapshot(before_page)
 
     def set_after_page(self, after_page):
-        self.after_page = after_page
+        self.after_page = self.store_snapshot(after_page)
 
     def set_after_context(self, after_context):
-        self.after_context = after_context
+        self.after_context = self.store_snapshot(after_context)
 
     def set_request_datas(self, request_datas):
-        self.request_datas = request_datas
+        self.request_datas = self.store_snapshot(request_datas)
 
     def __repr__(self):
         str_edge = str(self.method) + " " + str(self.method_data)
@@ -2716,9 +3699,9 @@ class CrawlEdge:
             'before_resource_operation': self.before_resource_operation,
             'after_resource_operation': self.after_resource_operation,
             'success': self.success,
-            'before_context': self.before_context,
-            'after_context': self.after_context,
-            'before_page': self.before_page,
-            'after_page': self.after_page,
-            'request_datas': self.request_datas
+            'before_context': self.get_before_context(),
+            'after_context': self.get_after_context(),
+            'before_page': self.get_before_page(),
+            'after_page': self.get_after_page(),
+            'request_datas': self.get_request_datas()
         }
\ No newline at end of file
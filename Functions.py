@@ -1,7 +1,6 @@
 # Functions.py contains general purpose functions can be utilized by
 # the crawler.
 import sys
-from PIL import Image, ImageDraw
 from selenium.webdriver.support.select import Select
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
@@ -18,13 +17,24 @@ import traceback
 import random
 import re
 import logging
+import threading
 import time
 import html2text
 import urllib.parse
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from types import MappingProxyType
 
 import Classes
 from extractors.Forms import extract_forms, parse_form
+from extractors.Page import analyze_page, page_state
+from settle import wait_for_settle
+from browser_state import restore_browser_state
+from traffic import filter_content_types, fileter_postfixes, heart_beats, reset_capture, truncate_body
 from llm_manager import LLMManager
+from llm_cache import get_llm_cache
 from tools import get_accessible_name
 from dotenv import load_dotenv
 
@@ -111,6 +121,7 @@ def capture_element_screenshot(driver, addr, filename):
         width = location['x'] + size['width']
         height = location['y'] + size['height']
 
+        from PIL import Image, ImageDraw
         im = Image.open(os.path.join(screenshot_dir, filename))
         draw = ImageDraw.Draw(im)
 
@@ -133,13 +144,69 @@ def extract_form_pages(path, is_crawl):
     for edge in path:
         index += 1
         if edge.value.method == "form" and edge.value.after_context:
-            form_pages[index]= edge.value.after_context
+            form_pages[index]= edge.value.get_after_context()
     return form_pages
 
+# Where the browser is in the graph: the path that led to the current page
+# and the page version (page_version() in js/settle.js) right after it
+def set_replay_position(driver, path, version):
+    driver.replay_position = (list(path), version)
+
+def clear_replay_position(driver):
+    driver.replay_position = None
+
+def shared_prefix_length(path, other):
+    length = 0
+    for (edge, other_edge) in zip(path, other):
+        if edge is not other_edge:
+            break
+        length += 1
+    return length
+
+# Number of steps of path already behind the browser. They can be skipped as
+# long as the page is still the one the recorded position ended on.
+def replay_start(driver, path):
+    position = getattr(driver, "replay_position", None)
+    if not position:
+        return 0
+    (position_path, version) = position
+    if version is None or len(position_path) >= len(path):
+        return 0
+    if shared_prefix_length(path, position_path) < len(position_path):
+        return 0
+    try:
+        current_version = page_state(driver, version)['version']
+    except UnexpectedAlertPresentException:
+        return 0
+    if current_version != version:
+        logging.info("Page changed since the last replay, replaying the whole path")
+        return 0
+    logging.info("Skipping " + str(len(position_path)) + " of " + str(len(path)) + " replay steps")
+    return len(position_path)
+
+# Common prefix of the edge positions of a replay path and of the current
+# position of the browser, -1 for edges not in the graph never match
+def replay_overlap(path, position_path):
+    length = 0
+    for (index, position) in zip(path, position_path):
+        if index < 0 or index != position:
+            break
+        length += 1
+    return length
+
 # Execute the path necessary to reach the state
 def find_state(driver, graph, edge, is_crawl):
     path = rec_find_path(graph, edge)
     form_pages = extract_form_pages(path, is_crawl)
+    start = replay_start(driver, path)
+    # Whatever happens below moves the browser away from the position
+    clear_replay_position(driver)
+    # Jump to the state saved for the node the last edge starts from. The
+    # attacks replay the submits of the path, and a saved URL does not
+    # lead into an iframe.
+    if is_crawl and start < len(path) - 1 and not any(e.value.method == "iframe" for e in path[:-1]):
+        if restore_browser_state(driver, path[-1].n1.value):
+            start = len(path) - 1
 
     text_maker = html2text.HTML2Text()
     text_maker.ignore_links = True
@@ -148,6 +215,8 @@ def find_state(driver, graph, edge, is_crawl):
     index = -1
     for edge_in_path in path:
         index += 1
+        if index < start:
+            continue
         if index == len(path) - 1:
             last_edge = True
         method = edge_in_path.value.method
@@ -159,10 +228,9 @@ def find_state(driver, graph, edge, is_crawl):
         before_page = ""
         if allow_edge(graph, edge_in_path):
             if is_crawl:
-                time.sleep(0.1)
+                wait_for_settle(driver, "before " + str(method))
             if is_crawl and last_edge:
-                time.sleep(0.5)
-                before_num = len(driver.requests)
+                before_num = reset_capture(driver)
                 before_page_context = text_maker.handle(driver.page_source)
                 edge_in_path.value.set_before_context(before_page_context)
                 before_page = driver.page_source
@@ -172,7 +240,7 @@ def find_state(driver, graph, edge, is_crawl):
                     driver.get("http://localhost")
                 driver.get(edge_in_path.n2.value.url)
                 if is_crawl:
-                    time.sleep(0.1)
+                    wait_for_settle(driver, "get")
             elif method == "form":
                 if is_crawl and not last_edge:
                     continue
@@ -180,7 +248,7 @@ def find_state(driver, graph, edge, is_crawl):
                 try:
                     form_fill(driver, form, is_crawl)
                     if is_crawl:
-                        time.sleep(0.1)
+                        wait_for_settle(driver, "form")
                 except Exception as e:
                     print(bcolors.OKGREEN+str(e).splitlines()[0]+bcolors.ENDC)
                     logging.error(str(e).splitlines()[0])
@@ -293,7 +361,7 @@ def find_state(driver, graph, edge, is_crawl):
 
             if last_edge:
                 if is_crawl:
-                    time.sleep(0.5)
+                    wait_for_settle(driver, "last edge")
                     try:
                         alert = driver.switch_to.alert
                         alertText = alert.text
@@ -376,42 +444,6 @@ def get_traffic(driver, graph, before_num, after_num, edge):
 
     from_url = graph.nodes[1].value.url
 
-    filter_content_types = [
-        "text/css",
-        "application/javascript",
-        "image/png",
-        "font/woff2",
-        "font/woff",
-        "font/ttf",
-        "image/x-icon",
-        "application/font-woff",
-        "image/vnd.microsoft.icon",
-        "image/jpg",
-        "image/jpeg",
-        "image/gif",
-        "multipart/form-data",
-        "application/octet-stream",
-        "application/x-www-form-urlencoded"
-    ]
-
-    fileter_postfixes = [
-        ".js",
-        ".css",
-        ".png",
-        ".jpg",
-        ".jpeg",
-        ".gif",
-        ".svg",
-        ".ico",
-        ".woff2",
-        ".woff",
-        ".ttf",
-    ]
-
-    heart_beats = [
-        "api/sessions"
-    ]
-
     for request in driver.requests[before_num:after_num]:
         if request.response:
             url = request.url
@@ -449,7 +481,7 @@ def get_traffic(driver, graph, before_num, after_num, edge):
                             break
 
             try:
-                request_body = request.body.decode('utf-8', errors='ignore')
+                request_body = truncate_body(request.body.decode('utf-8', errors='ignore'))
             except:
                 request_body = ""
             if request_need_filter:
@@ -467,13 +499,14 @@ def get_traffic(driver, graph, before_num, after_num, edge):
             # Add response body only for non-static files
             if not response_need_filter:
                 try:
-                    request_data["response_body"] = request.response.body.decode('utf-8', errors='ignore')
+                    request_data["response_body"] = truncate_body(request.response.body.decode('utf-8', errors='ignore'))
                 except Exception as e:
                     request_data["response_body_error"] = str(e).splitlines()[0]
 
                 traffic_data.append(request_data)
 
     edge.value.set_request_datas(traffic_data)
+    reset_capture(driver)
 
     return len(traffic_data) > 0
 
@@ -488,7 +521,7 @@ def follow_edge(driver, graph, edge, is_crawl=False):
         if is_crawl:
             text_maker.ignore_links = True
 
-            before_num = len(driver.requests)
+            before_num = reset_capture(driver)
             before_page = text_maker.handle(driver.page_source)
             edge.value.set_before_context(before_page)
 
@@ -498,7 +531,7 @@ def follow_edge(driver, graph, edge, is_crawl=False):
         driver.get(edge.n2.value.url)
 
         if is_crawl:
-            time.sleep(0.5)
+            wait_for_settle(driver, "follow get")
             after_num = len(driver.requests)
             after_page = text_maker.handle(driver.page_source)
             edge.value.set_after_context(after_page)
@@ -739,8 +772,7 @@ def form_fill(driver, target_form, is_crawl=False):
         logging.info("No alert removed (probably due to there not being any)"+str(e).splitlines()[0])
         pass
 
-    form_wait_time = float(os.getenv('FORM_WAIT_TIME', '0.5'))
-    time.sleep(form_wait_time)
+    wait_for_settle(driver, "form fill")
 
     elem = driver.find_elements(By.TAG_NAME, "form")
     fill_success = False
@@ -1304,7 +1336,7 @@ def enter_iframe(driver, target_frame):
 
 def find_login_form(driver, graph, early_state=False):
     logging.info("Finding login form in " + driver.current_url)
-    forms, form_contexts = extract_forms(driver)
+    forms, form_contexts = analyze_page(driver).extract(extract_forms)
     for form in forms:
         count = 0
         for input in form.inputs:
@@ -1330,6 +1362,22 @@ def empty2none(s):
     else:
         return s
 
+# Token counts of formatted dom contexts, known pages repeat the same ones
+dom_context_lengths = OrderedDict()
+dom_context_lengths_lock = threading.Lock()
+
+def dom_context_length(dom_context_prompt, tokenizer):
+    with dom_context_lengths_lock:
+        if dom_context_prompt in dom_context_lengths:
+            dom_context_lengths.move_to_end(dom_context_prompt)
+            return dom_context_lengths[dom_context_prompt]
+    length = len(tokenizer.encode(dom_context_prompt))
+    with dom_context_lengths_lock:
+        dom_context_lengths[dom_context_prompt] = length
+        if len(dom_context_lengths) > int(os.getenv("EXTRACTION_CACHE_SIZE", 256)) * 16:
+            dom_context_lengths.popitem(last=False)
+    return length
+
 def dom_context_format(dom_context, tokenizer):
     dom_context_prompt = ''
     if 'current_node' in dom_context:
@@ -1380,7 +1428,7 @@ def dom_context_format(dom_context, tokenizer):
                 index += 1
         else:
             dom_context_prompt += f"{sibling_nodes}"
-    length = len(tokenizer.encode(dom_context_prompt))
+    length = dom_context_length(dom_context_prompt, tokenizer)
     MAX_CONTEXT_LENGTH = int(os.getenv("MAX_CONTEXT_LENGTH", 65536))
     DOM_CONTEXT_LENGTH = MAX_CONTEXT_LENGTH*0.7
     if length > DOM_CONTEXT_LENGTH:
@@ -1392,35 +1440,80 @@ def dom_context_format(dom_context, tokenizer):
     return dom_context_prompt
 
 semantic_cache = {}
-function_llm_manger = LLMManager(os.getenv("API_KEY"), os.getenv("BASE_URL"), os.getenv("MODEL_NAME"))
+function_llm_manger = None
+
+def get_function_llm_manager():
+    global function_llm_manger
+    if function_llm_manger is None:
+        function_llm_manger = LLMManager(os.getenv("API_KEY"), os.getenv("BASE_URL"), os.getenv("MODEL_NAME"))
+    return function_llm_manger
+
+# Parameters are classified in the background once a third value shows up,
+# until then URLs are compared with this answer
+semantic_param_default = os.getenv("SEMANTIC_PARAM_DEFAULT", "true").lower() == "true"
+semantic_lock = threading.Lock()
+semantic_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEMANTIC_PARAM_WORKERS", 1)))
+# (url_template, param_name) being classified, to the equivalence keys of the
+# URLs compared with the provisional answer
+semantic_pending = {}
+# (url_template, param_name, important, keys) of finished classifications,
+# the crawler merges the nodes of keys again when the answer changed
+semantic_verdicts = Queue()
 
 def is_param_important(param_name, param_value1, param_value2, url1, url2, url_template):
     if param_name.startswith("PATH_PARAM_"):
         return True
-    if url_template not in semantic_cache:
-        semantic_cache[url_template] = {}
-    if param_name not in semantic_cache[url_template]:
-        semantic_cache[url_template][param_name] = {}
-    if "is_semantically_important" in semantic_cache[url_template][param_name]:
-        return semantic_cache[url_template][param_name]["is_semantically_important"]
-    if "value" not in semantic_cache[url_template][param_name]:
-        semantic_cache[url_template][param_name]["value"] = []
-    if param_value1 not in semantic_cache[url_template][param_name]["value"]:
-        semantic_cache[url_template][param_name]["value"].append(param_value1)
-    if param_value2 not in semantic_cache[url_template][param_name]["value"]:
-        semantic_cache[url_template][param_name]["value"].append(param_value2)
-    if len(semantic_cache[url_template][param_name]["value"]) > 2:
-        prompt = f"""URL: {url1}, Parameter Name: {param_name}, Parameter Value: {str(semantic_cache[url_template][param_name]["value"])}"""
-        start = time.time()
-        formatted_start = datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
-        print(bcolors.OKGREEN+"start to check if parameter is semantically important "+str(formatted_start)+bcolors.ENDC)
-        generated_data = function_llm_manger.identify_semantically_important_parameter(prompt)
-        print(bcolors.OKGREEN+"end to check if parameter is semantically important "+str(time.time()-start)+bcolors.ENDC)
-        semantic_cache[url_template][param_name]["is_semantically_important"] = generated_data.get("semantically important", True)
-        print(bcolors.OKGREEN+"url "+url1+" semantic_param_analysis for "+str(param_name)+" is "+str(semantic_cache[url_template][param_name]["is_semantically_important"])+bcolors.ENDC)
-        return semantic_cache[url_template][param_name]["is_semantically_important"]
-
-    return False
+    with semantic_lock:
+        if url_template not in semantic_cache:
+            semantic_cache[url_template] = {}
+        if param_name not in semantic_cache[url_template]:
+            semantic_cache[url_template][param_name] = {}
+        semantic_param = semantic_cache[url_template][param_name]
+        if "is_semantically_important" in semantic_param:
+            return semantic_param["is_semantically_important"]
+        cache_key = url_template + "\n" + param_name
+        if "cache_checked" not in semantic_param:
+            semantic_param["cache_checked"] = True
+            llm_cache = get_llm_cache()
+            answer = llm_cache.get("semantic_parameter", cache_key) if llm_cache else None
+            if answer is not None:
+                semantic_param["is_semantically_important"] = answer
+                return answer
+        if "value" not in semantic_param:
+            semantic_param["value"] = []
+        if param_value1 not in semantic_param["value"]:
+            semantic_param["value"].append(param_value1)
+        if param_value2 not in semantic_param["value"]:
+            semantic_param["value"].append(param_value2)
+        if len(semantic_param["value"]) <= 2:
+            return False
+        pending = (url_template, param_name)
+        if pending not in semantic_pending:
+            semantic_pending[pending] = set()
+            prompt = f"""URL: {url1}, Parameter Name: {param_name}, Parameter Value: {str(semantic_param["value"])}"""
+            semantic_executor.submit(classify_param, url_template, param_name, prompt, cache_key, url1)
+        semantic_pending[pending].add(get_url_equivalence_key(url1))
+    return semantic_param_default
+
+def classify_param(url_template, param_name, prompt, cache_key, url):
+    start = time.time()
+    formatted_start = datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
+    print(bcolors.OKGREEN+"start to check if parameter is semantically important "+str(formatted_start)+bcolors.ENDC)
+    try:
+        generated_data = get_function_llm_manager().identify_semantically_important_parameter(prompt)
+    except Exception as e:
+        logging.error("Semantic parameter analysis failed " + str(e).splitlines()[0])
+        generated_data = {}
+    print(bcolors.OKGREEN+"end to check if parameter is semantically important "+str(time.time()-start)+bcolors.ENDC)
+    important = generated_data.get("semantically important", True)
+    with semantic_lock:
+        semantic_cache[url_template][param_name]["is_semantically_important"] = important
+        keys = semantic_pending.pop((url_template, param_name), set())
+    llm_cache = get_llm_cache()
+    if llm_cache and generated_data:
+        llm_cache.put("semantic_parameter", cache_key, generated_data["semantically important"])
+    print(bcolors.OKGREEN+"url "+url+" semantic_param_analysis for "+str(param_name)+" is "+str(important)+bcolors.ENDC)
+    semantic_verdicts.put((url_template, param_name, important, keys))
 
 def extract_all_query_params(query_str):
     pairs = re.split(r"[&;]", query_str)
@@ -1467,10 +1560,8 @@ def extract_all_parameters(url: str):
             params[PATH_PARAM] = part
     return params
 
-def get_url_template(url: str) -> str:
-    parsed = urllib.parse.urlparse(url)
+def build_url_template(parsed, path_parts):
     url_template = parsed.scheme + "://" + parsed.netloc
-    path_parts = parsed.path.strip("/").split("/")
     for i in range(len(path_parts)):
         part = path_parts[i]
         if "=" in part:
@@ -1491,6 +1582,47 @@ def get_url_template(url: str) -> str:
         url_template += "#" + parsed.fragment
     return url_template
 
+def url_part_key(part):
+    # Parts with "=" or ":" are compared by their key only, and a part holding
+    # both can match either kind, so they all share one wildcard bucket.
+    if "=" in part or ":" in part:
+        return "*"
+    if part.isdigit():
+        return "#"
+    return part
+
+# Parsed form of a URL, computed once per raw URL string.
+# key is shared by all URLs that are_urls_equivalent may consider equal.
+CanonicalUrl = namedtuple("CanonicalUrl", ["scheme", "netloc", "path_parts", "fragment",
+                                           "template", "params", "key"])
+
+@lru_cache(maxsize=int(os.getenv("URL_CACHE_SIZE", 65536)))
+def canonicalize_url(url: str) -> CanonicalUrl:
+    parsed = urllib.parse.urlparse(url)
+    path_parts = tuple(parsed.path.strip("/").split("/"))
+    params = extract_all_parameters(url)
+    key = (parsed.scheme,
+           parsed.netloc,
+           tuple(url_part_key(part) for part in path_parts),
+           url_part_key(parsed.fragment),
+           frozenset(params.keys()))
+    return CanonicalUrl(parsed.scheme, parsed.netloc, path_parts, parsed.fragment,
+                        build_url_template(parsed, path_parts), MappingProxyType(params), key)
+
+def get_url_template(url: str) -> str:
+    return canonicalize_url(url).template
+
+# Bucket key for are_urls_equivalent: two equivalent URLs always share the
+# same key, so the key can be used to hash and index URLs.
+def get_url_equivalence_key(url):
+    if url is None:
+        return None
+    url = str(url)
+    try:
+        return canonicalize_url(url).key
+    except Exception:
+        return "raw", url
+
 # === Compare two URLs for semantic equivalence ===
 def are_urls_equivalent(url1: str, url2: str) -> bool:
     if url1 == url2:
@@ -1500,19 +1632,20 @@ def are_urls_equivalent(url1: str, url2: str) -> bool:
     url1 = str(url1)
     url2 = str(url2)
     try:
-        parsed1 = urllib.parse.urlparse(url1)
-        parsed2 = urllib.parse.urlparse(url2)
+        canonical1 = canonicalize_url(url1)
+        canonical2 = canonicalize_url(url2)
     except Exception as e:
         print(bcolors.OKGREEN+"Error parsing URLs: "+str(e).splitlines()[0]+bcolors.ENDC)
         return False
 
-    # Compare path
-    url1_template = parsed1.scheme + "://" + parsed1.netloc
-    url2_template = parsed2.scheme + "://" + parsed2.netloc
-    path1_parts = parsed1.path.strip("/").split("/")
-    path2_parts = parsed2.path.strip("/").split("/")
-    if len(path1_parts) != len(path2_parts):
+    if canonical1.key != canonical2.key:
         return False
+
+    # Compare path
+    url1_template = canonical1.scheme + "://" + canonical1.netloc
+    url2_template = canonical2.scheme + "://" + canonical2.netloc
+    path1_parts = canonical1.path_parts
+    path2_parts = canonical2.path_parts
     path_length = len(path1_parts)
     for i in range(path_length):
         if "=" in path1_parts[i] and "=" in path2_parts[i]:
@@ -1530,37 +1663,30 @@ def are_urls_equivalent(url1: str, url2: str) -> bool:
             url2_template += "/" + path2_parts[i]
         else:
             return False
-    if parsed1.netloc != parsed2.netloc:
-        return False
-    if parsed1.scheme != parsed2.scheme:
-        return False
-    if "=" in parsed1.fragment and "=" in parsed2.fragment:
-        url1_template += "#" + parsed1.fragment.split("=")[0]
-        url2_template += "#" + parsed2.fragment.split("=")[0]
-    elif ":" in parsed1.fragment and ":" in parsed2.fragment:
-        url1_template += "#" + parsed1.fragment.split(":")[0]
-        url2_template += "#" + parsed2.fragment.split(":")[0]
-    elif parsed1.fragment.isdigit() and parsed2.fragment.isdigit():
+    fragment1 = canonical1.fragment
+    fragment2 = canonical2.fragment
+    if "=" in fragment1 and "=" in fragment2:
+        url1_template += "#" + fragment1.split("=")[0]
+        url2_template += "#" + fragment2.split("=")[0]
+    elif ":" in fragment1 and ":" in fragment2:
+        url1_template += "#" + fragment1.split(":")[0]
+        url2_template += "#" + fragment2.split(":")[0]
+    elif fragment1.isdigit() and fragment2.isdigit():
         url1_template += "#PATH_PARAM_"+str(path_length)
         url2_template += "#PATH_PARAM_"+str(path_length)
-    elif parsed1.fragment == parsed2.fragment:
-        url1_template += "#" + parsed1.fragment
-        url2_template += "#" + parsed2.fragment
+    elif fragment1 == fragment2:
+        url1_template += "#" + fragment1
+        url2_template += "#" + fragment2
     else:
         return False
 
     if url1_template!= url2_template:
         return False
 
-    # Extract and filter parameters
-    params1 = extract_all_parameters(url1)
-    params2 = extract_all_parameters(url2)
-
-    # All keys union
-    all_keys = set(params1.keys()) | set(params2.keys())
-    if all_keys != set(params1.keys()) & set(params2.keys()):
-        return False
-    for k in all_keys:
+    # Equal keys mean both URLs have the same parameter names
+    params1 = canonical1.params
+    params2 = canonical2.params
+    for k in params1:
         v1 = params1.get(k)
         v2 = params2.get(k)
         if v1 != v2:
@@ -1,6 +1,9 @@
 import sys
 from typing import Dict, List, Tuple, Optional
-from collections import defaultdict
+from collections import Counter, defaultdict
+import heapq
+import itertools
+import os
 import random
 
 class bcolors:
@@ -25,6 +28,18 @@ class bcolors:
         BOLD = ''
         UNDERLINE = ''
 
+# Priority of a ready node is weight * failed_count plus the weight of its
+# operation, e.g. SCHEDULER_WEIGHTS="delete=2,read=-1". Lowest goes first.
+failed_weight = float(os.getenv("SCHEDULER_FAILED_WEIGHT", 1))
+operation_weights = {}
+for item in os.getenv("SCHEDULER_WEIGHTS", "").split(","):
+    if "=" in item:
+        (operation, weight) = item.split("=", 1)
+        operation_weights[operation.strip()] = float(weight)
+scheduler_seed = int(os.getenv("SCHEDULER_SEED", 6))
+# At most this many equally good nodes are offered to the preference
+preference_window = int(os.getenv("SCHEDULER_PREFERENCE_WINDOW", 32))
+
 class Node:
     def __init__(self, action: str, resource: str, operation: str,
                  subtype: str, index: int, failed_count: int = 0):
@@ -48,10 +63,19 @@ class Cluster:
         self.nodes: List[Node] = []
         self.predecessors: List['Cluster'] = []
         self.successors: List['Cluster'] = []
+        # Predecessors that are not done yet, see DependencyGraph.rebuild
+        self.pending = 0
 
     def is_empty(self) -> bool:
         return len(self.nodes) == 0
 
+    # Same as DependencyGraph.is_all_predecessors_empty, kept up to date
+    def is_ready(self) -> bool:
+        return self.pending == 0
+
+    def is_done(self) -> bool:
+        return self.is_empty() and self.is_ready()
+
     def __repr__(self):
         return f"Cluster({self.resource}, {self.operation}, nodes={len(self.nodes)})"
 
@@ -62,6 +86,16 @@ class DependencyGraph:
         self.parent_cache: Dict[str, List[str]] = defaultdict(list)
         self.crawler = crawler
         self.max_failed_count = 10
+        # Told about nodes becoming ready or going away, see Scheduler
+        self.listeners = []
+        # Dependency questions still in the LLM process per resource, the new
+        # resource of a question and the known ones it is asked about
+        self.inferring = Counter()
+        # Topological position of every cluster, kept up to date as clusters
+        # are linked
+        self.order: Dict[Cluster, int] = {}
+        self.positions = itertools.count()
+        self.forward: List[Cluster] = []
 
     def _ensure_placeholders(self, resource: str):
         ops = ['create', 'read', 'update', 'unknown', 'delete']
@@ -74,45 +108,138 @@ class DependencyGraph:
 
 
     def add_node(self, node: Node):
+        is_new = (node.resource, node.operation) not in self.clusters
         self._ensure_placeholders(node.resource)
+        if is_new:
+            self.infer_dependencies(node.resource, [node.index])
         failed_count = node.failed_count
         if failed_count > self.max_failed_count:
             print(bcolors.OKGREEN + f"[Navigation] Node {node.key4()} failed too many times, skipping." + bcolors.ENDC)
             return False
 
         cluster = self.clusters[(node.resource, node.operation)]
+        (was_ready, was_done) = (cluster.is_ready(), cluster.is_done())
         cluster.nodes.append(node)
+        self._changed(cluster, was_ready, was_done)
+        if cluster.is_ready():
+            for listener in self.listeners:
+                listener.push(cluster, [node])
 
         return True
 
+    def remove_nodes(self, cluster: Cluster, nodes: List[Node]):
+        if not nodes:
+            return
+        for listener in self.listeners:
+            listener.drop(nodes)
+        (was_ready, was_done) = (cluster.is_ready(), cluster.is_done())
+        removed = set(map(id, nodes))
+        cluster.nodes = [n for n in cluster.nodes if id(n) not in removed]
+        self._changed(cluster, was_ready, was_done)
+
+    def _set_pending(self, cluster: Cluster, pending: int):
+        (was_ready, was_done) = (cluster.is_ready(), cluster.is_done())
+        cluster.pending = pending
+        self._changed(cluster, was_ready, was_done)
+
+    # Passes a change of cluster on to its listeners and successors
+    def _changed(self, cluster: Cluster, was_ready: bool, was_done: bool):
+        if cluster.is_ready() and not was_ready:
+            for listener in self.listeners:
+                listener.push(cluster, cluster.nodes)
+        done = cluster.is_done()
+        if done != was_done:
+            for succ in cluster.successors:
+                self._set_pending(succ, succ.pending + (-1 if done else 1))
+
+    # Recomputes the pending counters, after the clusters were replaced or
+    # merged
+    def rebuild(self):
+        self._sort_clusters()
+        done = {}
+        for c in sorted(self.clusters.values(), key=self.order.get):
+            c.pending = sum(1 for p in c.predecessors if not done.get(p, False))
+            done[c] = c.is_done()
+        for listener in self.listeners:
+            listener.reset()
+
     def _all_nodes(self) -> List[Node]:
         out = []
         for c in self.clusters.values():
             out.extend(c.nodes)
         return out
 
+    def _position(self, cluster: Cluster) -> int:
+        if cluster not in self.order:
+            self.order[cluster] = next(self.positions)
+        return self.order[cluster]
+
+    # src -> dst closes a cycle if dst reaches src. In the topological order
+    # only clusters between dst and src can be on such a path, so that is all
+    # that is searched (Pearce-Kelly). The clusters dst reaches are kept for
+    # _reorder. The cycle starts with src, the last cluster links back to it.
     def _has_cycle_and_get_path(self, src: Cluster, dst: Cluster):
-        path = []
+        upper = self._position(src)
+        self.forward = []
+        if self._position(dst) > upper:
+            return False, []
 
-        def dfs(current, target, trace):
-            if current in trace:
-                return False
-            if current == target:
-                path.extend(trace + [current])
-                return True
-            trace.append(current)
+        parents = {dst: None}
+        stack = [dst]
+        while stack:
+            current = stack.pop()
+            self.forward.append(current)
             for succ in current.successors:
-                if dfs(succ, target, trace):
-                    return True
-            trace.pop()
-            return False
-
-        if dfs(dst, src, []):
-            cycle_start = path.index(src)
-            cycle = path[cycle_start:] + [dst]
-            return True, cycle
-        else:
-            return False, []
+                if succ is src:
+                    path = []
+                    while current is not None:
+                        path.append(current)
+                        current = parents[current]
+                    return True, [src] + path[::-1]
+                if succ not in parents and self._position(succ) < upper:
+                    parents[succ] = current
+                    stack.append(succ)
+        return False, []
+
+    # Moves the clusters reaching src in front of those dst reaches, reusing
+    # their positions
+    def _reorder(self, src: Cluster, dst: Cluster):
+        if not self.forward:
+            return
+        lower = self._position(dst)
+        backward = []
+        seen = {src}
+        stack = [src]
+        while stack:
+            current = stack.pop()
+            backward.append(current)
+            for pred in current.predecessors:
+                if pred not in seen and self._position(pred) > lower:
+                    seen.add(pred)
+                    stack.append(pred)
+        backward.sort(key=self.order.get)
+        self.forward.sort(key=self.order.get)
+        clusters = backward + self.forward
+        for (cluster, position) in zip(clusters, sorted(self.order[c] for c in clusters)):
+            self.order[cluster] = position
+        self.forward = []
+
+    # Topological order from scratch, after clusters were replaced or merged
+    def _sort_clusters(self):
+        self.order = {}
+        self.positions = itertools.count()
+        waiting = {c: len(c.predecessors) for c in self.clusters.values()}
+        queue = [c for c in self.clusters.values() if waiting[c] == 0]
+        while queue:
+            current = queue.pop()
+            self._position(current)
+            for succ in current.successors:
+                waiting[succ] -= 1
+                if waiting[succ] == 0:
+                    queue.append(succ)
+        # Only left if the graph has a cycle
+        for c in self.clusters.values():
+            self._position(c)
 
     def _link_clusters(self, src: Cluster, dst: Cluster):
         has_cycle, cycle_path = self._has_cycle_and_get_path(src, dst)
@@ -128,9 +255,12 @@ class DependencyGraph:
                 self._break_cycle(cycle_path)
             return
         if dst not in src.successors:
+            self._reorder(src, dst)
             src.successors.append(dst)
         if src not in dst.predecessors:
             dst.predecessors.append(src)
+            if not src.is_done():
+                self._set_pending(dst, dst.pending + 1)
 
     def _merge_clusters(self, cycle_clusters: list[Cluster]):
         if not cycle_clusters:
@@ -158,6 +288,7 @@ class DependencyGraph:
 
         primary.successors = list(set(primary.successors) - {primary})
         primary.predecessors = list(set(primary.predecessors) - {primary})
+        self.rebuild()
 
     def _break_cycle(self, cycle_clusters: list[Cluster]):
         if not cycle_clusters or len(cycle_clusters) < 2:
@@ -176,6 +307,7 @@ class DependencyGraph:
         src, dst = random.choice(edges)
         src.successors.remove(dst)
         dst.predecessors.remove(src)
+        self.rebuild()
 
         print(bcolors.OKGREEN+f"Break cycle by deleting ：{src.resource}.{src.operation} → {dst.resource}.{dst.operation}"+bcolors.ENDC)
 
@@ -186,36 +318,27 @@ class DependencyGraph:
             c2 = self.clusters[(resource, order[i+1])]
             self._link_clusters(c1, c2)
 
+    # index_list are edges of resource to show the LLM
+    def infer_dependencies(self, resource: str, index_list: List[int]):
+        self.inferring.update(self.crawler.request_resource_dependencies(resource, index_list))
+
+    # The answer about resources came back, usable or not
+    def inferred(self, resources: List[str]):
+        self.inferring.subtract(resources)
+        for resource in resources:
+            if self.inferring[resource] <= 0:
+                del self.inferring[resource]
+
+    # Children are deleted before their parent
+    def link_delete(self, parent: str, child: str):
+        self._ensure_placeholders(parent)
+        self._ensure_placeholders(child)
+        self._link_clusters(self.clusters[(child, 'delete')], self.clusters[(parent, 'delete')])
+
+    # A delete waits for its children and for every dependency answer its
+    # resource is part of
     def has_predecessor_for_delete(self, cluster: Cluster):
-        has_predecessor_for_delete_flag = False
-        potential_parent_name = cluster.resource
-        potential_parent_index_list = []
-        for c in random.sample(self.clusters[(potential_parent_name, 'create')].nodes,
-                               min(3, len(self.clusters[(potential_parent_name, 'create')].nodes))):
-            potential_parent_index_list.append(c.index)
-        for r in random.sample(self.clusters[(potential_parent_name, 'read')].nodes,
-                               min(3, len(self.clusters[(potential_parent_name, 'read')].nodes))):
-            potential_parent_index_list.append(r.index)
-        for resource_operation in self.clusters.keys():
-            if resource_operation[1] == 'delete' and resource_operation[0] != cluster.resource:
-                potential_child_name = resource_operation[0]
-                potential_child_index_list = []
-                for c in random.sample(self.clusters[(potential_child_name, 'create')].nodes,
-                                       min(3, len(self.clusters[(potential_child_name, 'create')].nodes))):
-                    potential_child_index_list.append(c.index)
-                for r in random.sample(self.clusters[(potential_child_name, 'read')].nodes,
-                                       min(3, len(self.clusters[(potential_child_name, 'read')].nodes))):
-                    potential_child_index_list.append(r.index)
-
-                is_parent_child_relationship = self.crawler.infer_resource_dependency_relationship(
-                    potential_parent_name, potential_parent_index_list, potential_child_name,
-                    potential_child_index_list)
-
-                if is_parent_child_relationship:
-                    self._link_clusters(self.clusters[(potential_child_name, 'delete')], cluster)
-                    if not has_predecessor_for_delete_flag:
-                        has_predecessor_for_delete_flag = not self.is_all_predecessors_empty(cluster, set())
-        return has_predecessor_for_delete_flag
+        return self.inferring[cluster.resource] > 0 or not cluster.is_ready()
 
     def is_all_predecessors_empty(self, cluster: Cluster, empty_clusters: set):
         if cluster in empty_clusters:
@@ -229,39 +352,106 @@ class DependencyGraph:
                 empty_clusters.add(p)
         return True
 
+# Keeps the nodes of ready clusters in a heap ordered by priority and a
+# seeded random tie-break. Entries of nodes that were removed, changed or
+# whose cluster is blocked again are dropped when they come up.
 class Scheduler:
-    def __init__(self, graph: DependencyGraph):
+    def __init__(self, graph: DependencyGraph, weights: Optional[Dict[str, float]] = None, seed: Optional[int] = None):
         self.graph = graph
-
-    def _eligible_clusters(self):
-        candidates = []
+        self.weights = operation_weights if weights is None else weights
+        self.random = random.Random(scheduler_seed if seed is None else seed)
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        graph.listeners.append(self)
+        self.reset()
+
+    def priority(self, cluster: Cluster, node: Node) -> float:
+        return failed_weight * node.failed_count + self.weights.get(cluster.operation, 0)
+
+    def reset(self):
+        self.heap = []
+        self.entries = {}
         for c in self.graph.clusters.values():
-            if self.graph.is_all_predecessors_empty(c, set()):
-                candidates.append(c)
-        return candidates
-
-    def pick_and_run(self):
-        candidates = self._eligible_clusters()
-        cluster = None
-        while candidates:
-            cluster = random.choice(candidates)
-            if not cluster.is_empty():
-                if cluster.operation == 'delete' and not self.graph.has_predecessor_for_delete(cluster):
-                    choose_delete = random.randint(0,100)
-                    if choose_delete >= 90:
-                        break
-                else:
-                    break
-            candidates.remove(cluster)
+            if c.is_ready():
+                self.push(c, c.nodes)
+
+    def push(self, cluster: Cluster, nodes: List[Node]):
+        for n in nodes:
+            if id(n) in self.entries:
+                continue
+            entry = (self.priority(cluster, n), self.random.random(), next(self.counter), n, cluster)
+            self.entries[id(n)] = entry
+            heapq.heappush(self.heap, entry)
+
+    def drop(self, nodes: List[Node]):
+        for n in nodes:
+            self.entries.pop(id(n), None)
+
+    def _pop(self):
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            node = entry[3]
+            if self.entries.get(id(node)) is not entry:
+                continue
+            if not entry[4].is_ready():
+                # Pushed again once the cluster is ready
+                del self.entries[id(node)]
+                continue
+            return entry
+        return None
+
+    # Deletes only run now and then, and not before their children
+    def _accept(self, cluster: Cluster) -> bool:
+        if cluster.operation == 'delete':
+            if self.graph.has_predecessor_for_delete(cluster):
+                return False
+            return self.random.randint(0, 100) >= 90
+        return True
+
+    # preference(edge index) breaks ties between the best nodes, the
+    # highest value wins
+    def pick_and_run(self, preference=None):
+        deferred = []
+        decisions = {}
+        chosen = None
+        while chosen is None:
+            entry = self._pop()
+            if entry is None:
+                break
+            cluster = entry[4]
+            if cluster not in decisions:
+                decisions[cluster] = self._accept(cluster)
+            if decisions[cluster]:
+                chosen = entry
+            else:
+                deferred.append(entry)
 
-        if not candidates:
+        if chosen is None:
+            for entry in deferred:
+                heapq.heappush(self.heap, entry)
             return -1
 
-        nodes = sorted(cluster.nodes, key=lambda n: n.failed_count)
-        min_fc = nodes[0].failed_count
-        smallest = [n for n in nodes if n.failed_count == min_fc]
-        node = random.choice(smallest)
-        cluster.nodes.remove(node)
+        if preference is not None:
+            group = [chosen]
+            while len(group) < preference_window and self.heap and self.heap[0][0] == chosen[0]:
+                entry = self._pop()
+                if entry is None or entry[0] != chosen[0]:
+                    if entry is not None:
+                        deferred.append(entry)
+                    break
+                if decisions.get(entry[4], entry[4].operation != 'delete'):
+                    group.append(entry)
+                else:
+                    deferred.append(entry)
+            # group is in tie-break order, max keeps the first of equals
+            chosen = max(group, key=lambda e: preference(e[3].index))
+            deferred.extend(e for e in group if e is not chosen)
+
+        for entry in deferred:
+            heapq.heappush(self.heap, entry)
+        node = chosen[3]
+        self.graph.remove_nodes(chosen[4], [node])
         return node.index
 
     def feedback(self, node: Node, succeed: bool):
@@ -270,15 +460,14 @@ class Scheduler:
             print(bcolors.OKGREEN + f"[Navigation] No cluster found for {key}, skipping feedback." + bcolors.ENDC)
             return
         same_cluster = self.graph.clusters[(node.resource, node.operation)]
+        same = [n for n in same_cluster.nodes if n.key4() == node.key4()]
         if succeed:
-            same_cluster.nodes = [
-                n for n in same_cluster.nodes if n.key4() != node.key4()
-            ]
+            self.graph.remove_nodes(same_cluster, same)
         else:
-            for n in same_cluster.nodes:
-                if n.key4() == node.key4():
-                    n.failed_count += 1
-
-            same_cluster.nodes = [
-                n for n in same_cluster.nodes if n.failed_count <= self.graph.max_failed_count
-            ]
+            for n in same:
+                n.failed_count += 1
+            # Pushed again with the new priority
+            self.drop(same)
+            self.graph.remove_nodes(same_cluster, [n for n in same if n.failed_count > self.graph.max_failed_count])
+            if same_cluster.is_ready():
+                self.push(same_cluster, same_cluster.nodes)
@@ -0,0 +1,447 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from Navigation import DependencyGraph
+
+parser = argparse.ArgumentParser(description='Benchmarks')
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+cycles_parser = subparsers.add_parser("cycles", help="Cycle checks of DependencyGraph._link_clusters")
+cycles_parser.add_argument("--resources", type=int, default=1000,
+                           help="Resources to add, each brings five clusters")
+cycles_parser.add_argument("--links", type=int, default=2000,
+                           help="Random parent-child relationships between resources")
+cycles_parser.add_argument("--seed", type=int, default=6)
+cycles_parser.add_argument("--budget", type=float, default=60,
+                           help="Seconds after which a backend stops linking")
+imports_parser = subparsers.add_parser("imports", help="Import time of the crawler modules")
+imports_parser.add_argument("--modules", nargs="+", default=["Classes", "llm_analysis", "distributed"])
+imports_parser.add_argument("--repeat", type=int, default=5)
+imports_parser.add_argument("--max-seconds", type=float,
+                            help="Fail when a module takes longer than this to import")
+leases_parser = subparsers.add_parser("leases", help="Check that a coordinator hands out expired leases again")
+leases_parser.add_argument("--port", type=int, default=8799,
+                           help="The worker processes use the port after it")
+leases_parser.add_argument("--lease-seconds", type=float, default=1)
+graphs_parser = subparsers.add_parser("graphs", help="Check that Graph and SqliteGraph give the same answers")
+graphs_parser.add_argument("--pages", type=int, default=2000)
+graphs_parser.add_argument("--cache-size", type=int, default=50,
+                           help="Nodes and edges SqliteGraph keeps loaded")
+
+# Only imported when they are used, a module pulling one of them in at
+# import time is a regression
+lazy_modules = ["torch", "transformers", "openai", "httpx", "seleniumwire", "PIL",
+                "sklearn", "pandas", "lib2to3", "pkg_resources", "tldextract"]
+
+import_script = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted(m for m in {lazy_modules!r} if m in sys.modules)]))
+"""
+
+class NoInference:
+    def request_resource_dependencies(self, resource, index_list):
+        return []
+
+# The full search _link_clusters did before it kept a topological order
+class FullSearchGraph(DependencyGraph):
+    def _has_cycle_and_get_path(self, src, dst):
+        path = []
+
+        def dfs(current, target, trace):
+            if current in trace:
+                return False
+            if current == target:
+                path.extend(trace + [current])
+                return True
+            trace.append(current)
+            for succ in current.successors:
+                if dfs(succ, target, trace):
+                    return True
+            trace.pop()
+            return False
+
+        if dfs(dst, src, []):
+            cycle_start = path.index(src)
+            return True, path[cycle_start:] + [dst]
+        return False, []
+
+    def _reorder(self, src, dst):
+        pass
+
+# Seconds to add the resources and the links done within budget
+def build_graph(graph_class, resources, links, seed, budget):
+    generator = random.Random(seed)
+    graph = graph_class(NoInference())
+    start = time.perf_counter()
+    done = 0
+    # _link_clusters prints every cycle it finds
+    with contextlib.redirect_stdout(io.StringIO()):
+        for r in range(resources):
+            graph._ensure_placeholders("resource " + str(r))
+        for _ in range(links):
+            if time.perf_counter() - start > budget:
+                break
+            (parent, child) = generator.sample(range(resources), 2)
+            graph.link_delete("resource " + str(parent), "resource " + str(child))
+            done += 1
+    elapsed = time.perf_counter() - start
+    edges = sorted((c.resource, c.operation, s.resource, s.operation)
+                   for c in graph.clusters.values() for s in c.successors)
+    return elapsed, done, edges
+
+def benchmark_cycles(args):
+    # The recursive search goes as deep as the longest path
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * args.resources * 5))
+    print("%d clusters, %d relationships" % (5 * args.resources, args.links))
+    results = []
+    for (name, graph_class) in [("full search", FullSearchGraph), ("topological order", DependencyGraph)]:
+        (elapsed, done, edges) = build_graph(graph_class, args.resources, args.links, args.seed, args.budget)
+        print("%-18s %8.3fs for %d relationships" % (name + ":", elapsed, done))
+        results.append((elapsed, done, edges))
+    ((full_time, full_done, full_edges), (ordered_time, ordered_done, ordered_edges)) = results
+    if full_done < args.links or ordered_done < args.links:
+        print("Out of budget, the graphs are not compared")
+        return
+    if full_edges != ordered_edges:
+        print("The graphs differ!")
+        sys.exit(1)
+    print("same %d links, %.1fx faster" % (len(ordered_edges), full_time / max(ordered_time, 1e-9)))
+
+# Seconds to import module in a fresh interpreter and the lazy modules it
+# imported
+def time_import(module, directory):
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    result = subprocess.run([sys.executable, "-c", import_script.format(module=module, lazy_modules=lazy_modules)],
+                            cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(1)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def time_help():
+    root = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(root, "crawl.py"), "--help"], capture_output=True, check=True)
+    return time.perf_counter() - start
+
+def benchmark_imports(args):
+    failed = False
+    # The modules write their logs and caches to the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "logs"))
+        for module in args.modules:
+            runs = [time_import(module, directory) for _ in range(args.repeat)]
+            best = min(elapsed for (elapsed, imported) in runs)
+            imported = runs[0][1]
+            print("%-14s %6.3fs" % (module, best) + ("  imports " + ", ".join(imported) if imported else ""))
+            if imported or (args.max_seconds is not None and best > args.max_seconds):
+                failed = True
+    print("%-14s %6.3fs" % ("crawl --help", min(time_help() for _ in range(args.repeat))))
+    if failed:
+        print("Import time regression")
+        sys.exit(1)
+
+# What CrawlCoordinator uses of the crawler, over a graph of a few pages
+class LeaseCrawler:
+    def __init__(self, pages):
+        from Classes import CrawlEdge, Graph, Request
+        graph = Graph()
+        graph.add(Request("ROOTREQ", "get"))
+        start = Request("http://127.0.0.1/", "get")
+        graph.add(start)
+        graph.data['urls'] = {}
+        graph.data['form_urls'] = {}
+        for page in range(pages):
+            url = "http://127.0.0.1/page" + str(page)
+            graph.add(Request(url, "get"))
+            graph.connect(start, Request(url, "get"), CrawlEdge("get", url, None, []))
+        self.graph = graph
+        self.crawl_stop = threading.Event()
+        self.start_time = time.time()
+        self.max_crawl_time = float("inf")
+        self.login_url = None
+        self.login_generation = 0
+        self.claimed = set()
+        self.results = {}
+
+    def candidate_edges(self, driver, graph):
+        return [edge for edge in graph.edges if not edge.visited]
+
+    def claim_edge(self, edge):
+        if edge.visited or id(edge) in self.claimed:
+            return False
+        self.claimed.add(id(edge))
+        return True
+
+    def release_edge(self, edge):
+        self.claimed.discard(id(edge))
+
+    def apply_remote_result(self, edge, result):
+        self.graph.visit_edge(edge)
+        self.results[self.graph.edge_position(edge)] = result
+
+# A worker process crawling with a stub follow. With held set it reports
+# the edge of its first lease there and keeps the lease until killed.
+def lease_worker(port, name, lease_seconds, held):
+    import distributed
+    distributed.lease_seconds = lease_seconds
+
+    class StubWorker(distributed.CrawlWorker):
+        def follow(self, unit):
+            if held is not None:
+                held.put(unit["edge_index"])
+                while True:
+                    time.sleep(1)
+            time.sleep(0.1)
+            return {"followed": True, "failed": False, "visited": True, "current_url": unit["start_url"],
+                    "values": {}, "findings": None, "worker": self.worker}
+
+    worker = StubWorker(types.SimpleNamespace(driver=types.SimpleNamespace()), "http://127.0.0.1:" + str(port))
+    worker.worker = name
+    with contextlib.redirect_stdout(io.StringIO()):
+        worker.run()
+
+# Coordinator with real worker processes, one of them is killed holding a lease
+def check_worker_processes(args, check):
+    import distributed
+    crawler = LeaseCrawler(6)
+    graph = crawler.graph
+    port = args.port + 1
+    with tempfile.TemporaryDirectory() as directory:
+        coordinator = distributed.CrawlCoordinator(crawler, "127.0.0.1", port, os.path.join(directory, "frontier.sqlite"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            coordinator.start(False)
+        held = multiprocessing.Queue()
+        victim = multiprocessing.Process(target=lease_worker, args=(port, "victim", args.lease_seconds, held), daemon=True)
+        workers = [multiprocessing.Process(target=lease_worker, args=(port, "worker-" + str(number), args.lease_seconds, None),
+                                           daemon=True) for number in range(2)]
+        try:
+            victim.start()
+            edge_index = held.get(timeout=30)
+            for worker in workers:
+                worker.start()
+            # Renewed while the victim lives
+            time.sleep(args.lease_seconds * 2)
+            check("a live worker keeps its lease", crawler.results.get(edge_index) is None and not graph.edges[edge_index].visited)
+            victim.kill()
+            victim.join()
+
+            deadline = time.time() + args.lease_seconds * 20 + 10
+            while not all(edge.visited for edge in graph.edges) and time.time() < deadline:
+                time.sleep(0.2)
+            result = crawler.results.get(edge_index) or {}
+            check("the edge of a killed worker is leased again and completed by another one",
+                  result.get("worker") in ["worker-0", "worker-1"])
+            check("every edge is completed once by the workers left",
+                  sorted(crawler.results) == list(range(len(graph.edges))) and not list(graph.failed_edges))
+            crawler.crawl_stop.set()
+            for worker in workers:
+                worker.join(args.lease_seconds * 5 + 10)
+            check("the workers stop when the crawl does", all(worker.exitcode == 0 for worker in workers))
+        finally:
+            crawler.crawl_stop.set()
+            for process in [victim] + workers:
+                if process.is_alive():
+                    process.kill()
+            coordinator.server.shutdown()
+            coordinator.server.server_close()
+
+def check_leases(args):
+    import distributed
+    from Classes import Form
+    distributed.lease_seconds = args.lease_seconds
+    distributed.max_lease_attempts = 2
+    crawler = LeaseCrawler(3)
+    graph = crawler.graph
+    failed = []
+
+    def check(name, ok):
+        print(("ok      " if ok else "FAILED  ") + name)
+        if not ok:
+            failed.append(name)
+
+    def worker(name):
+        w = distributed.CrawlWorker(crawler, "http://127.0.0.1:" + str(args.port))
+        w.worker = name
+        return w
+
+    form = Form()
+    form.action = "http://127.0.0.1/post"
+    form.method = "post"
+    form.add_input("text", "Name", "name", "", False)
+    form.add_input("checkbox", "Remember", "remember", "1", True)
+    findings = {"url_contexts": {}, "form_contexts": {form: {"dom_context": "<form>", "action_url": form.action}},
+                "ui_form_contexts": {}, "event_contexts": {}, "iframe_contexts": {},
+                "cookies": [], "current_url": "http://127.0.0.1/page0", "login": None}
+    result = {"followed": True, "failed": False, "visited": True, "current_url": "http://127.0.0.1/page0",
+              "values": {}, "findings": distributed.encode_findings(findings)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        coordinator = distributed.CrawlCoordinator(crawler, "127.0.0.1", args.port,
+                                                   os.path.join(directory, "frontier.sqlite"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            coordinator.start(False)
+        try:
+            dead = worker("dead")
+            live = worker("live")
+            lease = dead.call("lease", {})
+            path = distributed.decode_path(lease["path"])
+            check("the path travels as JSON", path[-1].n2.value.url == graph.edges[lease["edge_index"]].n2.value.url)
+            check("a leased edge is not handed out twice", live.call("lease", {})["edge_index"] != lease["edge_index"])
+
+            time.sleep(args.lease_seconds * 1.5)
+            again = live.call("lease", {})
+            check("an expired lease is handed out again", again["edge_index"] == lease["edge_index"])
+            check("the result of an expired lease is dropped",
+                  dead.call("result", {"edge_index": lease["edge_index"], "result": result}) is False)
+            check("the result of the new lease is kept",
+                  live.call("result", {"edge_index": again["edge_index"], "result": result}) is True)
+            merged = crawler.results.get(again["edge_index"], {}).get("findings") or {}
+            check("findings travel as JSON", list(merged.get("form_contexts", {})) == [form])
+
+            # Nobody finishes the next edge
+            edge = graph.edges[dead.call("lease", {})["edge_index"]]
+            for _ in range(distributed.max_lease_attempts):
+                time.sleep(args.lease_seconds * 1.5)
+                dead.call("lease", {})
+            check("an edge is given up after MAX_LEASE_ATTEMPTS expired leases",
+                  edge.visited and any(e is edge for e in graph.failed_edges))
+        finally:
+            crawler.crawl_stop.set()
+            coordinator.server.shutdown()
+            coordinator.server.server_close()
+    check_worker_processes(args, check)
+    if failed:
+        sys.exit(1)
+
+# Builds a crawl-like graph, changes it the way the crawler does and yields
+# (name, answer) after every step. Answers only hold positions and values,
+# so they can be compared between backends.
+def graph_operations(graph, pages):
+    from Classes import CrawlEdge, Request
+    operation = {"resource": "item", "operation": "create", "CRUD_type": "create"}
+
+    def positions(edges):
+        return [graph.edge_position(edge) for edge in edges]
+
+    def answers():
+        return {"lengths": (len(graph.nodes), len(graph.edges)),
+                "visited_edges": positions(graph.visited_edges),
+                "successful_edges": positions(graph.successful_edges),
+                "failed_edges": positions(graph.failed_edges),
+                "blocking_edges": positions(graph.blocking_edges),
+                "unvisited_edges": [index for (index, edge) in graph.unvisited_edges()],
+                "unvisited_counts": dict(graph.unvisited_counts()),
+                "visited nodes": [index for (index, node) in enumerate(graph.nodes) if node.visited],
+                "edge values": [(edge.value.method, edge.value.before_prompt, edge.value.success) for edge in graph.edges],
+                "node urls": [node.value.url for node in graph.nodes]}
+
+    root = Request("ROOTREQ", "get")
+    start = Request("http://127.0.0.1/", "get")
+    graph.add(root)
+    graph.add(start)
+    graph.connect(root, start, CrawlEdge("get", None, None, None))
+    parent = None
+    for page in range(pages):
+        url = "http://127.0.0.1/page" + str(page)
+        method = ["get", "form", "event"][page % 3]
+        request = Request(url, method)
+        graph.add(request)
+        # Parents form short chains, like the pages behind a few clicks
+        parent = graph.connect(start, request, CrawlEdge(method, url, operation if page % 7 == 0 else None, None),
+                               parent if page % 5 else None)[0]
+    del parent, request
+    yield "build", answers()
+
+    for (index, edge) in enumerate(graph.edges):
+        if index % 3 == 0:
+            graph.visit_edge(edge)
+        if index % 4 == 0:
+            edge.value.before_prompt = "prompt " + str(index)
+        if index % 11 == 0:
+            graph.visit_node(edge.n2.value)
+    yield "visit", answers()
+
+    for (index, edge) in enumerate(graph.edges):
+        if index % 6 == 0:
+            graph.unvisit_edge(edge)
+        if index % 7 == 0:
+            edge.value.after_resource_operation = operation
+            edge.value.success = True
+            graph.add_success(edge)
+        elif index % 13 == 0:
+            graph.add_failed(edge)
+        if index % 17 == 0:
+            graph.add_blocking(edge)
+    url = "http://127.0.0.1/page1"
+    node = graph.nodes[graph.find_node(graph.Node(Request(url, "form")))]
+    graph.set_url(node.value, url + "/")
+    del node
+    probes = [graph.Edge(graph.Node(start), graph.Node(Request("http://127.0.0.1/page" + str(page), method)),
+                         CrawlEdge(method, "http://127.0.0.1/page" + str(page), None, None))
+              for page in range(0, pages, max(1, pages // 20)) for method in ["get", "form", "event"]]
+    yield "flags", dict(answers(),
+                        find_edge=[graph.find_edge(edge) for edge in probes],
+                        is_successful=[graph.is_successful(edge) for edge in probes],
+                        edges_to=positions(graph.get_edges_to(Request(url + "/", "form"))),
+                        find_node=graph.find_node(graph.Node(Request(url + "/", "form"))))
+
+    # What Crawler.start does before attacking
+    for edge in graph.edges:
+        if edge.visited:
+            graph.unvisit_edge(edge)
+    yield "reset", answers()
+
+def check_graphs(args):
+    import gc
+    from Classes import Graph, SqliteGraph
+    failed = []
+
+    def check(name, ok):
+        print(("ok      " if ok else "FAILED  ") + name)
+        if not ok:
+            failed.append(name)
+
+    # Evicting writes flags set on the edges back, with everything loaded
+    # only the store keeps SqliteGraph in line
+    for cache_size in [args.cache_size, 2 * args.pages + 10]:
+        with tempfile.TemporaryDirectory() as directory:
+            graph = SqliteGraph(os.path.join(directory, "graph.sqlite"))
+            graph.cache_size = cache_size
+            graph.clear()
+            for ((name, expected), (_, answer)) in zip(graph_operations(Graph(), args.pages),
+                                                       graph_operations(graph, args.pages)):
+                differing = [key for key in expected if expected[key] != answer[key]]
+                check("%s with %d cached: %s" % (name, cache_size, ", ".join(differing) or "same answers"), not differing)
+            if cache_size < args.pages:
+                gc.collect()
+                # Besides the cached ones only the chains of parents they keep
+                loaded = len(graph.edges.live)
+                check("%d of %d edges loaded" % (loaded, len(graph.edges)), loaded <= cache_size * 5)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.benchmark == "cycles":
+        benchmark_cycles(args)
+    elif args.benchmark == "imports":
+        benchmark_imports(args)
+    elif args.benchmark == "leases":
+        check_leases(args)
+    elif args.benchmark == "graphs":
+        check_graphs(args)
@@ -0,0 +1,96 @@
+from selenium.common.exceptions import UnexpectedAlertPresentException
+from urllib.parse import urlparse
+import logging
+
+from extractors.Page import page_state
+from settle import wait_for_settle
+from snapshot_store import get_snapshot_store
+
+browser_state_stats = {"saved": 0, "restored": 0, "rejected": 0}
+
+def dump_storage(driver):
+    return driver.execute_script("""
+        function dump(storage) {
+            var items = {};
+            for (var i = 0; i < storage.length; i++) {
+                var key = storage.key(i);
+                items[key] = storage.getItem(key);
+            }
+            return items;
+        }
+        return [dump(window.localStorage), dump(window.sessionStorage)];""")
+
+def load_storage(driver, local_storage, session_storage):
+    driver.execute_script("""
+        function load(storage, items) {
+            storage.clear();
+            for (var key in items) {
+                storage.setItem(key, items[key]);
+            }
+        }
+        load(window.localStorage, arguments[0]);
+        load(window.sessionStorage, arguments[1]);""", local_storage, session_storage)
+
+# Cookies, web storage and URL of the browser at a graph node, with the
+# fingerprint of the page to check a restore against. Kept in the snapshot
+# store, the request only holds the digest.
+def save_browser_state(driver, request, fingerprint):
+    if not fingerprint:
+        return
+    try:
+        (local_storage, session_storage) = dump_storage(driver)
+        state = {"url": driver.current_url,
+                 "cookies": driver.get_cookies(),
+                 "local_storage": local_storage,
+                 "session_storage": session_storage,
+                 "fingerprint": fingerprint}
+    except UnexpectedAlertPresentException:
+        raise
+    except Exception as e:
+        logging.warning("Can't save browser state " + str(e).splitlines()[0])
+        return
+    request.browser_state = get_snapshot_store().put(state)
+    browser_state_stats["saved"] += 1
+
+# Puts the browser back into the state saved for request. Returns False when
+# there is none or the page does not match it, the caller replays instead.
+def restore_browser_state(driver, request):
+    digest = getattr(request, "browser_state", None)
+    if not digest:
+        return False
+    state = get_snapshot_store().get(digest)
+    if not state:
+        return False
+
+    try:
+        # Cookies and storage can only be set from a page of their origin
+        purl = urlparse(state["url"])
+        origin = purl.scheme + "://" + purl.netloc
+        if urlparse(driver.current_url).netloc != purl.netloc:
+            driver.get(origin)
+        driver.delete_all_cookies()
+        for cookie in state["cookies"]:
+            try:
+                driver.add_cookie(cookie)
+            except Exception as e:
+                logging.debug("Can't restore cookie " + str(cookie.get("name")) + " " + str(e).splitlines()[0])
+        load_storage(driver, state["local_storage"], state["session_storage"])
+
+        if "#" in state["url"]:
+            driver.get("http://localhost")
+        driver.get(state["url"])
+        wait_for_settle(driver, "restore state")
+        fingerprint = page_state(driver, None)["fingerprint"]
+    except Exception as e:
+        logging.warning("Can't restore browser state " + str(e).splitlines()[0])
+        browser_state_stats["rejected"] += 1
+        return False
+
+    if fingerprint != state["fingerprint"]:
+        logging.info("Restored state of " + state["url"] + " does not match, replaying instead")
+        browser_state_stats["rejected"] += 1
+        return False
+
+    logging.info("Restored browser state of " + state["url"])
+    browser_state_stats["restored"] += 1
+    return True
@@ -0,0 +1,189 @@
+import logging
+import os
+import pickle
+import time
+
+# Seconds between two checkpoints while crawling
+checkpoint_interval = float(os.getenv("CHECKPOINT_INTERVAL", 300))
+
+# Cheap change detection for nodes and edges. Their attributes are replaced
+# rather than mutated, except for the containers whose size is compared too.
+def state_signature(obj):
+    signature = []
+    for (key, value) in obj.__dict__.items():
+        size = len(value) if isinstance(value, (list, dict, set)) else None
+        signature.append((key, id(value), size))
+    return tuple(signature)
+
+class CheckpointPickler(pickle.Pickler):
+    def __init__(self, file, references, graph):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.references = references
+        self.graph = graph
+
+    # Nodes and edges of earlier segments, or of a persistent graph, are
+    # stored as references
+    def persistent_id(self, obj):
+        if self.graph.persistent:
+            return self.graph.reference(obj)
+        return self.references.get(id(obj))
+
+class CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, file, nodes, edges):
+        super().__init__(file)
+        self.nodes = nodes
+        self.edges = edges
+
+    def persistent_load(self, pid):
+        (kind, index) = pid
+        if kind == "node":
+            return self.nodes[index]
+        if kind == "request":
+            return self.nodes[index].value
+        if kind == "edge":
+            return self.edges[index]
+        raise pickle.UnpicklingError("Unknown checkpoint reference " + str(pid))
+
+# Crawl state saved to numbered segments in a directory.
+#
+# A segment pickles the graph nodes and edges added since the previous
+# segment, earlier ones are only referenced by index. Nodes and edges that
+# changed after they were written (visited flags, LLM analyses, pages) are
+# stored again as attribute updates. The rest of the state (graph metadata,
+# clusters, crawler bookkeeping, attack table) is small and rewritten in every
+# segment, the last one wins when loading. A persistent graph (SqliteGraph)
+# stores its nodes and edges itself, its segments only hold that state.
+class CrawlCheckpoint:
+    def __init__(self, path):
+        self.path = path
+        self.segment = 0
+        self.nodes_written = 0
+        self.edges_written = 0
+        self.references = {}
+        self.signatures = {}
+        self.last_save = time.time()
+
+    def segment_names(self):
+        if not self.path or not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path) if name.endswith(".pickle"))
+
+    def clear(self):
+        for name in self.segment_names():
+            os.remove(os.path.join(self.path, name))
+
+    def maybe_save(self, crawler):
+        if time.time() - self.last_save >= checkpoint_interval:
+            self.save(crawler)
+
+    def changed(self, key, obj):
+        signature = (obj.visited, state_signature(obj.value))
+        if self.signatures.get(key) == signature:
+            return False
+        self.signatures[key] = signature
+        return True
+
+    def remember(self, nodes, edges):
+        for (index, node) in enumerate(nodes):
+            self.references[id(node)] = ("node", index)
+            self.references[id(node.value)] = ("request", index)
+            self.changed(("node", index), node)
+        for (index, edge) in enumerate(edges):
+            self.references[id(edge)] = ("edge", index)
+            self.changed(("edge", index), edge)
+        self.nodes_written = len(nodes)
+        self.edges_written = len(edges)
+
+    def save(self, crawler):
+        if not self.path:
+            return
+        start = time.time()
+        self.last_save = start
+        graph = crawler.graph
+        nodes = []
+        edges = []
+        updates = []
+        if graph.persistent:
+            graph.flush()
+        else:
+            nodes = list(graph.nodes)
+            edges = list(graph.edges)
+            for index in range(self.nodes_written):
+                if self.changed(("node", index), nodes[index]):
+                    updates.append(("node", index, nodes[index].visited, nodes[index].value.__dict__))
+            for index in range(self.edges_written):
+                if self.changed(("edge", index), edges[index]):
+                    updates.append(("edge", index, edges[index].visited, edges[index].value.__dict__))
+
+        segment = {"nodes": nodes[self.nodes_written:],
+                   "edges": edges[self.edges_written:],
+                   "updates": updates,
+                   "persistent": graph.persistent,
+                   "state": crawler.checkpoint_state()}
+
+        name = "%06d.pickle" % self.segment
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            tmp_path = os.path.join(self.path, name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                CheckpointPickler(f, self.references, graph).dump(segment)
+            os.replace(tmp_path, os.path.join(self.path, name))
+        except Exception as e:
+            # Signatures were already updated, write everything again next time
+            logging.error("Can't write checkpoint " + str(e).splitlines()[0])
+            self.signatures = {}
+            return
+
+        self.segment += 1
+        if not graph.persistent:
+            self.remember(nodes, edges)
+        logging.info("Checkpoint %s: %d nodes, %d edges, %d updates in %.2fs" % (
+            name, len(segment["nodes"]), len(segment["edges"]), len(updates), time.time() - start))
+
+    # Restores the graph and returns the crawler state, None without checkpoint
+    def load(self, graph):
+        if graph.persistent:
+            (nodes, edges) = (graph.nodes, graph.edges)
+        else:
+            (nodes, edges) = ([], [])
+        state = None
+        names = self.segment_names()
+        for (position, name) in enumerate(names):
+            try:
+                with open(os.path.join(self.path, name), "rb") as f:
+                    segment = CheckpointUnpickler(f, nodes, edges).load()
+            except Exception as e:
+                logging.error("Can't read checkpoint " + name + " " + str(e).splitlines()[0])
+                # Later segments reference what was lost
+                for later in names[position:]:
+                    os.remove(os.path.join(self.path, later))
+                break
+            if segment.get("persistent", False) != graph.persistent:
+                logging.error("Checkpoint " + name + " was written with another GRAPH_BACKEND")
+                return None
+            if graph.persistent:
+                state = segment["state"]
+                self.segment += 1
+                continue
+            nodes.extend(segment["nodes"])
+            edges.extend(segment["edges"])
+            for (kind, index, visited, attributes) in segment["updates"]:
+                target = nodes[index] if kind == "node" else edges[index]
+                target.visited = visited
+                target.value.__dict__.update(attributes)
+            state = segment["state"]
+            self.segment += 1
+
+        if state is None or len(nodes) == 0:
+            return None
+        if graph.persistent:
+            logging.info("Resuming with %d nodes and %d edges from the graph store" % (len(nodes), len(edges)))
+            return state
+
+        graph.nodes = nodes
+        graph.edges = edges
+        graph.rebuild_index()
+        self.remember(nodes, edges)
+        logging.info("Loaded checkpoint with %d nodes and %d edges" % (len(nodes), len(edges)))
+        return state
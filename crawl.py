@@ -1,24 +1,103 @@
 import multiprocessing
 import argparse
-
-from Classes import *
-from Functions import add_script
-
-from selenium.webdriver.remote.webdriver import WebDriver
-from seleniumwire import webdriver
-
-from llm_analysis import run_llm_analysis
+import asyncio
+import os
+import threading
 
 parser = argparse.ArgumentParser(description='Crawler')
 parser.add_argument("--debug", action='store_true',
                     help="Dont use path deconstruction and recon scan. Good for testing single URL")
 parser.add_argument("--url", help="Custom URL to crawl")
+parser.add_argument("--resume", action='store_true',
+                    help="Continue the crawl from the last checkpoint")
+parser.add_argument("--capture", choices=["selenium-wire", "cdp"], default="selenium-wire",
+                    help="Record traffic through the selenium-wire proxy or from Chrome DevTools network events")
+parser.add_argument("--coordinator", metavar="HOST:PORT",
+                    help="Also hand out edges to remote crawl workers on this address")
+parser.add_argument("--worker", metavar="URL",
+                    help="Crawl the edges handed out by the coordinator at URL, e.g. http://127.0.0.1:8765")
 args = parser.parse_args()
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Only imported once the arguments are fine, --help does not wait for them
+from Classes import Crawler
+from Functions import add_script
+from llm_manager import get_tokenizer
+
+from selenium.webdriver import ChromeOptions
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from llm_analysis import run_llm_analysis
+from traffic import CdpChrome
+from distributed import CrawlCoordinator, CrawlWorker
+
+# Chrome with the crawler scripts injected, also used for the extra attack browsers
+def create_driver():
+    chrome_options = ChromeOptions()
+    chrome_options.add_argument("--disable-pre-commit-input")
+    chrome_options.add_argument("--disable-features=AllowPreCommitInput")
+    chrome_options.add_argument("--disable-xss-auditor")
+    chrome_options.add_argument("--disable-ipc-flooding-protection")
+    chrome_options.add_argument("--no-experiments")
+    chrome_options.add_argument("--disable-bundled-ppapi-flash")
+    chrome_options.add_argument("--disable-plugins-discovery")
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_argument('--ignore-certificate-errors')
+    # chrome_options.add_argument('--headless')
+    chrome_options.add_argument("--no-sandbox")
+
+    if args.capture == "cdp":
+        # Network events end up in the performance log, no proxy in between
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        driver = CdpChrome(options=chrome_options)
+    else:
+        # The proxy pulls in a lot, the cdp capture does not need it
+        from seleniumwire import webdriver
+        driver = webdriver.Chrome(options=chrome_options)
+
+    # chrome_options.add_argument("--disable-dev-shm-usage")
+    #
+    # try:
+    #     # 使用配置好的 options 初始化 driver
+    #     driver = webdriver.Chrome(options=chrome_options)
+    #
+    #     # ... 您的爬虫代码 ...
+    #     print("浏览器启动成功！")
+    #     # driver.get(...)
+    #
+    # finally:
+    #     if 'driver' in locals() and driver:
+    #         driver.quit()
+
+    # Read scripts and add script which will be executed when the page starts loading
+    ## JS libraries from JaK crawler, with minor improvements
+    driver.add_script(open("js/lib.js", "r").read())
+    driver.add_script(open("js/page_extractor.js", "r").read())
+    driver.add_script(open("js/property_obs.js", "r", encoding='utf-8').read())
+    driver.add_script(open("js/md5.js", "r").read())
+    driver.add_script(open("js/addeventlistener_wrapper.js", "r").read())
+    driver.add_script(open("js/timing_wrapper.js", "r").read())
+    driver.add_script(open("js/settle.js", "r").read())
+    driver.add_script(open("js/window_wrapper.js", "r").read())
+    # Black Widow additions
+    driver.add_script(open("js/forms.js", "r").read())
+    driver.add_script(open("js/xss_xhr.js", "r").read())
+    driver.add_script(open("js/remove_alerts.js", "r").read())
+    return driver
+
 def main():
-    if args.url:
+    if args.url and args.worker:
+        WebDriver.add_script = add_script
+
+        driver = create_driver()
+        crawler = Crawler(driver, args.url, None, None, None, None, create_driver)
+        try:
+            CrawlWorker(crawler, args.worker).run()
+        finally:
+            driver.quit()
+
+    elif args.url:
         request_queue = multiprocessing.Queue()
         analysis_queue = multiprocessing.Queue()
         condition_signal = multiprocessing.Event()
@@ -28,6 +107,8 @@ def main():
 
         llm_process = multiprocessing.Process(target=run_llm_analysis, args=(request_queue, analysis_queue, condition_signal, still_crawling_signal))
         llm_process.start()
+        # Load the tokenizer while the browser starts, after the fork
+        threading.Thread(target=get_tokenizer, daemon=True).start()
 
         root_dir_name = os.path.dirname(__file__)
         dynamic_path = os.path.join(root_dir_name, 'form_files', 'dynamic')
@@ -36,54 +117,16 @@ def main():
 
         WebDriver.add_script = add_script
 
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_argument("--disable-pre-commit-input")
-        chrome_options.add_argument("--disable-features=AllowPreCommitInput")
-        chrome_options.add_argument("--disable-xss-auditor")
-        chrome_options.add_argument("--disable-ipc-flooding-protection")
-        chrome_options.add_argument("--no-experiments")
-        chrome_options.add_argument("--disable-bundled-ppapi-flash")
-        chrome_options.add_argument("--disable-plugins-discovery")
-        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-        chrome_options.add_argument('--ignore-certificate-errors')
-        # chrome_options.add_argument('--headless')
-        chrome_options.add_argument("--no-sandbox")
-
-        driver = webdriver.Chrome(options=chrome_options)
-
-        # chrome_options.add_argument("--disable-dev-shm-usage")
-        #
-        # try:
-        #     # 使用配置好的 options 初始化 driver
-        #     driver = webdriver.Chrome(options=chrome_options)
-        #
-        #     # ... 您的爬虫代码 ...
-        #     print("浏览器启动成功！")
-        #     # driver.get(...)
-        #
-        # finally:
-        #     if 'driver' in locals() and driver:
-        #         driver.quit()
-
-
-
-        # Read scripts and add script which will be executed when the page starts loading
-        ## JS libraries from JaK crawler, with minor improvements
-        driver.add_script(open("js/lib.js", "r").read())
-        driver.add_script(open("js/property_obs.js", "r", encoding='utf-8').read())
-        driver.add_script(open("js/md5.js", "r").read())
-        driver.add_script(open("js/addeventlistener_wrapper.js", "r").read())
-        driver.add_script(open("js/timing_wrapper.js", "r").read())
-        driver.add_script(open("js/window_wrapper.js", "r").read())
-        # Black Widow additions
-        driver.add_script(open("js/forms.js", "r").read())
-        driver.add_script(open("js/xss_xhr.js", "r").read())
-        driver.add_script(open("js/remove_alerts.js", "r").read())
+        driver = create_driver()
 
         url = args.url
-        crawler = Crawler(driver, url, request_queue, analysis_queue, condition_signal, still_crawling_signal)
+        crawler = Crawler(driver, url, request_queue, analysis_queue, condition_signal, still_crawling_signal, create_driver)
+        if args.coordinator:
+            (host, port) = args.coordinator.rsplit(":", 1)
+            crawler.coordinator = CrawlCoordinator(crawler, host, int(port),
+                                                   os.getenv("FRONTIER_PATH", os.path.join(os.getcwd(), "cache", "frontier.sqlite")))
 
-        asyncio.get_event_loop().run_until_complete(crawler.start(args.debug))
+        asyncio.get_event_loop().run_until_complete(crawler.start(args.debug, args.resume))
 
     else:
         print("Please use --url")
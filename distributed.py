@@ -0,0 +1,392 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request as HttpRequest, urlopen
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from Classes import CrawlEdge, Event, Form, Graph, Iframe, Request, Ui_form, bcolors
+from Functions import check_edge, follow_edge, rec_find_path
+
+# A remote worker has to renew its lease within this many seconds, or its
+# edge goes to the next worker asking
+lease_seconds = float(os.getenv("LEASE_SECONDS", 120))
+# Edges whose lease expired this often are given up on
+max_lease_attempts = int(os.getenv("MAX_LEASE_ATTEMPTS", 3))
+# Shared secret between coordinator and workers, required unless the
+# coordinator only listens on loopback
+coordinator_token = os.getenv("COORDINATOR_TOKEN", "")
+
+# Page attributes of CrawlEdge a worker sends back
+edge_snapshot_names = ["before_context", "before_page", "after_context", "after_page", "request_datas"]
+
+# Which graph edges are leased to which remote worker, kept in SQLite so the
+# assignments survive a coordinator restart (--resume).
+class Frontier:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS frontier (
+            edge_index INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS frontier_lease ON frontier (state, lease_expires)")
+        self.connection.commit()
+
+    def execute(self, query, parameters=()):
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            self.connection.commit()
+            return cursor
+
+    def clear(self):
+        self.execute("DELETE FROM frontier")
+
+    # The workers of the previous run are gone
+    def requeue(self):
+        self.execute("UPDATE frontier SET state='pending', worker=NULL, lease_expires=NULL WHERE state='leased'")
+
+    def lease(self, edge_index, worker):
+        self.execute("INSERT OR IGNORE INTO frontier (edge_index, state) VALUES (?, 'pending')", (edge_index,))
+        cursor = self.execute(
+            "UPDATE frontier SET state='leased', worker=?, lease_expires=? WHERE edge_index=? AND state!='leased'",
+            (worker, time.time() + lease_seconds, edge_index))
+        return cursor.rowcount == 1
+
+    def renew(self, edge_index, worker):
+        cursor = self.execute(
+            "UPDATE frontier SET lease_expires=? WHERE edge_index=? AND worker=? AND state='leased'",
+            (time.time() + lease_seconds, edge_index, worker))
+        return cursor.rowcount == 1
+
+    # False when the lease expired and the edge went to someone else
+    def complete(self, edge_index, worker):
+        cursor = self.execute(
+            "UPDATE frontier SET state='done', worker=NULL, lease_expires=NULL WHERE edge_index=? AND worker=? AND state='leased'",
+            (edge_index, worker))
+        return cursor.rowcount == 1
+
+    # Puts expired leases back, returns (edge index, worker, attempts) of each
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT edge_index, worker, attempts + 1 FROM frontier WHERE state='leased' AND lease_expires < ?",
+                (now,)).fetchall()
+            self.connection.execute(
+                "UPDATE frontier SET state='pending', worker=NULL, lease_expires=NULL, attempts=attempts + 1 WHERE state='leased' AND lease_expires < ?",
+                (now,))
+            self.connection.commit()
+        return rows
+
+    def leased(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT edge_index FROM frontier WHERE state='leased'")]
+
+# Messages are JSON, the values of the graph travel as plain dicts and are
+# rebuilt on the other side
+value_classes = {"Request": Request, "Form": Form, "Event": Event, "Iframe": Iframe, "Ui_form": Ui_form}
+element_classes = {"Element": Form.Element, "SubmitElement": Form.SubmitElement, "RadioElement": Form.RadioElement,
+                   "SelectElement": Form.SelectElement, "CheckboxElement": Form.CheckboxElement}
+finding_names = ["url_contexts", "form_contexts", "ui_form_contexts", "event_contexts", "iframe_contexts"]
+
+def encode_object(value, classes):
+    name = type(value).__name__
+    if classes.get(name) is not type(value):
+        # URLs, javascript and None are sent as they are
+        return value
+    fields = dict(vars(value))
+    if name == "Form":
+        fields["inputs"] = [[encode_object(key, element_classes), encode_object(element, element_classes)]
+                            for (key, element) in value.inputs.items()]
+    elif name == "Request":
+        # Saved browser states only exist on the coordinator
+        fields["browser_state"] = None
+    return {"class": name, "fields": fields}
+
+def decode_object(data, classes):
+    if not isinstance(data, dict) or "class" not in data:
+        return data
+    cls = classes[data["class"]]
+    value = cls.__new__(cls)
+    value.__dict__.update(data["fields"])
+    if cls is Form:
+        value.inputs = {decode_object(key, element_classes): decode_object(element, element_classes)
+                        for (key, element) in data["fields"]["inputs"]}
+    return value
+
+def encode_value(value):
+    return encode_object(value, value_classes)
+
+def decode_value(data):
+    return decode_object(data, value_classes)
+
+# The path edges without their pages, all find_state needs
+def encode_path(path):
+    return [{"method": edge.value.method,
+             "method_data": encode_value(edge.value.method_data),
+             "cookies": edge.value.cookies,
+             "before_resource_operation": edge.value.before_resource_operation,
+             "after_resource_operation": edge.value.after_resource_operation,
+             "success": edge.value.success,
+             "from": encode_value(edge.n1.value),
+             "to": encode_value(edge.n2.value)} for edge in path]
+
+def decode_path(steps):
+    path = []
+    parent = None
+    for step in steps:
+        value = CrawlEdge(step["method"], decode_value(step["method_data"]), step["before_resource_operation"],
+                          step["cookies"], step["after_resource_operation"])
+        value.success = step["success"]
+        edge = Graph.Edge(Graph.Node(decode_value(step["from"])), Graph.Node(decode_value(step["to"])), value, parent)
+        path.append(edge)
+        parent = edge
+    return path
+
+# The dicts of extract_findings are keyed by the found values
+def encode_findings(findings):
+    encoded = dict(findings)
+    for name in finding_names:
+        encoded[name] = [[encode_value(value), context] for (value, context) in findings[name].items()]
+    return encoded
+
+def decode_findings(data):
+    findings = dict(data)
+    for name in finding_names:
+        findings[name] = {decode_value(value): context for (value, context) in data[name]}
+    return findings
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+# The part of the crawl graph follow_edge looks at on a worker
+def scratch_graph(start_url):
+    graph = Graph()
+    graph.add(Request("ROOTREQ", "get"))
+    graph.add(Request(start_url, "get"))
+    graph.data['urls'] = {}
+    graph.data['form_urls'] = {}
+    return graph
+
+def coordinator_handler(coordinator):
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            token = self.headers.get("X-Coordinator-Token", "")
+            if coordinator_token and not hmac.compare_digest(token.encode(), coordinator_token.encode()):
+                self.send_error(403)
+                return
+            try:
+                message = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if self.path == "/lease":
+                    answer = coordinator.lease(message["worker"])
+                elif self.path == "/renew":
+                    answer = coordinator.frontier.renew(message["edge_index"], message["worker"])
+                elif self.path == "/result":
+                    answer = coordinator.complete(message["worker"], message["edge_index"], message["result"])
+                else:
+                    self.send_error(404)
+                    return
+            except Exception as e:
+                logging.error("Coordinator request " + self.path + " failed " + str(e).splitlines()[0])
+                self.send_error(500)
+                return
+            body = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Coordinator " + format % args)
+
+    return CoordinatorHandler
+
+# Serves the edges of the crawler's graph to remote CrawlWorkers over HTTP.
+#
+# The crawler keeps crawling with its own browsers, remote workers get the
+# same candidates through lease(). A lease has to be renewed while the
+# worker follows the edge. Leases of dead workers expire and their edges are
+# handed out again, up to MAX_LEASE_ATTEMPTS times.
+class CrawlCoordinator:
+    def __init__(self, crawler, host, port, path):
+        if not coordinator_token and not is_loopback(host):
+            raise Exception("Set COORDINATOR_TOKEN to let remote workers reach the coordinator on " + host)
+        self.crawler = crawler
+        self.address = (host, port)
+        self.frontier = Frontier(path)
+        self.server = None
+        self.leasing = False
+
+    def start(self, resumed):
+        if resumed:
+            self.frontier.requeue()
+        else:
+            self.frontier.clear()
+        self.server = ThreadingHTTPServer(self.address, coordinator_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.leasing = True
+        print(bcolors.OKGREEN+"Coordinator listening on "+self.address[0]+":"+str(self.address[1])+bcolors.ENDC)
+        logging.info("Coordinator listening on " + self.address[0] + ":" + str(self.address[1]))
+
+    # Stops handing out edges and waits for the leased ones
+    def stop(self):
+        self.leasing = False
+        deadline = time.time() + lease_seconds
+        while self.frontier.leased() and time.time() < deadline:
+            self.expire_leases()
+            time.sleep(1)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_leases(self):
+        graph = self.crawler.graph
+        for (edge_index, worker, attempts) in self.frontier.expire():
+            edge = graph.edges[edge_index]
+            logging.warning("Lease of edge " + str(edge_index) + " expired on " + str(worker))
+            self.crawler.release_edge(edge)
+            if attempts >= max_lease_attempts:
+                logging.warning("Giving up on edge " + str(edge))
+                graph.add_failed(edge)
+                graph.visit_edge(edge)
+
+    def lease(self, worker):
+        crawler = self.crawler
+        if not self.leasing or crawler.crawl_stop.is_set() or time.time() - crawler.start_time > crawler.max_crawl_time:
+            return {"done": True}
+        self.expire_leases()
+
+        graph = crawler.graph
+        for edge in crawler.candidate_edges(None, graph):
+            if not crawler.claim_edge(edge):
+                continue
+            edge_index = graph.edge_position(edge)
+            if not check_edge(None, graph, edge):
+                logging.warning("Check_edge failed for " + str(edge))
+                graph.visit_edge(edge)
+                crawler.release_edge(edge)
+                continue
+            if not self.frontier.lease(edge_index, worker):
+                crawler.release_edge(edge)
+                continue
+            logging.info("Leased edge " + str(edge_index) + " to " + worker)
+            with graph.lock:
+                path = encode_path(rec_find_path(graph, edge))
+            return {"edge_index": edge_index,
+                    "path": path,
+                    "start_url": graph.nodes[1].value.url,
+                    "login_url": crawler.login_url,
+                    "login_generation": crawler.login_generation}
+        return {"wait": 1.0}
+
+    def complete(self, worker, edge_index, result):
+        edge = self.crawler.graph.edges[edge_index]
+        if not self.frontier.complete(edge_index, worker):
+            logging.warning("Dropping result of " + worker + " for edge " + str(edge_index) + ", lease expired")
+            return False
+        try:
+            if result["findings"]:
+                result["findings"] = decode_findings(result["findings"])
+            self.crawler.apply_remote_result(edge, result)
+        finally:
+            self.crawler.release_edge(edge)
+        return True
+
+# Crawls the edges a CrawlCoordinator hands out, with the browser and the
+# extraction of a local Crawler whose own graph stays unused.
+class CrawlWorker:
+    def __init__(self, crawler, coordinator_url):
+        self.crawler = crawler
+        self.coordinator_url = coordinator_url.rstrip("/")
+        self.worker = socket.gethostname() + "-" + str(os.getpid())
+        self.max_failures = int(os.getenv("WORKER_MAX_FAILURES", 12))
+
+    def call(self, name, message):
+        message["worker"] = self.worker
+        request = HttpRequest(self.coordinator_url + "/" + name,
+                              data=json.dumps(message).encode(),
+                              headers={"Content-Type": "application/json",
+                                       "X-Coordinator-Token": coordinator_token})
+        with urlopen(request, timeout=60) as response:
+            return json.loads(response.read())
+
+    def keep_lease(self, edge_index, done):
+        while not done.wait(lease_seconds / 3):
+            try:
+                if not self.call("renew", {"edge_index": edge_index}):
+                    logging.warning("Lost the lease of edge " + str(edge_index))
+                    return
+            except Exception as e:
+                logging.warning("Can't renew lease " + str(e).splitlines()[0])
+
+    def run(self):
+        self.crawler.driver.login_generation = 0
+        failures = 0
+        while failures < self.max_failures:
+            try:
+                unit = self.call("lease", {})
+            except Exception as e:
+                failures += 1
+                logging.warning("Coordinator unreachable " + str(e).splitlines()[0])
+                time.sleep(5)
+                continue
+            failures = 0
+            if unit.get("done"):
+                break
+            if "wait" in unit:
+                time.sleep(unit["wait"])
+                continue
+
+            done = threading.Event()
+            threading.Thread(target=self.keep_lease, args=(unit["edge_index"], done), daemon=True).start()
+            try:
+                result = self.follow(unit)
+            finally:
+                done.set()
+            try:
+                self.call("result", {"edge_index": unit["edge_index"], "result": result})
+            except Exception as e:
+                logging.error("Can't send result of edge " + str(unit["edge_index"]) + " " + str(e).splitlines()[0])
+
+        print(bcolors.OKGREEN+"Worker done"+bcolors.ENDC)
+        logging.info("Worker done")
+
+    def follow(self, unit):
+        crawler = self.crawler
+        driver = crawler.driver
+        if unit["login_generation"] > driver.login_generation:
+            driver.login_generation = unit["login_generation"]
+            crawler.login_url = unit["login_url"]
+            crawler.login_browser(driver)
+
+        graph = scratch_graph(unit["start_url"])
+        edge = decode_path(unit["path"])[-1]
+        print(bcolors.OKGREEN+"Remote crawl (edge): "+str(edge)+bcolors.ENDC)
+        result = {"followed": False, "current_url": None, "findings": None}
+        try:
+            result["followed"] = bool(follow_edge(driver, graph, edge, True))
+            if result["followed"]:
+                result["current_url"] = driver.current_url
+                result["findings"] = encode_findings(crawler.extract_findings(driver, graph, edge, edge.n2.value))
+        except Exception as e:
+            logging.error("Can't crawl edge " + str(edge) + " " + str(e).splitlines()[0])
+        result["failed"] = any(failed is edge for failed in graph.failed_edges)
+        result["visited"] = edge.visited
+        result["values"] = {name: getattr(edge.value, "get_" + name)() for name in edge_snapshot_names}
+        return result
@@ -8,7 +8,6 @@ from selenium.webdriver.common.by import By
 import json
 import pprint
 import datetime
-import tldextract
 import math
 import os
 import traceback
@@ -19,164 +18,26 @@ import copy
 import time
 
 import Classes
+from extractors.Page import extract_page
 
 
-def extract_data_toggle(driver):
-    toggles = driver.find_elements(By.XPATH, "//button[@data-toggle]")
-    dos = []
-    for toggle in toggles:
-        parent = driver.execute_script("return arguments[0].parentNode;", toggle)
-        siblings = driver.execute_script("""
-            var siblings = [];
-            var sibling = arguments[0].parentNode.firstChild;
-            var sibling_count = 0;
-            while (sibling && sibling_count < 10) {
-                if (sibling.nodeType === 1 && sibling !== arguments[0]) {
-                    siblings.push(sibling);
-                }
-                sibling = sibling.nextSibling;
-                sibling_count++;
-            }
-            return siblings;
-        """, toggle)
+def extract_events(driver, page=None):
+    if page is None:
+        page = extract_page(driver)
 
-        xpath = driver.execute_script("return getXPath(arguments[0])", toggle)
-        url = driver.current_url
+    section = page.get('events') or {}
 
-        do = {
-            'function_id': '',
-            'event': 'click',
-            'id': toggle.get_attribute('id'),
-            'tag': 'button',
-            'addr': xpath,
-            'class': toggle.get_attribute('class'),
-            'dom_context': {
-                'current_node': driver.execute_script("return arguments[0].outerHTML;", toggle),
-                'parent_node': driver.execute_script("return arguments[0].outerHTML;", parent),
-                'sibling_nodes': [driver.execute_script("return arguments[0].outerHTML;", s) for s in siblings],
-                'page_title': driver.title
-            },
-            'url': url,
-            'is_visible': toggle.is_displayed()
-        }
-        dos.append(do)
-
-    return dos
-
-
-def extract_inputs(driver):
-    inputs = driver.find_elements(By.XPATH, "//input | //textarea")
-    dos = []
-    for input_elem in inputs:
-        input_type = input_elem.get_attribute("type")
-        if (not input_type) or input_type == "text":
-            in_form = input_elem.find_elements(By.XPATH, ".//ancestor::form")
-            if in_form:
-                continue
-            parent = driver.execute_script("return arguments[0].parentNode;", input_elem)
-            siblings = driver.execute_script("""
-                var siblings = [];
-                var sibling = arguments[0].parentNode.firstChild;
-                var sibling_count = 0;
-                while (sibling && sibling_count < 10) {
-                    if (sibling.nodeType === 1 && sibling !== arguments[0]) {
-                        siblings.push(sibling);
-                    }
-                    sibling = sibling.nextSibling;
-                    sibling_count++;
-                }
-                return siblings;
-            """, input_elem)
-
-            xpath = driver.execute_script("return getXPath(arguments[0])", input_elem)
-            url = driver.current_url
-
-            do = {
-                'function_id': '',
-                'event': 'input',
-                'id': input_elem.get_attribute('id'),
-                'tag': 'input',
-                'addr': xpath,
-                'class': input_elem.get_attribute('class'),
-                'dom_context': {
-                    'current_node': driver.execute_script("return arguments[0].outerHTML;", input_elem),
-                    'parent_node': driver.execute_script("return arguments[0].outerHTML;", parent),
-                    'sibling_nodes': [driver.execute_script("return arguments[0].outerHTML;", s) for s in siblings],
-                    'page_title': driver.title
-                },
-                'url': url,
-                'is_visible': input_elem.is_displayed()
-            }
-            dos.append(do)
-
-    return dos
-
-
-def extract_fake_buttons(driver):
-    fake_buttons = driver.find_elements(By.CLASS_NAME, "btn")
-    dos = []
-    for button in fake_buttons:
-        parent = driver.execute_script("return arguments[0].parentNode;", button)
-        siblings = driver.execute_script("""
-            var siblings = [];
-            var sibling = arguments[0].parentNode.firstChild;
-            var sibling_count = 0;
-            while (sibling && sibling_count < 10) {
-                if (sibling.nodeType === 1 && sibling !== arguments[0]) {
-                    siblings.push(sibling);
-                }
-                sibling = sibling.nextSibling;
-                sibling_count++;
-            }
-            return siblings;
-        """, button)
-
-        xpath = driver.execute_script("return getXPath(arguments[0])", button)
-        url = driver.current_url
-
-        do = {
-            'function_id': '',
-            'event': 'click',
-            'id': button.get_attribute('id'),
-            'tag': 'a',
-            'addr': xpath,
-            'class': button.get_attribute('class'),
-            'dom_context': {
-                'current_node': driver.execute_script("return arguments[0].outerHTML;", button),
-                'parent_node': driver.execute_script("return arguments[0].outerHTML;", parent),
-                'sibling_nodes': [driver.execute_script("return arguments[0].outerHTML;", s) for s in siblings],
-                'page_title': driver.title
-            },
-            'url': url,
-            'is_visible': button.is_displayed()
-        }
-        dos.append(do)
-
-    return dos
-
-def extract_events(driver):
-    try:
-    # Use JavaScript to find events
-        resps = driver.execute_script("return catch_properties()")
-        todo = json.loads(resps)
-    except Exception as e:
-        logging.warning("Failed to extract events: %s" % str(e))
+    # From JavaScript properties
+    todo = section.get('properties')
+    if todo is None:
+        logging.warning("Failed to extract events from properties")
         todo = []
 
     # From event listeners
-    resps = driver.execute_script("return JSON.stringify(added_events)")
-    todo += json.loads(resps)
+    todo += section.get('added_events', [])
 
-    # From data-toggle
-    resps = extract_data_toggle(driver)
-    todo += resps
-
-    # From fake buttons class="btn"
-    resps = extract_fake_buttons(driver)
-    todo += resps
-
-    resps = extract_inputs(driver)
-    todo += resps
+    # From data-toggle, fake buttons class="btn" and free inputs
+    todo += section.get('targets', [])
 
     events = set()
     event_contexts = {}
@@ -196,5 +57,3 @@ def extract_events(driver):
         }
 
     return events, event_contexts
-
-
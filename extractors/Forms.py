@@ -11,7 +11,6 @@ from selenium.webdriver.common.keys import Keys
 import json
 import pprint
 import datetime
-import tldextract
 import math
 import os
 import traceback
@@ -23,238 +22,158 @@ import time
 
 import Classes
 
-from tools import get_accessible_name
+from tools import get_accessible_name, resolve_accessible_name
+from extractors.Page import extract_page
 
 
-def get_element_text(driver, element):
-    return driver.execute_script("return arguments[0].textContent;", element).strip()
-
-def extract_dom_context(el, driver):
-    dom_context = {
-        "current_node": {
-            "tag_name": el.tag_name,
-            "attributes": el.get_attribute('outerHTML'),
-            "text": get_element_text(driver, el),
-        },
-        "parent_node": {},
-        "sibling_nodes": [],
-        "page_title": driver.title
-    }
-
-    try:
-        parent = el.find_element(By.XPATH, '..')
-        dom_context["parent_node"] = {
-            "tag_name": parent.tag_name,
-            "attributes": parent.get_attribute('outerHTML'),
-            "text": get_element_text(driver, parent)
-        }
-    except:
-        dom_context["parent_node"] = {}
-
-    try:
-        siblings = el.find_elements(By.XPATH, '../*')
-        siblings = siblings[:10]
-        for sibling in siblings:
-            if sibling != el:
-                dom_context["sibling_nodes"].append({
-                    "tag_name": sibling.tag_name,
-                    "attributes": sibling.get_attribute('outerHTML'),
-                    "text": get_element_text(driver, sibling)
-                })
-    except:
-        dom_context["sibling_nodes"] = []
-    return dom_context
-
-def parse_form(el, driver):
+def decode_form(form_data, driver):
     form = Classes.Form()
 
-    form.html = el.get_attribute("outerHTML")
+    form.html = form_data['html']
 
-    try:
-        if el.get_attribute("action"):
-            form.action = el.get_attribute("action")
-            if el.get_attribute("method"):
-                form.method = el.get_attribute("method")
-            else:
-                form.method = "get"
+    if form_data['action']:
+        form.action = form_data['action']
+        if form_data['method']:
+            form.method = form_data['method']
+        else:
+            form.method = "get"
 
-    except StaleElementReferenceException as e:
-        logging.error("Stale pasta in from action")
-        # logging.error(traceback.format_exc())
-    except:
-        logging.error("Failed to write element")
-        # logging.error(traceback.format_exc())
+    if not form_data['inputs']:
+        logging.warning("No inputs founds during parse")
 
     # <input> tags
-    try:
-        inputs = el.find_elements(By.TAG_NAME, "input")
-    except StaleElementReferenceException as e:
-        print("Stale pasta in inputs")
-        logging.error("Stale pasta in inputs")
-        inputs = None
-    except:
-        logging.error("Unknown exception in inputs")
-        inputs = None
-
-    if not inputs:
-        # TODO Exapnd JavaScript for all types of elements
-        inputs = []
-        logging.warning("No inputs founds during parse, falling back to JavaScript")
-        resps = driver.execute_script("return get_forms()")
-        js_forms = json.loads(resps)
-        for js_form in js_forms:
-            current_form = Classes.Form()
-            current_form.method = js_form['method']
-            current_form.action = js_form['action']
-            logging.info("Found js form: " + str(current_form) )
-
-            if current_form.method == form.method and current_form.action == form.action:
-                for js_el in js_form['elements']:
-                    web_el = driver.find_element(By.XPATH, js_el['xpath'])
-                    inputs.append(web_el)
-                break
-
-    for iel in inputs:
-        # accessible_name
+    for iel in form_data['inputs']:
         tmp = {'type': None, 'accessible_name': None, 'name': None, 'value': None, 'checked': None}
         try:
-            accessible_name = get_accessible_name(driver, iel)
-            if iel.get_attribute("type"):
-                tmp['type'] = iel.get_attribute("type")
+            accessible_name = resolve_accessible_name(driver, iel)
+            if iel['type']:
+                tmp['type'] = iel['type']
             if accessible_name:
                 tmp['accessible_name'] = accessible_name
-            if iel.get_attribute("name"):
-                tmp['name'] = iel.get_attribute("name")
-            if iel.get_attribute("value"):
-                tmp['value'] = iel.get_attribute("value")
-            if iel.get_attribute("checked"):
+            if iel['name']:
+                tmp['name'] = iel['name']
+            if iel['value']:
+                tmp['value'] = iel['value']
+            if iel['checked']:
                 tmp['checked'] = True
-            if iel.aria_role and iel.aria_role == "combobox":
+            if iel['role'] == "combobox":
                 try:
-                    iel.click()
+                    web_el = driver.find_element(By.XPATH, iel['xpath'])
+                    web_el.click()
                     time.sleep(0.1)
                     driver.switch_to.active_element.send_keys(Keys.ENTER)
-                    tmp['value'] = iel.get_attribute("value")
+                    tmp['value'] = web_el.get_attribute("value")
                 except Exception as e:
                     logging.warning(f"Failed to extract value from combobox: {str(e)}")
-
-        except StaleElementReferenceException as e:
-            print("Stale pasta in from action")
         except:
             print("Failed to write element")
             print(traceback.format_exc())
         form.add_input(tmp['type'], tmp['accessible_name'], tmp['name'], tmp['value'], tmp['checked'])
 
     # <select> and <option> tags
-    selects = el.find_elements(By.TAG_NAME, "select")
-    for select in selects:
+    for select in form_data['selects']:
         tmp = {'accessible_name': None, 'name': None, 'value': None}
-        accessible_name = get_accessible_name(driver, select)
+        accessible_name = resolve_accessible_name(driver, select)
         if accessible_name:
             tmp['accessible_name'] = accessible_name
-        if select.get_attribute("name"):
-            tmp['name'] = select.get_attribute("name")
-        if select.get_attribute("value"):
-            tmp['value'] = select.get_attribute("value")
+        if select['name']:
+            tmp['name'] = select['name']
+        if select['value']:
+            tmp['value'] = select['value']
         form_select = form.add_select("select", tmp['accessible_name'], tmp['name'], tmp['value'])
 
-        selenium_select = Select( select )
-        options = selenium_select.options
-        for option in options:
-            text = get_element_text(driver, option)
-            form_select.add_option( option.get_attribute("value"), text)
+        for option in select['options']:
+            form_select.add_option(option['value'], option['text'])
 
     # <textarea> tags
-    textareas = el.find_elements(By.TAG_NAME, "textarea")
-    for ta in textareas:
+    for ta in form_data['textareas']:
         tmp = {'accessible_name': None, 'name': None, 'value': None}
-        try:
-            accessible_name = get_accessible_name(driver, ta)
-            if accessible_name:
-                tmp['accessible_name'] = accessible_name
-            if ta.get_attribute("name"):
-                tmp['name'] = ta.get_attribute("name")
-            if ta.get_attribute("value"):
-                tmp['value'] = ta.get_attribute("value")
-
-        except StaleElementReferenceException as e:
-            print("Stale pasta in from action")
-        except:
-            print("Failed to write element")
-            print(traceback.format_exc())
+        accessible_name = resolve_accessible_name(driver, ta)
+        if accessible_name:
+            tmp['accessible_name'] = accessible_name
+        if ta['name']:
+            tmp['name'] = ta['name']
+        if ta['value']:
+            tmp['value'] = ta['value']
         form.add_textarea(tmp['accessible_name'], tmp['name'], tmp['value'])
 
     # <button> tags
-    buttons = el.find_elements(By.TAG_NAME, "button")
-    for button in buttons:
+    for button in form_data['buttons']:
         tmp = {'type': None, 'accessible_name': None, 'name': None, 'value': None}
-        try:
-            accessible_name = get_accessible_name(driver, button)
-            if button.get_attribute("type"):
-                tmp['type'] = button.get_attribute("type")
-            if accessible_name:
-                tmp['accessible_name'] = accessible_name
-            if button.get_attribute("name"):
-                tmp['name'] = button.get_attribute("name")
-            if button.get_attribute("value"):
-                tmp['value'] = button.get_attribute("value")
-        except StaleElementReferenceException as e:
-            print("Stale pasta in from action")
-        except:
-            print("Failed to write element")
-            print(traceback.format_exc())
+        accessible_name = resolve_accessible_name(driver, button)
+        if button['type']:
+            tmp['type'] = button['type']
+        if accessible_name:
+            tmp['accessible_name'] = accessible_name
+        if button['name']:
+            tmp['name'] = button['name']
+        if button['value']:
+            tmp['value'] = button['value']
         form.add_button(tmp['type'], tmp['accessible_name'], tmp['name'], tmp['value'])
 
-    a_tags = el.find_elements(By.TAG_NAME, "a")
-    for a_tag in a_tags:
-        form.add_a_tag(a_tag.get_attribute("id"),
-                       get_accessible_name(driver, a_tag),
+    for a_tag in form_data['a_tags']:
+        form.add_a_tag(a_tag['id'],
+                       resolve_accessible_name(driver, a_tag),
                        )
 
     # <iframe> with <body contenteditable>
-    iframes = el.find_elements(By.TAG_NAME, "iframe")
-    for iframe in iframes:
-        iframe_id = iframe.get_attribute("id")
-        driver.switch_to.frame(iframe)
-        iframe_body = driver.find_element(By.TAG_NAME, "body")
-
-        if iframe_body.get_attribute("contenteditable") == "true":
-            accessible_name = get_accessible_name(driver, iframe_body)
-            if accessible_name:
-                accessible_name = accessible_name
-            elif iframe_body.get_attribute("data-id"):
-                accessible_name = iframe_body.get_attribute("data-id")
-            form.add_iframe_body(iframe_id, accessible_name)
+    for iframe in form_data['iframes']:
+        if not iframe['accessible']:
+            # Cross origin, read the body from inside the frame
+            try:
+                driver.switch_to.frame(driver.find_element(By.XPATH, iframe['xpath']))
+                iframe_body = driver.find_element(By.TAG_NAME, "body")
+                if iframe_body.get_attribute("contenteditable") == "true":
+                    accessible_name = get_accessible_name(driver, iframe_body)
+                    if not accessible_name and iframe_body.get_attribute("data-id"):
+                        accessible_name = iframe_body.get_attribute("data-id")
+                    form.add_iframe_body(iframe['id'], accessible_name)
+            except Exception as e:
+                logging.warning("Failed to parse iframe in form: %s" % str(e).splitlines()[0])
+            finally:
+                driver.switch_to.default_content()
+            continue
 
-        driver.switch_to.default_content()
+        if iframe['contenteditable'] == "true":
+            accessible_name = iframe['accessible_name']
+            if accessible_name is None:
+                try:
+                    driver.switch_to.frame(driver.find_element(By.XPATH, iframe['xpath']))
+                    accessible_name = driver.find_element(By.TAG_NAME, "body").accessible_name
+                except Exception as e:
+                    logging.warning("Failed to read iframe body name: %s" % str(e).splitlines()[0])
+                finally:
+                    driver.switch_to.default_content()
+            if not accessible_name and iframe['data_id']:
+                accessible_name = iframe['data_id']
+            form.add_iframe_body(iframe['id'], accessible_name)
 
     return form
 
+def parse_form(el, driver):
+    resps = driver.execute_script("return JSON.stringify(parseForm(arguments[0]))", el)
+    return decode_form(json.loads(resps), driver)
+
 
 # Search for <form>
-def extract_forms(driver):
-    form_wait_time = float(os.getenv('FORM_WAIT_TIME', '0.5'))
-    time.sleep(form_wait_time)
-    elem = driver.find_elements(By.TAG_NAME, "form")
-    logging.debug("Current URL: " + driver.current_url)
+def extract_forms(driver, page=None):
+    if page is None:
+        page = extract_page(driver)
+    logging.debug("Current URL: " + page['current_url'])
 
     forms = set()
     form_contexts = {}
-    for el in elem:
-        if not el.is_displayed():
-            if not el.is_displayed():
-                form = parse_form(el, driver)
-                logging.warning("Form "+str(form)+" is not displayed, skipping")
-                continue
-        form = parse_form(el, driver)
+    for form_data in page.get('forms') or []:
+        if not form_data['is_displayed']:
+            logging.warning("Form "+str(form_data['action'])+" is not displayed, skipping")
+            continue
+        form = decode_form(form_data, driver)
         if form.inputs == {}:
             logging.warning("Form has no inputs, skipping")
             continue
         forms.add(form)
         form_contexts[form] = {
-            "dom_context": extract_dom_context(el, driver),
-            "action_url": el.get_attribute("action") or driver.current_url
+            "dom_context": form_data['dom_context'],
+            "action_url": form_data['action'] or page['current_url']
         }
     return forms, form_contexts
-
-
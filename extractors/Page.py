@@ -0,0 +1,92 @@
+from selenium.common.exceptions import UnexpectedAlertPresentException
+from collections import OrderedDict
+import json
+import logging
+import os
+import threading
+
+from settle import wait_for_settle
+
+# Collects links, forms, iframes, events and ui forms of the current page in
+# one WebDriver round trip (extract_page() in js/page_extractor.js).
+# The extractors decode their section of the returned dict.
+def extract_page(driver, settle=True):
+    if settle:
+        wait_for_settle(driver, "extract page")
+
+    try:
+        resps = driver.execute_script("return extract_page()")
+        page = json.loads(resps)
+    except UnexpectedAlertPresentException:
+        raise
+    except Exception as e:
+        logging.warning("Failed to extract page: %s" % str(e).splitlines()[0])
+        page = {}
+
+    if not page.get('current_url'):
+        page['current_url'] = driver.current_url
+    if page.get('title') is None:
+        page['title'] = driver.title
+    return page
+
+# Extractions of recently seen page states, by page_state() fingerprint
+extraction_cache = OrderedDict()
+extraction_cache_size = int(os.getenv("EXTRACTION_CACHE_SIZE", 256))
+extraction_cache_lock = threading.Lock()
+
+# Version of the page and, when it differs from known_version, the structural
+# fingerprint of the page (page_state() in js/page_extractor.js)
+def page_state(driver, known_version):
+    try:
+        return json.loads(driver.execute_script("return page_state(arguments[0])", known_version))
+    except UnexpectedAlertPresentException:
+        raise
+    except Exception as e:
+        logging.debug("No page state " + str(e).splitlines()[0])
+        return {"version": None, "fingerprint": None}
+
+# Everything extracted from one DOM state. Form extraction, login detection
+# and the crawl step share it, each extractor runs at most once per state.
+class PageAnalysis:
+    def __init__(self, driver, version, page, results=None, fingerprint=None):
+        self.driver = driver
+        self.version = version
+        self.page = page
+        self.fingerprint = fingerprint
+        self.results = {} if results is None else results
+
+    # extractor(driver, page), e.g. extract_forms
+    def extract(self, extractor):
+        if extractor not in self.results:
+            self.results[extractor] = extractor(self.driver, self.page)
+        return self.results[extractor]
+
+# Analysis of the current page, reused until page_version() changes. A page
+# whose fingerprint was seen before gets the extraction of that page.
+def analyze_page(driver):
+    wait_for_settle(driver, "analyze page")
+    analysis = getattr(driver, "page_analysis", None)
+    state = page_state(driver, analysis.version if analysis else None)
+    version = state['version']
+    if version is not None and analysis is not None and analysis.version == version:
+        logging.info("Reusing page analysis of " + analysis.page['current_url'])
+        return analysis
+
+    fingerprint = state['fingerprint']
+    with extraction_cache_lock:
+        known = extraction_cache.get(fingerprint) if fingerprint else None
+        if known is not None:
+            extraction_cache.move_to_end(fingerprint)
+    if known is not None:
+        logging.info("Known page state " + fingerprint + " of " + known.page['current_url'])
+        analysis = PageAnalysis(driver, version, known.page, known.results, fingerprint)
+    else:
+        analysis = PageAnalysis(driver, version, extract_page(driver, settle=False), fingerprint=fingerprint)
+        if fingerprint:
+            # Crawl workers share the cache
+            with extraction_cache_lock:
+                extraction_cache[fingerprint] = analysis
+                if len(extraction_cache) > extraction_cache_size:
+                    extraction_cache.popitem(last=False)
+    driver.page_analysis = analysis
+    return analysis
@@ -8,7 +8,6 @@ from selenium.webdriver.common.by import By
 import json
 import pprint
 import datetime
-import tldextract
 import math
 import os
 import traceback
@@ -19,47 +18,7 @@ import copy
 import time
 
 import Classes
-
-def get_element_text(driver, element):
-    return driver.execute_script("return arguments[0].textContent;", element).strip()
-
-def extract_dom_context(el, driver):
-    dom_context = {
-        "current_node": {
-            "tag_name": el.tag_name,
-            "attributes": el.get_attribute('outerHTML'),
-            "text": get_element_text(driver, el),
-        },
-        "parent_node": None,
-        "sibling_nodes": [],
-        "page_title": driver.title
-    }
-
-    try:
-        parent = el.find_element(By.XPATH, '..')
-        dom_context["parent_node"] = {
-            "tag_name": parent.tag_name,
-            "attributes": parent.get_attribute('outerHTML'),
-            "text": get_element_text(driver, parent)
-        }
-    except:
-        dom_context["parent_node"] = None
-
-    try:
-        siblings = el.find_elements(By.XPATH, '../*')
-        siblings = siblings[:10]
-        for sibling in siblings:
-            if sibling != el:
-                dom_context["sibling_nodes"].append({
-                    "tag_name": sibling.tag_name,
-                    "attributes": sibling.get_attribute('outerHTML'),
-                    "text": get_element_text(driver, sibling)
-                })
-    except:
-        dom_context["sibling_nodes"] = []
-
-    return dom_context
-
+from extractors.Page import extract_page
 
 # If the url is from a form then the form method is used
 # However, javascript overrides the form method.
@@ -77,15 +36,13 @@ def url_to_request(url, form_method=None):
         url = url.rstrip("/")
     return Classes.Request(url,method)
 
-def add_url_with_context(el, url, element_type, url_contexts, urls, driver):
-    if el:
-        dom_context = extract_dom_context(el, driver)
-    else:
+def add_url_with_context(dom_context, url, element_type, url_contexts, urls, page):
+    if not dom_context:
         dom_context = {
             "current_node": None,
             "parent_node": None,
             "sibling_nodes": None,
-            "page_title": driver.title
+            "page_title": page['title']
         }
     url_request = url_to_request(url)
     url_contexts[url_request] = {
@@ -95,87 +52,66 @@ def add_url_with_context(el, url, element_type, url_contexts, urls, driver):
     urls.add(url_request)
 
 # Looks for a and from urls
-def extract_urls(driver):
+def extract_urls(driver, page=None):
+    if page is None:
+        page = extract_page(driver)
+
     urls = set()
 
     url_contexts = {}
 
+    section = page.get('urls')
+    if not section:
+        logging.warning("No urls extracted from page")
+        return urls, url_contexts
+
+    current_url = page['current_url']
+
     # Search for urls in <a>
-    elem = driver.find_elements(By.TAG_NAME, "a")
-    for el in elem:
+    for el in section['links']:
         try:
-            href = el.get_attribute("href")
-            current_url_js = driver.current_url+"#"
+            href = el['href']
+            current_url_js = current_url+"#"
             if href and (href.startswith("javascript:") or href == current_url_js):
                 if href == current_url_js:
                     href = "javascript:void(0);"
-                if el.get_attribute("id"):
-                    id = el.get_attribute("id")
-                    href = href+"id:"+id
-                elif el.get_attribute("className"):
-                    class_name = el.get_attribute("className")
-                    href = href+"class_name:"+class_name
-                elif el.get_attribute("onclick"):
-                    onclick = el.get_attribute("onclick")
-                    href = href+"onclick:"+onclick
-                text = get_element_text(driver, el)
-                href = href+"text:"+text
+                if el['id']:
+                    href = href+"id:"+el['id']
+                elif el['class_name']:
+                    href = href+"class_name:"+el['class_name']
+                elif el['onclick']:
+                    href = href+"onclick:"+el['onclick']
+                href = href+"text:"+el['text']
                 logging.debug("found javascript url " + href)
             if href:
-                add_url_with_context(el, href, "a", url_contexts, urls, driver)
-
-        except StaleElementReferenceException as e:
-            print("Stale pasta in from action")
+                add_url_with_context(el['dom_context'], href, "a", url_contexts, urls, page)
         except:
             print("Failed to write element")
             print(traceback.format_exc())
 
     # Search for urls in <iframe>
-    elem = driver.find_elements(By.TAG_NAME, "iframe")
-    for el in elem:
-        try:
-            src = el.get_attribute("src")
-            if src:
-                add_url_with_context(el, src, "iframe", url_contexts, urls, driver)
-
-        except StaleElementReferenceException as e:
-            print("Stale pasta in from action")
-        except:
-            print("Failed to write element")
-            print(traceback.format_exc())
+    for el in section['iframes']:
+        if el['src']:
+            add_url_with_context(el['dom_context'], el['src'], "iframe", url_contexts, urls, page)
 
     # Search for urls in <meta>
-    elem = driver.find_elements(By.TAG_NAME, "meta")
-    for el in elem:
-        try:
-
-            if el.get_attribute("http-equiv") and el.get_attribute("content"):
-                if el.get_attribute("http-equiv").lower()  == "refresh":
-                    m = re.search("url=(.*)", el.get_attribute("content"), re.IGNORECASE )
-                    if not m:
-                        continue
-                    fresh_url = m.group(1)
-                    full_fresh_url = urljoin( driver.current_url, fresh_url )
-                    add_url_with_context(el, full_fresh_url, "meta", url_contexts, urls, driver)
-
-        except StaleElementReferenceException as e:
-            print("Stale pasta in from action")
-        except:
-            print("Failed to write element")
-            print(traceback.format_exc())
-
-
-    try:
-        resps = driver.execute_script("return JSON.stringify(window_open_urls)")
-        window_open_urls = json.loads(resps)
-        for window_open_url in window_open_urls:
-            full_window_open_url = urljoin( driver.current_url, window_open_url )
-            add_url_with_context(None, full_window_open_url, "window.open", url_contexts, urls, driver)
-    except Exception as e:
-        logging.warning("Failed to extract window.open URLs: %s" % str(e))
+    for el in section['metas']:
+        if el['http_equiv'] and el['content']:
+            if el['http_equiv'].lower()  == "refresh":
+                m = re.search("url=(.*)", el['content'], re.IGNORECASE )
+                if not m:
+                    continue
+                fresh_url = m.group(1)
+                full_fresh_url = urljoin( current_url, fresh_url )
+                add_url_with_context(el['dom_context'], full_fresh_url, "meta", url_contexts, urls, page)
+
+    if section['window_open_urls'] is None:
+        logging.warning("Failed to extract window.open URLs")
+    else:
+        for window_open_url in section['window_open_urls']:
+            full_window_open_url = urljoin( current_url, window_open_url )
+            add_url_with_context(None, full_window_open_url, "window.open", url_contexts, urls, page)
 
     logging.debug("URLs from extract_urls %s" % str(urls) )
 
     return urls, url_contexts
-
-
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+# Columns of the edges table counting how often an edge was recorded in
+# the matching Graph list, e.g. successful for successful_edges
+counted_flags = ["successful", "failed", "blocking"]
+
+# Bumped when the tables change, older tables are dropped
+schema_version = 1
+
+def plain_key(key):
+    if isinstance(key, (tuple, list)):
+        return [plain_key(part) for part in key]
+    if isinstance(key, (set, frozenset)):
+        # Iteration order of a set is not part of its value
+        return sorted((plain_key(part) for part in key), key=lambda part: json.dumps(part, sort_keys=True, default=str))
+    if isinstance(key, dict):
+        return {str(name): plain_key(part) for (name, part) in key.items()}
+    return key
+
+# Column value of a Graph.node_key/edge_key, equal keys always give the same
+# string
+def store_key(key):
+    return hashlib.sha1(json.dumps(plain_key(key), sort_keys=True, default=str).encode()).hexdigest()
+
+# SQLite tables behind SqliteGraph: every node and edge with its pickled
+# value, the keys Graph looks them up by, the visited flags and how often an
+# edge ended up in the successful, failed and blocking lists. Edges refer to
+# their nodes and parent edge by position. flag_events keeps every append to
+# the visited, successful, failed and blocking lists in order, so they behave
+# like the lists of Graph. Keys are the store_key of Graph.node_key/edge_key.
+class GraphStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # The graph itself lives here, a checkpoint only adds the crawler state
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+            for table in ["nodes", "edges", "flag_events"]:
+                self.connection.execute("DROP TABLE IF EXISTS " + table)
+            self.connection.execute("PRAGMA user_version=%d" % schema_version)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS nodes (
+            idx INTEGER PRIMARY KEY,
+            method TEXT,
+            node_key TEXT NOT NULL,
+            visited INTEGER NOT NULL DEFAULT 0,
+            value BLOB)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS edges (
+            idx INTEGER PRIMARY KEY,
+            method TEXT,
+            edge_key TEXT NOT NULL,
+            target_key TEXT NOT NULL,
+            resource TEXT,
+            operation TEXT,
+            crud_type TEXT,
+            visited INTEGER NOT NULL DEFAULT 0,
+            successful INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocking INTEGER NOT NULL DEFAULT 0,
+            n1 INTEGER,
+            n2 INTEGER,
+            parent INTEGER,
+            parent_value BLOB,
+            value BLOB)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS flag_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            flag TEXT NOT NULL,
+            idx INTEGER NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS flag_events_flag ON flag_events (flag, seq)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS flag_events_edge ON flag_events (flag, idx)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS nodes_key ON nodes (node_key)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS edges_key ON edges (edge_key)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS edges_target ON edges (target_key)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS edges_visited ON edges (visited, method)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS edges_operation ON edges (resource, operation, crud_type)")
+        for flag in counted_flags:
+            self.connection.execute("CREATE INDEX IF NOT EXISTS edges_" + flag + " ON edges (" + flag + ") WHERE " + flag + " > 0")
+
+    def execute(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters)
+
+    def column(self, query, parameters=()):
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query, parameters)]
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM nodes")
+            self.connection.execute("DELETE FROM edges")
+            self.connection.execute("DELETE FROM flag_events")
+        logging.info("Cleared graph store " + self.path)
+
+    def add_node(self, index, method, node_key, value, visited=False):
+        self.execute("INSERT OR REPLACE INTO nodes (idx, method, node_key, visited, value) VALUES (?, ?, ?, ?, ?)",
+                     (index, method, node_key, int(visited), value))
+
+    # parent is the position of the parent edge, parent_value the pickled
+    # parent for one that is not in the graph
+    def add_edge(self, index, method, edge_key, target_key, n1, n2, parent, parent_value, value, visited=False):
+        self.execute("""INSERT OR REPLACE INTO edges (idx, method, edge_key, target_key, visited, n1, n2, parent, parent_value, value)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (index, method, edge_key, target_key, int(visited), n1, n2, parent, parent_value, value))
+
+    def count(self, table):
+        return self.column("SELECT COUNT(*) FROM " + table)[0]
+
+    # (visited, value) of a node
+    def node_row(self, index):
+        with self.lock:
+            return self.connection.execute("SELECT visited, value FROM nodes WHERE idx=?", (index,)).fetchone()
+
+    # (visited, n1, n2, parent, parent_value, value) of an edge
+    def edge_row(self, index):
+        with self.lock:
+            return self.connection.execute("SELECT visited, n1, n2, parent, parent_value, value FROM edges WHERE idx=?",
+                                           (index,)).fetchone()
+
+    def save_row(self, table, index, visited, value):
+        self.execute("UPDATE " + table + " SET visited=?, value=? WHERE idx=?", (int(visited), value, index))
+
+    def nodes_with_key(self, node_key):
+        return self.column("SELECT idx FROM nodes WHERE node_key=? ORDER BY idx", (node_key,))
+
+    def edges_with_key(self, edge_key):
+        return self.column("SELECT idx FROM edges WHERE edge_key=? ORDER BY idx", (edge_key,))
+
+    def edges_to(self, target_key):
+        return self.column("SELECT idx FROM edges WHERE target_key=? ORDER BY idx", (target_key,))
+
+    def set_node_key(self, index, node_key):
+        self.execute("UPDATE nodes SET node_key=? WHERE idx=?", (node_key, index))
+
+    def set_edge_keys(self, index, edge_key, target_key):
+        self.execute("UPDATE edges SET edge_key=?, target_key=? WHERE idx=?", (edge_key, target_key, index))
+
+    def set_target_key(self, index, target_key):
+        self.execute("UPDATE edges SET target_key=? WHERE idx=?", (target_key, index))
+
+    def visit_node(self, index):
+        self.execute("UPDATE nodes SET visited=1 WHERE idx=?", (index,))
+
+    def set_visited(self, index, visited):
+        self.execute("UPDATE edges SET visited=? WHERE idx=?", (int(visited), index))
+
+    def add_flag(self, index, flag):
+        with self.lock:
+            self.connection.execute("INSERT INTO flag_events (flag, idx) VALUES (?, ?)", (flag, index))
+            if flag in counted_flags:
+                self.connection.execute("UPDATE edges SET " + flag + "=" + flag + " + 1 WHERE idx=?", (index,))
+
+    # Drops the first time the edge was added to the list of flag
+    def remove_flag(self, index, flag):
+        with self.lock:
+            seq = self.connection.execute("SELECT MIN(seq) FROM flag_events WHERE flag=? AND idx=?", (flag, index)).fetchone()[0]
+            if seq is None:
+                return
+            self.connection.execute("DELETE FROM flag_events WHERE seq=?", (seq,))
+            if flag in counted_flags:
+                self.connection.execute("UPDATE edges SET " + flag + "=" + flag + " - 1 WHERE idx=?", (index,))
+
+    def reset_flag(self, flag):
+        with self.lock:
+            self.connection.execute("DELETE FROM flag_events WHERE flag=?", (flag,))
+            if flag in counted_flags:
+                self.connection.execute("UPDATE edges SET " + flag + "=0")
+
+    # Edge indices in the order they were added, once per add
+    def flagged(self, flag):
+        return self.column("SELECT idx FROM flag_events WHERE flag=? ORDER BY seq", (flag,))
+
+    def count_flagged(self, flag):
+        return self.column("SELECT COUNT(*) FROM flag_events WHERE flag=?", (flag,))[0]
+
+    def flagged_with_key(self, flag, edge_key):
+        return self.column("SELECT idx FROM edges WHERE edge_key=? AND " + flag + " > 0 ORDER BY idx", (edge_key,))
+
+    def set_operation(self, index, resource, operation, crud_type):
+        self.execute("UPDATE edges SET resource=?, operation=?, crud_type=? WHERE idx=?",
+                     (resource, operation, crud_type, index))
+
+    def unvisited_edges(self):
+        return self.column("SELECT idx FROM edges WHERE visited=0 ORDER BY idx")
+
+    def unvisited_counts(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT method, COUNT(*) FROM edges WHERE visited=0 GROUP BY method").fetchall()
+        return dict(rows)
@@ -0,0 +1,570 @@
+/*
+ * Batched page extraction.
+ *
+ * extract_page() walks the DOM once and returns everything the Python
+ * extractors (extractors/*.py) need as a single JSON string, instead of one
+ * WebDriver command per attribute. Attribute reads follow the semantics of
+ * WebElement.get_attribute so the decoded objects match the ones built
+ * element by element.
+ */
+
+var attribute_aliases = {"class": "className", "readonly": "readOnly"};
+var boolean_attributes = ["checked", "selected", "disabled", "readonly", "required", "multiple", "hidden"];
+
+// WebElement.get_attribute: property first, attribute as fallback.
+function attributeOf(el, name) {
+  name = name.toLowerCase();
+  if (name === "style") {
+    return el.style ? el.style.cssText : null;
+  }
+  var prop = attribute_aliases[name] || name;
+  if (boolean_attributes.indexOf(name) >= 0) {
+    var flag = (prop in el) ? el[prop] : el.hasAttribute(name);
+    return flag ? "true" : null;
+  }
+  var value = null;
+  try {
+    value = el[prop];
+  } catch (e) {
+    value = null;
+  }
+  if (value === undefined || value === null || typeof value === "object" || typeof value === "function") {
+    value = el.getAttribute(name);
+  }
+  return (value === undefined || value === null) ? null : String(value);
+}
+
+// get_element_text: textContent, stripped.
+function textOf(el) {
+  return (el && el.textContent) ? el.textContent.trim() : "";
+}
+
+// WebElement.text: rendered text.
+function visibleTextOf(el) {
+  if (!el) {
+    return "";
+  }
+  var text = (el.innerText !== undefined) ? el.innerText : el.textContent;
+  return text ? text.trim() : "";
+}
+
+// Close to WebElement.is_displayed: hidden or transparent ancestors,
+// visibility and an empty box without displayed children.
+function isDisplayed(el) {
+  if (!el || !el.isConnected) {
+    return false;
+  }
+  var view = el.ownerDocument.defaultView || window;
+  if (el.tagName === "OPTION" || el.tagName === "OPTGROUP") {
+    var select = el.closest("select");
+    return select ? isDisplayed(select) : true;
+  }
+  if (el.tagName === "INPUT" && el.type === "hidden") {
+    return false;
+  }
+  for (var e = el; e && e.nodeType === 1; e = e.parentElement) {
+    var ancestor_style = view.getComputedStyle(e);
+    if (ancestor_style.display === "none" || ancestor_style.opacity === "0") {
+      return false;
+    }
+  }
+  var style = view.getComputedStyle(el);
+  if (style.visibility === "hidden" || style.visibility === "collapse") {
+    return false;
+  }
+  return hasDisplayedBox(el);
+}
+
+function hasDisplayedBox(el) {
+  var rect = el.getBoundingClientRect();
+  if (rect.width > 0 && rect.height > 0) {
+    return true;
+  }
+  for (var i = 0; i < el.children.length; i++) {
+    if (hasDisplayedBox(el.children[i])) {
+      return true;
+    }
+  }
+  return false;
+}
+
+function isInForm(el) {
+  return el.parentElement ? el.parentElement.closest("form") !== null : false;
+}
+
+// Same lookup order as tools.get_accessible_name. Returns null when the
+// browser computed label is needed, which only WebDriver can provide.
+function getAccessibleName(el) {
+  var doc = el.ownerDocument || document;
+
+  var labelledby = el.getAttribute("aria-labelledby");
+  if (labelledby) {
+    var ids = labelledby.split(/\s+/).filter(Boolean);
+    var labels = [];
+    var missing = false;
+    for (var i = 0; i < ids.length; i++) {
+      var label_el = doc.getElementById(ids[i]);
+      if (!label_el) {
+        missing = true;
+        break;
+      }
+      labels.push(visibleTextOf(label_el));
+    }
+    if (!missing && labels.length) {
+      return labels.join(" ");
+    }
+  }
+
+  var aria_label = el.getAttribute("aria-label");
+  if (aria_label) {
+    return aria_label.trim();
+  }
+
+  var element_id = attributeOf(el, "id");
+  if (element_id) {
+    try {
+      var for_label = doc.querySelector("label[for='" + element_id + "']");
+      if (for_label) {
+        return visibleTextOf(for_label);
+      }
+    } catch (e) {
+    }
+  }
+
+  var wrapping_label = el.parentElement ? el.parentElement.closest("label") : null;
+  if (wrapping_label) {
+    return visibleTextOf(wrapping_label);
+  }
+
+  if (el.parentElement) {
+    var parent_labels = el.parentElement.getElementsByTagName("label");
+    if (parent_labels.length) {
+      var texts = [];
+      for (var j = 0; j < parent_labels.length; j++) {
+        var text = visibleTextOf(parent_labels[j]);
+        if (text) {
+          texts.push(text);
+        }
+      }
+      return texts.join(" ");
+    }
+  }
+
+  var placeholder = el.getAttribute("placeholder");
+  if (placeholder) {
+    return placeholder.trim();
+  }
+
+  var title = el.getAttribute("title");
+  if (title) {
+    return title.trim();
+  }
+
+  return null;
+}
+
+function nodeContext(el, textFn) {
+  return {
+    "tag_name": el.tagName.toLowerCase(),
+    "attributes": el.outerHTML,
+    "text": textFn(el)
+  };
+}
+
+// Same shape as extract_dom_context in the extractors.
+function domContext(el, textFn, missing_parent) {
+  var dom_context = {
+    "current_node": nodeContext(el, textFn),
+    "parent_node": missing_parent,
+    "sibling_nodes": [],
+    "page_title": document.title
+  };
+  var parent = el.parentElement;
+  if (parent) {
+    dom_context["parent_node"] = nodeContext(parent, textFn);
+    var siblings = Array.prototype.slice.call(parent.children, 0, 10);
+    for (var i = 0; i < siblings.length; i++) {
+      if (siblings[i] !== el) {
+        dom_context["sibling_nodes"].push(nodeContext(siblings[i], textFn));
+      }
+    }
+  }
+  return dom_context;
+}
+
+// Same shape as the outerHTML contexts built in extractors/Events.py.
+function htmlContext(el) {
+  var siblings = [];
+  var parent = el.parentNode;
+  var sibling = parent ? parent.firstChild : null;
+  var sibling_count = 0;
+  while (sibling && sibling_count < 10) {
+    if (sibling.nodeType === 1 && sibling !== el) {
+      siblings.push(sibling.outerHTML);
+    }
+    sibling = sibling.nextSibling;
+    sibling_count++;
+  }
+  return {
+    "current_node": el.outerHTML,
+    "parent_node": (parent && parent.outerHTML !== undefined) ? parent.outerHTML : null,
+    "sibling_nodes": siblings,
+    "page_title": document.title
+  };
+}
+
+function controlData(el) {
+  var role = el.getAttribute("role");
+  if (!role && el.tagName === "INPUT" && el.hasAttribute("list")
+      && ["text", "search", "tel", "url", "email"].indexOf(el.type) >= 0) {
+    role = "combobox";
+  }
+  return {
+    "xpath": getXPath(el),
+    "type": attributeOf(el, "type"),
+    "accessible_name": getAccessibleName(el),
+    "name": attributeOf(el, "name"),
+    "value": attributeOf(el, "value"),
+    "checked": attributeOf(el, "checked"),
+    "role": role ? role.split(/\s+/)[0] : null
+  };
+}
+
+function formAction(form) {
+  return attributeOf(form, "action");
+}
+
+function formMethod(form) {
+  return attributeOf(form, "method");
+}
+
+// Everything parse_form reads from a <form>.
+function parseForm(form) {
+  var data = {
+    "xpath": getXPath(form),
+    "html": form.outerHTML,
+    "action": formAction(form),
+    "method": formMethod(form),
+    "inputs": [],
+    "selects": [],
+    "textareas": [],
+    "buttons": [],
+    "a_tags": [],
+    "iframes": []
+  };
+
+  var inputs = Array.prototype.slice.call(form.getElementsByTagName("input"));
+  if (!inputs.length) {
+    // Same fallback as get_forms(): the elements of the matching document form.
+    for (var f = 0; f < document.forms.length; f++) {
+      var js_form = document.forms[f];
+      if (js_form.method === data["method"] && js_form.action === data["action"]) {
+        inputs = Array.prototype.slice.call(js_form.elements);
+        break;
+      }
+    }
+  }
+  for (var i = 0; i < inputs.length; i++) {
+    try {
+      data["inputs"].push(controlData(inputs[i]));
+    } catch (e) {
+      console.log("parseForm input error " + e);
+    }
+  }
+
+  var selects = form.getElementsByTagName("select");
+  for (var s = 0; s < selects.length; s++) {
+    var select_data = controlData(selects[s]);
+    select_data["options"] = [];
+    for (var o = 0; o < selects[s].options.length; o++) {
+      var option = selects[s].options[o];
+      select_data["options"].push({"value": attributeOf(option, "value"), "text": textOf(option)});
+    }
+    data["selects"].push(select_data);
+  }
+
+  var textareas = form.getElementsByTagName("textarea");
+  for (var t = 0; t < textareas.length; t++) {
+    data["textareas"].push(controlData(textareas[t]));
+  }
+
+  var buttons = form.getElementsByTagName("button");
+  for (var b = 0; b < buttons.length; b++) {
+    data["buttons"].push(controlData(buttons[b]));
+  }
+
+  var a_tags = form.getElementsByTagName("a");
+  for (var a = 0; a < a_tags.length; a++) {
+    data["a_tags"].push({
+      "xpath": getXPath(a_tags[a]),
+      "id": attributeOf(a_tags[a], "id"),
+      "accessible_name": getAccessibleName(a_tags[a])
+    });
+  }
+
+  var iframes = form.getElementsByTagName("iframe");
+  for (var k = 0; k < iframes.length; k++) {
+    var iframe_data = {
+      "xpath": getXPath(iframes[k]),
+      "id": attributeOf(iframes[k], "id"),
+      "accessible": false
+    };
+    try {
+      var body = iframes[k].contentDocument.body;
+      iframe_data["accessible"] = true;
+      iframe_data["contenteditable"] = attributeOf(body, "contenteditable");
+      iframe_data["accessible_name"] = getAccessibleName(body);
+      iframe_data["data_id"] = attributeOf(body, "data-id");
+    } catch (e) {
+      // Cross origin frame, the Python side switches into it instead.
+    }
+    data["iframes"].push(iframe_data);
+  }
+
+  return data;
+}
+
+function extractLinks(current_url) {
+  var links = [];
+  var anchors = document.getElementsByTagName("a");
+  for (var i = 0; i < anchors.length; i++) {
+    var el = anchors[i];
+    try {
+      links.push({
+        "href": attributeOf(el, "href"),
+        "id": attributeOf(el, "id"),
+        "class_name": attributeOf(el, "class"),
+        "onclick": attributeOf(el, "onclick"),
+        "text": textOf(el),
+        "dom_context": domContext(el, textOf, null)
+      });
+    } catch (e) {
+      console.log("extractLinks error " + e);
+    }
+  }
+
+  var iframes = [];
+  var iframe_elements = document.getElementsByTagName("iframe");
+  for (var j = 0; j < iframe_elements.length; j++) {
+    iframes.push({
+      "src": attributeOf(iframe_elements[j], "src"),
+      "dom_context": domContext(iframe_elements[j], textOf, null)
+    });
+  }
+
+  var metas = [];
+  var meta_elements = document.getElementsByTagName("meta");
+  for (var k = 0; k < meta_elements.length; k++) {
+    metas.push({
+      "http_equiv": attributeOf(meta_elements[k], "http-equiv"),
+      "content": attributeOf(meta_elements[k], "content"),
+      "dom_context": domContext(meta_elements[k], textOf, null)
+    });
+  }
+
+  return {
+    "links": links,
+    "iframes": iframes,
+    "metas": metas,
+    "window_open_urls": (typeof window_open_urls !== "undefined") ? window_open_urls : null
+  };
+}
+
+function extractForms() {
+  var forms = [];
+  var form_elements = document.getElementsByTagName("form");
+  for (var i = 0; i < form_elements.length; i++) {
+    var el = form_elements[i];
+    try {
+      var displayed = isDisplayed(el);
+      var form_data = displayed ? parseForm(el) : {"html": el.outerHTML, "action": formAction(el)};
+      form_data["is_displayed"] = displayed;
+      if (displayed) {
+        form_data["dom_context"] = domContext(el, textOf, {});
+      }
+      forms.push(form_data);
+    } catch (e) {
+      console.log("extractForms error " + e);
+    }
+  }
+  return forms;
+}
+
+function extractFrames() {
+  var frames = [];
+  var tags = ["iframe", "frame"];
+  for (var t = 0; t < tags.length; t++) {
+    var elements = document.getElementsByTagName(tags[t]);
+    for (var i = 0; i < elements.length; i++) {
+      var el = elements[i];
+      var content = null;
+      try {
+        content = el.contentDocument.documentElement.outerHTML;
+      } catch (e) {
+        content = null;
+      }
+      frames.push({
+        "tag": tags[t],
+        "xpath": getXPath(el),
+        "src": attributeOf(el, "src"),
+        "id": attributeOf(el, "id"),
+        "i": attributeOf(el, "i"),
+        "content": content,
+        "dom_context": domContext(el, textOf, {})
+      });
+    }
+  }
+  return frames;
+}
+
+function eventTarget(el, event, tag) {
+  return {
+    "function_id": "",
+    "event": event,
+    "id": attributeOf(el, "id"),
+    "tag": tag,
+    "addr": getXPath(el),
+    "class": attributeOf(el, "class"),
+    "dom_context": htmlContext(el),
+    "url": window.location.href,
+    "is_visible": isDisplayed(el)
+  };
+}
+
+function extractEvents() {
+  var properties = null;
+  try {
+    properties = JSON.parse(catch_properties());
+  } catch (e) {
+    console.log("catch_properties error " + e);
+  }
+
+  var targets = [];
+  var toggles = document.querySelectorAll("button[data-toggle]");
+  for (var i = 0; i < toggles.length; i++) {
+    targets.push(eventTarget(toggles[i], "click", "button"));
+  }
+
+  var fake_buttons = document.getElementsByClassName("btn");
+  for (var j = 0; j < fake_buttons.length; j++) {
+    targets.push(eventTarget(fake_buttons[j], "click", "a"));
+  }
+
+  var inputs = document.querySelectorAll("input, textarea");
+  for (var k = 0; k < inputs.length; k++) {
+    var input_type = attributeOf(inputs[k], "type");
+    if ((!input_type || input_type === "text") && !isInForm(inputs[k])) {
+      targets.push(eventTarget(inputs[k], "input", "input"));
+    }
+  }
+
+  return {
+    "properties": properties,
+    "added_events": (typeof added_events !== "undefined") ? added_events : [],
+    "targets": targets
+  };
+}
+
+function extractUiForms() {
+  var sources = [];
+  var inputs = document.getElementsByTagName("input");
+  for (var i = 0; i < inputs.length; i++) {
+    var input_type = attributeOf(inputs[i], "type");
+    if ((!input_type || input_type === "text") && !isInForm(inputs[i])) {
+      sources.push({"xpath": getXPath(inputs[i]), "value": "jAEkPotUI"});
+    }
+  }
+  var textareas = document.getElementsByTagName("textarea");
+  for (var j = 0; j < textareas.length; j++) {
+    if (!isInForm(textareas[j])) {
+      sources.push({"xpath": getXPath(textareas[j]), "value": "jAEkPotUI"});
+    }
+  }
+
+  var submits = [];
+  if (sources.length) {
+    var buttons = Array.prototype.slice.call(document.getElementsByTagName("button"), 0, 10);
+    for (var k = 0; k < buttons.length; k++) {
+      var button = buttons[k];
+      var form = button.parentElement ? button.parentElement.closest("form") : null;
+      if (form) {
+        continue;
+      }
+      submits.push({
+        "xpath": getXPath(button),
+        "action_url": window.location.href,
+        "method": "GET",
+        "dom_context": domContext(button, visibleTextOf, null)
+      });
+    }
+  }
+
+  return {"sources": sources, "submits": submits};
+}
+
+function extract_page() {
+  var current_url = window.location.href;
+  var page = {
+    "current_url": current_url,
+    "title": document.title
+  };
+  var sections = {
+    "urls": function() { return extractLinks(current_url); },
+    "forms": extractForms,
+    "iframes": extractFrames,
+    "events": extractEvents,
+    "ui_forms": extractUiForms
+  };
+  for (var name in sections) {
+    try {
+      page[name] = sections[name]();
+    } catch (e) {
+      console.log("extract_page " + name + " error " + e);
+      page[name] = null;
+    }
+  }
+  return JSON.stringify(page);
+}
+
+// 53 bit string hash (cyrb53)
+function hashString(str) {
+  var h1 = 0xdeadbeef, h2 = 0x41c6ce57;
+  for (var i = 0; i < str.length; i++) {
+    var ch = str.charCodeAt(i);
+    h1 = Math.imul(h1 ^ ch, 2654435761);
+    h2 = Math.imul(h2 ^ ch, 1597334677);
+  }
+  h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+  h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+  return (h2 >>> 0).toString(16) + (h1 >>> 0).toString(16) + ":" + str.length;
+}
+
+// The page without its text: url, tags, attributes, control state and the
+// registered listeners. Pages with the same skeleton extract the same links,
+// forms, iframes, events and ui forms, only the surrounding text can differ.
+function pageSkeleton() {
+  var parts = [window.location.href, (typeof added_events !== "undefined") ? added_events.length : 0];
+  var elements = document.getElementsByTagName("*");
+  for (var i = 0; i < elements.length; i++) {
+    var el = elements[i];
+    var part = el.tagName + "/" + el.childElementCount;
+    for (var j = 0; j < el.attributes.length; j++) {
+      part += " " + el.attributes[j].name + "=" + el.attributes[j].value;
+    }
+    if (el.tagName === "INPUT" || el.tagName === "TEXTAREA" || el.tagName === "SELECT") {
+      part += " value=" + el.value + " checked=" + el.checked;
+    }
+    parts.push(part);
+  }
+  return parts.join("\n");
+}
+
+// The fingerprint is only computed when the page changed since known_version
+function page_state(known_version) {
+  var version = (typeof page_version === "function") ? page_version() : null;
+  var state = {"version": version, "fingerprint": null};
+  if (version === null || version !== known_version) {
+    state["fingerprint"] = hashString(pageSkeleton());
+  }
+  return JSON.stringify(state);
+}
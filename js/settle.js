@@ -0,0 +1,120 @@
+/*
+ * Page settle instrumentation.
+ *
+ * Tracks in-flight XMLHttpRequest/fetch calls, short pending timers and the
+ * time of the last DOM mutation, so settle.wait_for_settle() can poll
+ * settle_state() instead of sleeping for a fixed time.
+ *
+ * page_version() changes whenever the document or its DOM changes, so an
+ * analysis of the page can be reused until then.
+ */
+
+var settle_timer_horizon = 1000;
+var settle_pending_requests = 0;
+var settle_pending_timers = 0;
+var settle_last_mutation = Date.now();
+var settle_mutations = 0;
+
+(function() {
+	var original_send = XMLHttpRequest.prototype.send;
+	XMLHttpRequest.prototype.send = function() {
+		var xhr = this;
+		var done = false;
+		settle_pending_requests++;
+		xhr.addEventListener("loadend", function() {
+			if (!done) {
+				done = true;
+				settle_pending_requests--;
+			}
+		});
+		try {
+			return original_send.apply(this, arguments);
+		} catch (e) {
+			if (!done) {
+				done = true;
+				settle_pending_requests--;
+			}
+			throw e;
+		}
+	};
+
+	if (window.fetch) {
+		var original_fetch = window.fetch;
+		window.fetch = function() {
+			settle_pending_requests++;
+			var finished = function() {
+				settle_pending_requests--;
+			};
+			var result;
+			try {
+				result = original_fetch.apply(this, arguments);
+			} catch (e) {
+				// Thrown before a promise exists, e.g. by a page wrapping fetch
+				finished();
+				throw e;
+			}
+			result.then(finished, finished);
+			return result;
+		};
+	}
+
+	// Only timers set outside of other timer callbacks are tracked, polling
+	// loops that re-arm themselves would otherwise never settle.
+	var original_set_timeout = window.setTimeout;
+	var original_clear_timeout = window.clearTimeout;
+	var pending_timers = {};
+	var in_timer_callback = false;
+	window.setTimeout = function(callback, delay) {
+		var tracked = !in_timer_callback && typeof callback === "function"
+			&& (delay || 0) <= settle_timer_horizon;
+		var args = Array.prototype.slice.call(arguments);
+		var timer_id;
+		if (tracked) {
+			args[0] = function() {
+				if (pending_timers[timer_id]) {
+					delete pending_timers[timer_id];
+					settle_pending_timers--;
+				}
+				in_timer_callback = true;
+				try {
+					return callback.apply(this, arguments);
+				} finally {
+					in_timer_callback = false;
+				}
+			};
+		}
+		timer_id = original_set_timeout.apply(this, args);
+		if (tracked) {
+			pending_timers[timer_id] = true;
+			settle_pending_timers++;
+		}
+		return timer_id;
+	};
+	window.clearTimeout = function(timer_id) {
+		if (pending_timers[timer_id]) {
+			delete pending_timers[timer_id];
+			settle_pending_timers--;
+		}
+		return original_clear_timeout.apply(this, arguments);
+	};
+
+	new MutationObserver(function(records) {
+		settle_last_mutation = Date.now();
+		settle_mutations += records.length;
+	}).observe(document, {"childList": true, "subtree": true, "attributes": true, "characterData": true});
+})();
+
+function settle_state() {
+	return JSON.stringify({
+		"ready_state": document.readyState,
+		"pending_requests": settle_pending_requests,
+		"pending_timers": settle_pending_timers,
+		"quiet_ms": Date.now() - settle_last_mutation,
+		"need_to_wait": (typeof need_to_wait !== "undefined") ? need_to_wait : false,
+		"timeouts": (typeof timeouts !== "undefined") ? timeouts.length : 0
+	});
+}
+
+function page_version() {
+	return performance.timeOrigin + ":" + settle_mutations + ":" + location.href;
+}
@@ -7,11 +7,9 @@ import sys
 import time
 from datetime import datetime
 
-import openai
-import httpx
-import transformers
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from similarity import SimilarityIndex
+from llm_cache import get_llm_cache
+from llm_manager import get_tokenizer
 
 class bcolors:
     if sys.stdout.isatty():
@@ -50,13 +48,21 @@ def setup_logger(name, log_file):
     logger.propagate = False
     return logger
 
-long_timeout_async_client = httpx.AsyncClient(timeout=180)
-async_client = openai.AsyncOpenAI(api_key=os.getenv("API_KEY"), base_url=os.getenv("BASE_URL"), timeout=180, http_client=long_timeout_async_client)
+# Created on first use, openai takes a while to import
+async_client = None
+
+def get_async_client():
+    global async_client
+    if async_client is None:
+        import httpx
+        import openai
+        async_client = openai.AsyncOpenAI(api_key=os.getenv("API_KEY"), base_url=os.getenv("BASE_URL"), timeout=180,
+                                          http_client=httpx.AsyncClient(timeout=180))
+    return async_client
+
 max_crawl_time = float(os.getenv("MAX_CRAWL_TIME", 8 * 60 * 60))
 start_time = time.time()
 
-tokenizer = transformers.AutoTokenizer.from_pretrained(os.getcwd(), trust_remote_code=True)
-
 timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 app_name = os.getenv("APP_NAME", "")
 log_file_name = os.path.join(os.getcwd(), 'logs', app_name + '-llm-' + str(timestamp) + '.log')
@@ -64,21 +70,108 @@ llm_logger = setup_logger('llm', log_file_name)
 
 failed_analysis_prompt = {}
 
-def is_similar(prompt, cache, threshold=0.95):
-    if not cache:
-        return None
-
-    prompts = list(cache.keys())
-    vectorizer = TfidfVectorizer().fit_transform([prompt] + prompts)
-    similarity_matrix = cosine_similarity(vectorizer[0:1], vectorizer[1:])
-    max_sim_idx = similarity_matrix.argmax()
-    max_sim_value = similarity_matrix[0, max_sim_idx]
+# Continuous token bucket over requests and tokens per minute. A 429 halves
+# the refill rate and blocks dispatch for an exponentially growing backoff,
+# successful calls slowly restore both.
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, initial_backoff=2.0, max_backoff=60.0):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_budget = requests_per_minute
+        self.token_budget = tokens_per_minute
+        self.rate_scale = 1.0
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self.blocked_until = 0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_budget = min(self.request_capacity,
+                                  self.request_budget + elapsed * self.rate_scale * self.request_capacity / 60)
+        self.token_budget = min(self.token_capacity,
+                                self.token_budget + elapsed * self.rate_scale * self.token_capacity / 60)
+
+    async def acquire(self, tokens):
+        # A prompt larger than the bucket would never fit
+        tokens = min(tokens, self.token_capacity)
+        # Waiters are served in arrival order
+        async with self.lock:
+            while True:
+                self.refill()
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.request_budget >= 1 and self.token_budget >= tokens:
+                    self.request_budget -= 1
+                    self.token_budget -= tokens
+                    return
+                rate = self.rate_scale / 60
+                wait = max((1 - self.request_budget) / (self.request_capacity * rate),
+                           (tokens - self.token_budget) / (self.token_capacity * rate))
+                await asyncio.sleep(max(wait, 0.01))
+
+    def rate_limited(self):
+        self.refill()
+        self.rate_scale = max(0.1, self.rate_scale / 2)
+        self.backoff = min(self.max_backoff, self.backoff * 2 if self.backoff else self.initial_backoff)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + self.backoff)
+        self.request_budget = 0
+        self.token_budget = 0
+        llm_logger.warning("Rate limited, backing off %.1fs at %.0f%% rate" % (self.backoff, self.rate_scale * 100))
+        return self.backoff
+
+    def succeeded(self):
+        self.rate_scale = min(1.0, self.rate_scale + 0.05)
+        self.backoff = self.backoff / 2 if self.backoff > self.initial_backoff else 0
+
+# Asks the model for a JSON answer, retrying rate limited calls. Returns the
+# raw answer ("{}" when there is none) and whether the call failed.
+async def request_json(system_prompt, prompt, limiter):
+    conversation = [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}]
+    error = False
+    tokenizer = get_tokenizer()
+    token_length = len(tokenizer.encode(system_prompt)) + len(tokenizer.encode(prompt))
+    max_retries = int(os.getenv("MODEL_MAX_RETRIES", 3))
+    response = None
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(token_length)
+        try:
+            response = await get_async_client().chat.completions.create(
+                model=os.getenv("MODEL_NAME"),
+                messages=conversation,
+                response_format={
+                    'type': 'json_object'
+                }
+            )
+            limiter.succeeded()
+            error = False
+            break
+        except Exception as e:
+            error_msg = str(e)
+            if "429" in error_msg or "Please wait for 1 minute before trying again" in error_msg:
+                llm_logger.error("Rate limit exceeded: " + error_msg)
+                print(bcolors.OKBLUE + "Rate limit exceeded: " + error_msg + bcolors.ENDC)
+                limiter.rate_limited()
+                response = None
+                error = True
+            else:
+                llm_logger.error("LLM API error: " + error_msg)
+                print(bcolors.OKBLUE + "LLM API error: " + error_msg + bcolors.ENDC)
+                response = None
+                error = True
+                break
 
-    if max_sim_value >= threshold:
-        return prompts[max_sim_idx]
-    return None
+    if response is not None:
+        return response.choices[0].message.content, error
+    return "{}", error
 
-async def identify_resource_operation_before_request(purpose, prompt):
+async def identify_resource_operation_before_request(purpose, prompt, limiter):
     system_prompt_template = """You are a penetration testing expert. Below is a description of a web application that you
 need to analyze. The purpose of this application are {purpose}.
 
@@ -114,37 +207,8 @@ If you are unable to determine the operation or resource, please return {{}} or
 
     system_prompt = system_prompt_template.format(purpose=purpose)
 
-    conversation = [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}]
-
-    start = time.time()
-    error = False
     try:
-        try:
-            response = await async_client.chat.completions.create(
-                model=os.getenv("MODEL_NAME"),
-                messages=conversation,
-                response_format={
-                    'type': 'json_object'
-                }
-            )
-        except Exception as e:
-            error_msg = str(e)
-            if "429" in error_msg or "Please wait for 1 minute before trying again" in error_msg:
-                llm_logger.error("Rate limit exceeded: " + error_msg)
-                print(bcolors.OKBLUE + "Rate limit exceeded: " + error_msg + bcolors.ENDC)
-                await asyncio.sleep(60)
-                response = None
-                error = True
-            else:
-                llm_logger.error("LLM API error: " + error_msg)
-                print(bcolors.OKBLUE + "LLM API error: " + error_msg + bcolors.ENDC)
-                response = None
-                error = True
-
-        if response is not None:
-            answer = response.choices[0].message.content
-        else:
-            answer = "{}"
+        answer, error = await request_json(system_prompt, prompt, limiter)
 
         try:
             answer = json.loads(answer)
@@ -182,64 +246,101 @@ If you are unable to determine the operation or resource, please return {{}} or
         answer = {"operation": "unknown", "resource": "unknown", "CRUD_type": "unknown"}
     return answer, error
 
-async def analyze_request(request_queue, analysis_queue, still_crawling_signal, cache, cache_lock, hash_cache):
+async def identify_resource_dependencies(prompt, limiter):
+    system_prompt = """You are a penetration testing expert. Given a new resource A and the resources already known in a web application, determine which known resources have a parent-child relationship with A.
+A parent-child dependency means that one child resource cannot exist or function properly without the parent resource.
+User will provide resource A and the known resources, each with a few web contexts to help you understand the resource structure and their relationship.
+
+Respond only with a single line in the following JSON format, using the names of the known resources exactly as given:
+{"children": ["known resources that are children of A"], "parents": ["known resources that are parents of A"]}
+
+Example:
+Resource A: Post
+Known resource: Comment
+Known resource: User
+Known resource: Product
+{"children": ["Comment"], "parents": ["User"]}
+    """
+
+    try:
+        answer, error = await request_json(system_prompt, prompt, limiter)
+        try:
+            answer = json.loads(answer)
+            if not isinstance(answer.get("children", []), list) or not isinstance(answer.get("parents", []), list):
+                llm_logger.error("Failed to identify resource dependencies: " + str(answer))
+                answer = {}
+                error = True
+        except Exception as e:
+            llm_logger.error("Parsing error: " + str(e))
+            llm_logger.error("Failed to parse response: " + str(answer))
+            answer = {}
+            error = True
+    except Exception as e:
+        llm_logger.error(f"Failed to generate response: {str(e)}")
+        answer = {}
+        error = True
+    return answer, error
+
+async def analyze_request(request_queue, analysis_queue, still_crawling_signal, cache, cache_lock, hash_cache, similarity_index):
     model_tpm = int(os.getenv("MODEL_TPM", 1000000))
     model_tpm = 0.6 * model_tpm
     model_qpm = int(os.getenv("MODEL_QPM", 1200))
     model_qpm = 0.6 * model_qpm
+    limiter = RateLimiter(model_qpm, model_tpm)
+    tasks = set()
 
+    # Prompts are dispatched as soon as they arrive, the limiter spaces the
+    # actual LLM calls.
     while still_crawling_signal.is_set():
-        if not request_queue.empty():
-            tasks = []
-            total_batch_size = 0
-            total_batch_token_length = 0
-
-            for failed_prompt in failed_analysis_prompt:
-                if failed_analysis_prompt[failed_prompt]["retry_times"] == 1:
-                    request_wrapper = {
-                        'prompt': failed_prompt,
-                        'req_index': failed_analysis_prompt[failed_prompt]["req_index"],
-                        'edge_index': failed_analysis_prompt[failed_prompt]["edge_index"],
-                    }
-                    token_length = len(tokenizer.encode(failed_prompt))
-                    total_batch_token_length += token_length
-                    total_batch_size += 1
-                    llm_logger.info("Retry analysis: " + str(request_wrapper['edge_index']))
-                    print(bcolors.OKBLUE + "Retry analysis: " + str(request_wrapper['edge_index']) + bcolors.ENDC)
-                    tasks.append(asyncio.create_task(
-                        llm_wrapper(request_wrapper, time.time(), analysis_queue, cache, cache_lock,
-                                    hash_cache)))
-
-                    if total_batch_token_length > model_tpm or total_batch_size > model_qpm:
-                        break
-
-            while not request_queue.empty():
-                if request_queue.empty():
-                    break
-                request_wrapper = request_queue.get()
-                prompt = request_wrapper['prompt']
-                token_length = len(tokenizer.encode(prompt))
-                total_batch_token_length += token_length
-                total_batch_size += 1
-                tasks.append(asyncio.create_task(llm_wrapper(request_wrapper, time.time(), analysis_queue, cache, cache_lock, hash_cache)))
-
-                if total_batch_token_length > model_tpm or total_batch_size > model_qpm:
-                    break
-
-            if tasks:
-                start = time.time()
-                formatted_start = datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
-                print(bcolors.OKBLUE+"Start analyzing batch, start time: "+str(formatted_start)+bcolors.ENDC)
-                await asyncio.gather(*tasks)
-                MODEL_WAIT_TIME = int(os.getenv("MODEL_WAIT_TIME", 60))
-                await asyncio.sleep(MODEL_WAIT_TIME)
-            else:
-                await asyncio.sleep(1)
-
-        else:
-            await asyncio.sleep(5)
-
-async def llm_wrapper(request_wrapper, start, analysis_queue, cache, cache_lock, hash_cache):
+        for failed_prompt in failed_analysis_prompt:
+            if failed_analysis_prompt[failed_prompt]["retry_times"] == 1 and not failed_analysis_prompt[failed_prompt].get("retrying"):
+                failed_analysis_prompt[failed_prompt]["retrying"] = True
+                request_wrapper = {
+                    'prompt': failed_prompt,
+                    'req_index': failed_analysis_prompt[failed_prompt]["req_index"],
+                    'edge_index': failed_analysis_prompt[failed_prompt]["edge_index"],
+                }
+                llm_logger.info("Retry analysis: " + str(request_wrapper['edge_index']))
+                print(bcolors.OKBLUE + "Retry analysis: " + str(request_wrapper['edge_index']) + bcolors.ENDC)
+                task = asyncio.create_task(llm_wrapper(request_wrapper, time.time(), analysis_queue, cache, cache_lock, hash_cache, similarity_index, limiter))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        events = []
+        while not request_queue.empty():
+            try:
+                request_wrapper = request_queue.get_nowait()
+            except Exception:
+                break
+            if request_wrapper.get("type") == "resource_dependency":
+                task = asyncio.create_task(dependency_wrapper(request_wrapper, analysis_queue, limiter))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                continue
+            if 'is_event' in request_wrapper:
+                events.append(request_wrapper)
+                continue
+            task = asyncio.create_task(llm_wrapper(request_wrapper, time.time(), analysis_queue, cache, cache_lock, hash_cache, similarity_index, limiter))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # Events that arrived together are looked up in one batch
+        if events:
+            async with cache_lock:
+                similar_prompts = similarity_index.nearest_many([request_wrapper['prompt'] for request_wrapper in events])
+            for (request_wrapper, similar_prompt) in zip(events, similar_prompts):
+                task = asyncio.create_task(llm_wrapper(request_wrapper, time.time(), analysis_queue, cache, cache_lock, hash_cache, similarity_index, limiter, similar_prompt))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        await asyncio.sleep(float(os.getenv("MODEL_POLL_INTERVAL", 0.5)))
+
+    if tasks:
+        await asyncio.gather(*tasks)
+
+# similar_prompt is the indexed prompt found for an event, its analysis is
+# reused
+async def llm_wrapper(request_wrapper, start, analysis_queue, cache, cache_lock, hash_cache, similarity_index, limiter, similar_prompt=None):
     purpose = os.getenv("PURPOSE", "")
     req_index = request_wrapper['req_index']
     prompt = request_wrapper['prompt']
@@ -256,21 +357,22 @@ async def llm_wrapper(request_wrapper, start, analysis_queue, cache, cache_lock,
         print(bcolors.OKBLUE+"Found same prompt"+bcolors.ENDC)
         llm_logger.info("Found same prompt: \n" + str(prompt))
         analysis = hash_cache[key_hash]
-    if not find_same and 'is_event' in request_wrapper:
-        async with cache_lock:
-            similar_prompt = is_similar(prompt, cache)
-            if similar_prompt:
-                print(bcolors.OKBLUE+"Similar prompt found"+bcolors.ENDC)
-                llm_logger.info("Similar prompt found: \n" + str(prompt) + "\nSimilar prompt: \n" + str(similar_prompt))
-                find_similar = True
-                analysis = cache[similar_prompt]
+    if not find_same and similar_prompt:
+        print(bcolors.OKBLUE+"Similar prompt found"+bcolors.ENDC)
+        llm_logger.info("Similar prompt found: \n" + str(prompt) + "\nSimilar prompt: \n" + str(similar_prompt))
+        find_similar = True
+        analysis = cache[similar_prompt]
 
     if not find_same and not find_similar:
-        analysis, error = await identify_resource_operation_before_request(purpose, prompt)
+        analysis, error = await identify_resource_operation_before_request(purpose, prompt, limiter)
         async with cache_lock:
             if analysis and analysis != {}:
                 cache[prompt] = analysis
+                similarity_index.add(prompt)
                 hash_cache[key_hash] = analysis
+                llm_cache = get_llm_cache()
+                if llm_cache:
+                    llm_cache.put("before_resource_operation", prompt, analysis, keep_prompt=True)
 
     if not error:
         analysis_wrapper = {
@@ -291,16 +393,45 @@ async def llm_wrapper(request_wrapper, start, analysis_queue, cache, cache_lock,
             }
         else:
             failed_analysis_prompt[prompt]["retry_times"] += 1
+            failed_analysis_prompt[prompt]["retrying"] = False
 
     print(bcolors.OKBLUE+"Total time: "+ str(time.time() - start)+bcolors.ENDC)
     print(bcolors.OKBLUE+"Analysis for index: "+str(edge_index)+" is "+str(analysis)+bcolors.ENDC)
 
+# One question per new resource about all the known ones, the answer goes
+# back through the analysis queue
+async def dependency_wrapper(request_wrapper, analysis_queue, limiter):
+    start = time.time()
+    resource = request_wrapper["resource"]
+    answer, error = await identify_resource_dependencies(request_wrapper["prompt"], limiter)
+    # Names as the crawler knows them, whatever case the model answered in
+    known = {str(name).strip().lower(): name for name in request_wrapper["known"]}
+    analysis_queue.put({
+        "type": "resource_dependency",
+        "resource": resource,
+        "known": request_wrapper["known"],
+        "children": [known[c] for c in (str(c).strip().lower() for c in answer.get("children", [])) if c in known],
+        "parents": [known[p] for p in (str(p).strip().lower() for p in answer.get("parents", [])) if p in known],
+        "error": error
+    })
+    llm_logger.info("Resource dependencies of " + str(resource) + ": " + str(answer) + " in " + str(time.time() - start))
+    print(bcolors.OKBLUE+"Resource dependencies of "+str(resource)+" is "+str(answer)+bcolors.ENDC)
+
 def run_llm_analysis(request_queue, analysis_queue, condition_signal, still_crawling_signal):
     cache = {}
     cache_lock = asyncio.Lock()
     hash_cache = {}
+    similarity_index = SimilarityIndex()
+    # Answers from previous runs
+    llm_cache = get_llm_cache()
+    if llm_cache:
+        for prompt, analysis in llm_cache.entries("before_resource_operation"):
+            cache[prompt] = analysis
+            similarity_index.add(prompt)
+            hash_cache[hashlib.sha256(prompt.encode()).hexdigest()] = analysis
+        llm_logger.info("Loaded " + str(len(cache)) + " cached analyses")
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(
-        analyze_request(request_queue, analysis_queue, still_crawling_signal, cache, cache_lock, hash_cache))
+        analyze_request(request_queue, analysis_queue, still_crawling_signal, cache, cache_lock, hash_cache, similarity_index))
     loop.close()
\ No newline at end of file
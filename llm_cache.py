@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# LLM answers kept on disk between runs, keyed by model name, purpose, the
+# kind of question and the hash of the prompt. Least recently used entries
+# are evicted once the cache grows past LLM_CACHE_MAX_BYTES.
+class LLMCache:
+    def __init__(self, path, model_name, purpose, max_bytes):
+        self.path = path
+        self.model_name = model_name or ""
+        self.purpose = purpose or ""
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+            model TEXT NOT NULL,
+            purpose TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            prompt TEXT,
+            answer TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (model, purpose, kind, prompt_hash))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self.connection.commit()
+        self.total_bytes = self.stored_bytes()
+
+    @staticmethod
+    def prompt_hash(prompt):
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    def stored_bytes(self):
+        row = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        return row[0]
+
+    def get(self, kind, prompt):
+        key = (self.model_name, self.purpose, kind, self.prompt_hash(prompt))
+        with self.lock:
+            try:
+                row = self.connection.execute(
+                    "SELECT answer FROM llm_cache WHERE model=? AND purpose=? AND kind=? AND prompt_hash=?",
+                    key).fetchone()
+                if row is None:
+                    return None
+                self.connection.execute(
+                    "UPDATE llm_cache SET accessed=? WHERE model=? AND purpose=? AND kind=? AND prompt_hash=?",
+                    (time.time(),) + key)
+                self.connection.commit()
+            except sqlite3.Error as e:
+                logging.warning("LLM cache read failed: " + str(e))
+                return None
+        return json.loads(row[0])
+
+    def put(self, kind, prompt, answer, keep_prompt=False):
+        stored_prompt = prompt if keep_prompt else None
+        encoded = json.dumps(answer)
+        size = len(encoded) + (len(stored_prompt) if stored_prompt else 0)
+        key = (self.model_name, self.purpose, kind, self.prompt_hash(prompt))
+        with self.lock:
+            try:
+                # A replaced answer no longer counts
+                row = self.connection.execute(
+                    "SELECT size FROM llm_cache WHERE model=? AND purpose=? AND kind=? AND prompt_hash=?",
+                    key).fetchone()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    key + (stored_prompt, encoded, size, time.time()))
+                self.connection.commit()
+                self.total_bytes += size - (row[0] if row else 0)
+                if self.total_bytes > self.max_bytes:
+                    self.evict()
+            except sqlite3.Error as e:
+                logging.warning("LLM cache write failed: " + str(e))
+
+    # Answers stored with their prompt, oldest first
+    def entries(self, kind):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT prompt, answer FROM llm_cache WHERE model=? AND purpose=? AND kind=? AND prompt IS NOT NULL ORDER BY accessed",
+                (self.model_name, self.purpose, kind)).fetchall()
+        return [(prompt, json.loads(answer)) for prompt, answer in rows]
+
+    def evict(self):
+        # Other processes write to the same file, recount first
+        self.total_bytes = self.stored_bytes()
+        target = int(self.max_bytes * 0.9)
+        while self.total_bytes > target:
+            removed = self.connection.execute(
+                "DELETE FROM llm_cache WHERE rowid IN (SELECT rowid FROM llm_cache ORDER BY accessed LIMIT 100)").rowcount
+            self.connection.commit()
+            if not removed:
+                break
+            self.total_bytes = self.stored_bytes()
+        logging.info("LLM cache evicted down to " + str(self.total_bytes) + " bytes")
+
+llm_cache = None
+llm_cache_pid = None
+
+# One cache per process, None when LLM_CACHE_PATH is set to an empty value
+def get_llm_cache():
+    global llm_cache, llm_cache_pid
+    if llm_cache_pid == os.getpid():
+        return llm_cache
+    llm_cache_pid = os.getpid()
+    path = os.getenv("LLM_CACHE_PATH", os.path.join(os.getcwd(), "cache", "llm_cache.sqlite"))
+    if not path:
+        llm_cache = None
+        return llm_cache
+    try:
+        llm_cache = LLMCache(path,
+                             os.getenv("MODEL_NAME"),
+                             os.getenv("PURPOSE", ""),
+                             int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024)))
+    except (sqlite3.Error, OSError) as e:
+        logging.warning("LLM cache disabled: " + str(e))
+        llm_cache = None
+    return llm_cache
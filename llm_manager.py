@@ -2,13 +2,31 @@ import hashlib
 import json
 import os
 import logging
+import threading
 
-import httpx
 import time
-from openai import OpenAI, AsyncOpenAI
+
+from llm_cache import get_llm_cache
+
+tokenizer = None
+tokenizer_lock = threading.Lock()
+
+# One tokenizer per process, transformers is only imported when it is first
+# needed
+def get_tokenizer():
+    global tokenizer
+    with tokenizer_lock:
+        if tokenizer is None:
+            import transformers
+            tokenizer = transformers.AutoTokenizer.from_pretrained(os.getcwd(), trust_remote_code=True)
+        return tokenizer
 
 class LLMManager:
     def __init__(self, api_key, base_url, model_name):
+        # The clients take a while to import, only pay for them when used
+        import httpx
+        from openai import OpenAI, AsyncOpenAI
+
         self.api_key = api_key
         self.base_url = base_url
         self.model_name = model_name
@@ -178,6 +196,13 @@ Resource B: Post
         if key_hash in self.after_resource_operation_cache:
             logging.info("Cache hit for after_resource_operation: " + key_hash)
             return self.after_resource_operation_cache[key_hash]
+        llm_cache = get_llm_cache()
+        if llm_cache:
+            answer = llm_cache.get("after_resource_operation", page_state)
+            if answer is not None:
+                logging.info("Disk cache hit for after_resource_operation: " + key_hash)
+                self.after_resource_operation_cache[key_hash] = answer
+                return answer
 
         system_prompt_template = """You are a penetration testing expert. Below is a description of a web application that you 
 need to analyze. The purpose of this application are {purpose}.
@@ -280,4 +305,6 @@ or {{"operation": "unknown", "resource": "unknown", "CRUD_type": "unknown", "suc
             answer = {}
         if answer != {}:
             self.after_resource_operation_cache[key_hash] = answer
+            if llm_cache:
+                llm_cache.put("after_resource_operation", page_state, answer)
         return answer
\ No newline at end of file
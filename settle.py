@@ -0,0 +1,71 @@
+from selenium.common.exceptions import UnexpectedAlertPresentException
+from datetime import datetime
+import json
+import os
+import logging
+import time
+
+# Upper bound for a single settle, and how long the DOM has to be quiet
+settle_max_wait = float(os.getenv("SETTLE_MAX_WAIT", 5.0))
+settle_quiet_time = float(os.getenv("SETTLE_QUIET_TIME", 0.3))
+settle_poll_interval = float(os.getenv("SETTLE_POLL_INTERVAL", 0.05))
+
+settle_stats = {"count": 0, "total": 0.0, "bounded": 0}
+
+def page_settle_state(driver):
+    try:
+        return json.loads(driver.execute_script("return settle_state()"))
+    except UnexpectedAlertPresentException:
+        # Left for the caller to handle
+        logging.warning("Alert detected while waiting for the page")
+        return None
+    except Exception as e:
+        logging.debug("No settle state " + str(e).splitlines()[0])
+        return None
+
+# selenium-wire also sees navigations and resources, not only XHR/fetch
+def has_pending_traffic(driver, max_wait):
+    try:
+        last_request = driver.last_request
+    except Exception:
+        return False
+    if last_request is None or last_request.response is not None:
+        return False
+    return (datetime.now() - last_request.date).total_seconds() < max_wait
+
+def is_settled(state, quiet_time):
+    return (state['ready_state'] == "complete"
+            and state['pending_requests'] == 0
+            and state['pending_timers'] == 0
+            and state['quiet_ms'] >= quiet_time * 1000)
+
+# Wait until the network is idle, the DOM stopped changing and no short
+# timers are pending, at most max_wait seconds. Returns the time it took.
+def wait_for_settle(driver, reason="", max_wait=None):
+    if max_wait is None:
+        max_wait = settle_max_wait
+    start = time.time()
+    state = None
+    settled = False
+    while True:
+        state = page_settle_state(driver)
+        if state is None:
+            # Alert or page without instrumentation, nothing to wait for
+            settled = True
+            break
+        if is_settled(state, settle_quiet_time) and not has_pending_traffic(driver, max_wait):
+            settled = True
+            break
+        if time.time() - start >= max_wait:
+            break
+        time.sleep(settle_poll_interval)
+
+    elapsed = time.time() - start
+    settle_stats["count"] += 1
+    settle_stats["total"] += elapsed
+    if settled:
+        logging.info("Page settled in %.2fs (%s)" % (elapsed, reason))
+    else:
+        settle_stats["bounded"] += 1
+        logging.warning("Page not settled after %.2fs (%s) %s" % (elapsed, reason, str(state)))
+    return elapsed
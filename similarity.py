@@ -0,0 +1,148 @@
+import math
+import re
+import hashlib
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# Same tokens as the default TfidfVectorizer
+token_pattern = re.compile(r"(?u)\b\w\w+\b")
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), "little")
+
+# Near duplicate lookup for prompts.
+#
+# Candidates come from MinHash LSH over the token sets, so a query only looks
+# at prompts sharing a band instead of refitting a TfidfVectorizer over all of
+# them. Candidates are then scored with the same smoothed TF-IDF cosine as
+# TfidfVectorizer fitted on [query] + prompts, using document frequencies
+# maintained incrementally.
+class SimilarityIndex:
+    def __init__(self, bands=32, rows=4, seed=1):
+        self.bands = bands
+        self.rows = rows
+        generator = np.random.RandomState(seed)
+        permutations = bands * rows
+        # Multiply-shift hashing, multipliers have to be odd
+        self.hash_a = generator.randint(0, 1 << 63, size=permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.hash_b = generator.randint(0, 1 << 63, size=permutations, dtype=np.uint64)
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+        self.prompts = []
+        self.counts = []
+        self.document_frequency = Counter()
+        self.prompt_index = {}
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def __contains__(self, prompt):
+        return prompt in self.prompt_index
+
+    # MinHash signatures of several term lists, one row each
+    def signatures(self, term_lists):
+        hashes = np.fromiter((term_hash(term) for terms in term_lists for term in terms), dtype=np.uint64)
+        lengths = np.array([len(terms) for terms in term_lists], dtype=np.int64)
+        signatures = np.zeros((len(term_lists), self.bands * self.rows), dtype=np.uint64)
+        filled = lengths > 0
+        if not filled.any():
+            return signatures
+        # (a * h + b) mod 2^64, keeping the high bits
+        values = (np.outer(self.hash_a, hashes) + self.hash_b[:, None]) >> np.uint64(32)
+        # Minimum per term list, empty ones have no segment
+        starts = (np.cumsum(lengths) - lengths)[filled]
+        signatures[filled] = np.minimum.reduceat(values, starts, axis=1).T
+        return signatures
+
+    def signature(self, terms):
+        return self.signatures([terms])[0]
+
+    def band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def add(self, prompt):
+        if prompt in self.prompt_index:
+            return self.prompt_index[prompt]
+        counts = Counter(tokenize(prompt))
+        index = len(self.prompts)
+        self.prompts.append(prompt)
+        self.counts.append(counts)
+        self.prompt_index[prompt] = index
+        self.document_frequency.update(counts.keys())
+        if counts:
+            for band, key in self.band_keys(self.signature(list(counts))):
+                self.buckets[band][key].append(index)
+        return index
+
+    # added are the term counts of prompts taken as added to the corpus
+    def cosine(self, query_counts, counts, added=()):
+        # The query is part of the corpus, as in fit_transform([prompt] + prompts)
+        documents = len(self.prompts) + 1 + len(added)
+
+        def idf(term):
+            frequency = (self.document_frequency[term] + (1 if term in query_counts else 0) +
+                         sum(1 for other in added if term in other))
+            return math.log((1 + documents) / (1 + frequency)) + 1
+
+        def weights(term_counts):
+            return {term: count * idf(term) for term, count in term_counts.items()}
+
+        query_weights = weights(query_counts)
+        candidate_weights = weights(counts)
+        dot = sum(weight * candidate_weights[term] for term, weight in query_weights.items() if term in candidate_weights)
+        norm = math.sqrt(sum(w * w for w in query_weights.values())) * math.sqrt(sum(w * w for w in candidate_weights.values()))
+        if norm == 0:
+            return 0.0
+        return dot / norm
+
+    # Most similar indexed prompt with a similarity >= threshold, or None
+    def nearest(self, prompt, threshold=0.95):
+        if not self.prompts:
+            return None
+        return self.nearest_many([prompt], threshold)[0]
+
+    # nearest for each of prompts, with the signatures computed together and
+    # the buckets looked up once per prompt. With batch=True a prompt also
+    # matches an earlier one of prompts that matched nothing, as when those
+    # are added one after another.
+    def nearest_many(self, prompts, threshold=0.95, batch=False):
+        query_counts = [Counter(tokenize(prompt)) for prompt in prompts]
+        signatures = self.signatures([list(counts) for counts in query_counts])
+        batch_buckets = [defaultdict(list) for _ in range(self.bands)]
+        batch_prompts = set()
+        added = []
+        found = []
+        for (position, prompt) in enumerate(prompts):
+            if prompt in self.prompt_index or prompt in batch_prompts:
+                found.append(prompt)
+                continue
+            counts = query_counts[position]
+            keys = list(self.band_keys(signatures[position])) if counts else []
+            candidates = set()
+            earlier = set()
+            for band, key in keys:
+                candidates.update(self.buckets[band].get(key, ()))
+                earlier.update(batch_buckets[band].get(key, ()))
+            best_prompt = None
+            best_value = threshold
+            for index in sorted(candidates):
+                value = self.cosine(counts, self.counts[index], added)
+                if value >= best_value:
+                    best_prompt = self.prompts[index]
+                    best_value = value
+            for other in sorted(earlier):
+                value = self.cosine(counts, query_counts[other], added)
+                if value >= best_value:
+                    best_prompt = prompts[other]
+                    best_value = value
+            found.append(best_prompt)
+            if batch and best_prompt is None:
+                batch_prompts.add(prompt)
+                added.append(counts)
+                for band, key in keys:
+                    batch_buckets[band][key].append(position)
+        return found
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+
+# Page sources, page markdown and captured traffic of the crawl edges.
+#
+# Content is stored once per sha256 digest, zlib compressed on disk. Edges
+# only keep the digest, recently used content stays decoded in memory up to
+# SNAPSHOT_MEMORY_BYTES.
+class SnapshotStore:
+    def __init__(self, path, memory_bytes):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.lock = threading.Lock()
+        self.stats = {"put": 0, "stored": 0, "hits": 0, "reads": 0}
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def remember(self, digest, value, size):
+        self.memory[digest] = (value, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_bytes and len(self.memory) > 1:
+            (_, (_, old_size)) = self.memory.popitem(last=False)
+            self.memory_used -= old_size
+
+    # Stores a JSON serializable value and returns its digest
+    def put(self, value):
+        if value is None:
+            return None
+        encoded = json.dumps(value).encode()
+        digest = hashlib.sha256(encoded).hexdigest()
+        with self.lock:
+            self.stats["put"] += 1
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                return digest
+            file_path = self.file_path(digest)
+            if not os.path.exists(file_path):
+                directory = os.path.dirname(file_path)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                tmp_path = file_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(zlib.compress(encoded))
+                os.replace(tmp_path, file_path)
+                self.stats["stored"] += 1
+            self.remember(digest, value, len(encoded))
+        return digest
+
+    def get(self, digest):
+        if digest is None:
+            return None
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                self.stats["hits"] += 1
+                return self.memory[digest][0]
+            self.stats["reads"] += 1
+            try:
+                with open(self.file_path(digest), "rb") as f:
+                    encoded = zlib.decompress(f.read())
+            except (OSError, zlib.error) as e:
+                logging.error("Missing snapshot " + digest + " " + str(e).splitlines()[0])
+                return None
+            value = json.loads(encoded)
+            self.remember(digest, value, len(encoded))
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_used = 0
+            for name in os.listdir(self.path):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+snapshot_store = None
+
+def get_snapshot_store():
+    global snapshot_store
+    if snapshot_store is None:
+        snapshot_store = SnapshotStore(os.getenv("SNAPSHOT_DIR", os.path.join(os.getcwd(), "cache", "snapshots")),
+                                       int(os.getenv("SNAPSHOT_MEMORY_BYTES", 64 * 1024 * 1024)))
+    return snapshot_store
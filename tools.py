@@ -1,6 +1,26 @@
 from selenium.webdriver.common.by import By
 
+# Resolved in the page by getAccessibleName() from js/page_extractor.js in a
+# single command, the browser computed label is only requested when needed.
 def get_accessible_name(driver, element) -> str:
+    try:
+        accessible_name = driver.execute_script("return getAccessibleName(arguments[0])", element)
+    except Exception:
+        return get_accessible_name_by_commands(driver, element)
+    if accessible_name is None:
+        return element.accessible_name
+    return accessible_name
+
+# Accessible name of an element serialized by js/page_extractor.js
+def resolve_accessible_name(driver, element_data) -> str:
+    if element_data.get('accessible_name') is not None:
+        return element_data['accessible_name']
+    try:
+        return driver.find_element(By.XPATH, element_data['xpath']).accessible_name
+    except Exception:
+        return None
+
+def get_accessible_name_by_commands(driver, element) -> str:
     aria_labelledby = element.get_attribute("aria-labelledby")
     if aria_labelledby:
         try:
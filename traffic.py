@@ -0,0 +1,171 @@
+from selenium.webdriver import Chrome
+from urllib.parse import urlparse
+from datetime import datetime
+import base64
+import json
+import logging
+import os
+import re
+
+# Bodies longer than this are cut before they are stored on an edge
+traffic_max_body = int(os.getenv("TRAFFIC_MAX_BODY", 64 * 1024))
+
+filter_content_types = [
+    "text/css",
+    "application/javascript",
+    "image/png",
+    "font/woff2",
+    "font/woff",
+    "font/ttf",
+    "image/x-icon",
+    "application/font-woff",
+    "image/vnd.microsoft.icon",
+    "image/jpg",
+    "image/jpeg",
+    "image/gif",
+    "multipart/form-data",
+    "application/octet-stream",
+    "application/x-www-form-urlencoded"
+]
+
+fileter_postfixes = [
+    ".js",
+    ".css",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".svg",
+    ".ico",
+    ".woff2",
+    ".woff",
+    ".ttf",
+]
+
+heart_beats = [
+    "api/sessions"
+]
+
+# selenium-wire scope for the origin of url, without the static files
+def capture_scope(url):
+    purl = urlparse(url)
+    origin = re.escape(purl.scheme + "://" + purl.netloc)
+    postfixes = "|".join(re.escape(postfix) for postfix in fileter_postfixes)
+    return "^" + origin + "(?:[/?#]|$)(?![^?#]*(?:" + postfixes + ")(?:[?#]|$))"
+
+# Only keep the traffic get_traffic can use, everything else is not even stored
+def configure_capture(driver, url):
+    try:
+        driver.scopes = [capture_scope(url)]
+    except Exception as e:
+        logging.warning("Can't scope traffic capture " + str(e).splitlines()[0])
+
+# Drops the captured traffic, returns the number of requests left (usually 0)
+def reset_capture(driver):
+    try:
+        del driver.requests
+    except Exception as e:
+        logging.warning("Can't purge captured traffic " + str(e).splitlines()[0])
+    return len(driver.requests)
+
+def truncate_body(body):
+    if len(body) > traffic_max_body:
+        return body[:traffic_max_body] + "...[truncated " + str(len(body) - traffic_max_body) + " characters]"
+    return body
+
+class CapturedResponse:
+    def __init__(self, driver, request_id, response):
+        self.driver = driver
+        self.request_id = request_id
+        self.status_code = response.get("status")
+        self.headers = response.get("headers", {})
+        # Redirects have no body to fetch
+        self._body = None if request_id else b""
+
+    @property
+    def body(self):
+        if self._body is None:
+            result = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": self.request_id})
+            body = result.get("body", "")
+            self._body = base64.b64decode(body) if result.get("base64Encoded") else body.encode()
+        return self._body
+
+# Same attributes as a selenium-wire request, as far as get_traffic and
+# settle use them
+class CapturedRequest:
+    def __init__(self, driver, request_id, request, wall_time):
+        self.driver = driver
+        self.request_id = request_id
+        self.url = request["url"]
+        self.method = request["method"]
+        self.headers = request.get("headers", {})
+        self.has_post_data = request.get("hasPostData", False)
+        self.date = datetime.fromtimestamp(wall_time) if wall_time else datetime.now()
+        self.response = None
+        self._body = request["postData"].encode() if "postData" in request else None
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = b""
+            if self.has_post_data:
+                try:
+                    result = self.driver.execute_cdp_cmd("Network.getRequestPostData", {"requestId": self.request_id})
+                    self._body = result.get("postData", "").encode()
+                except Exception as e:
+                    logging.debug("No post data " + str(e).splitlines()[0])
+        return self._body
+
+# Chrome that records its traffic from the DevTools Network events in the
+# performance log instead of going through the selenium-wire proxy. It offers
+# the parts of the selenium-wire API the crawler uses: scopes, requests,
+# del requests and last_request.
+class CdpChrome(Chrome):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scopes = []
+        self.captured = []
+        self.captured_by_id = {}
+        self.execute_cdp_cmd("Network.enable", {})
+
+    def in_scope(self, url):
+        return not self.scopes or any(re.search(scope, url) for scope in self.scopes)
+
+    def poll_network(self):
+        for entry in self.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            method = message.get("method")
+            params = message.get("params", {})
+            if method == "Network.requestWillBeSent":
+                request_id = params["requestId"]
+                # A redirect reuses the request id for the next hop
+                previous = self.captured_by_id.pop(request_id, None)
+                if previous is not None and "redirectResponse" in params:
+                    previous.response = CapturedResponse(self, None, params["redirectResponse"])
+                if not self.in_scope(params["request"]["url"]):
+                    continue
+                captured = CapturedRequest(self, request_id, params["request"], params.get("wallTime"))
+                self.captured.append(captured)
+                self.captured_by_id[request_id] = captured
+            elif method == "Network.responseReceived":
+                captured = self.captured_by_id.get(params["requestId"])
+                if captured is not None:
+                    captured.response = CapturedResponse(self, params["requestId"], params["response"])
+
+    @property
+    def requests(self):
+        self.poll_network()
+        return list(self.captured)
+
+    @requests.deleter
+    def requests(self):
+        self.poll_network()
+        self.captured = []
+        self.captured_by_id = {}
+
+    @property
+    def last_request(self):
+        self.poll_network()
+        if self.captured:
+            return self.captured[-1]
+        return None